@@ -5,15 +5,16 @@ from PyQt6.QtWidgets import (
     QApplication, QWidget, QPushButton, QVBoxLayout, QLabel, QMainWindow, QMessageBox
 )
 from PyQt6.QtCore import Qt, QTimer
-from settings_window import SettingsWindow  # Our updated settings window with plan support
-from single_measurement_window import SingleMeasurementInspection
-from measurement_plan_window import MeasurementPlanWindow  # New file for plan management
-from debug_window import DebugWindow  # Import the full DebugWindow implementation
-from continuous_measurement_window import ContinuousMeasurementWindow  # New continuous measurement window
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'process-data', 'artifact'))
+from StartupTiming import record_milestone
+
+# The sub-windows are imported when they are opened, so the main window is
+# shown without first loading matplotlib, numpy and the plotting code.
 
 class SingleMeasurementWindow(QWidget):
     def __init__(self):
         super().__init__()
+        from single_measurement_window import SingleMeasurementInspection
         # Open the full Single Measurement Inspection window.
         self.inspection = SingleMeasurementInspection()
         self.inspection.setWindowTitle("Single Measurement Inspection")
@@ -109,22 +110,27 @@ class PlenseMainGUI(QMainWindow):
             self.measurement_app_proc = None
 
     def open_single_measurement(self):
+        from single_measurement_window import SingleMeasurementInspection
         self.single_measurement_window = SingleMeasurementInspection()
         self.single_measurement_window.show()
 
     def open_global_settings(self):
+        from settings_window import SettingsWindow
         self.settings_window = SettingsWindow(plan_index=None)
         self.settings_window.show()
 
     def open_plan(self):
+        from measurement_plan_window import MeasurementPlanWindow
         self.measurement_plan_window = MeasurementPlanWindow()
         self.measurement_plan_window.show()
 
     def open_continuous_measurement(self):
+        from continuous_measurement_window import ContinuousMeasurementWindow
         self.continuous_measurement_window = ContinuousMeasurementWindow()
         self.continuous_measurement_window.show()
 
     def open_debug(self):
+        from debug_window import DebugWindow
         self.debug_window = DebugWindow()
         self.debug_window.show()
 
@@ -132,4 +138,5 @@ if __name__ == "__main__":
     app = QApplication(sys.argv)
     main_window = PlenseMainGUI()
     main_window.show()
+    record_milestone('interface-guis', 'main_window_shown')
     sys.exit(app.exec())
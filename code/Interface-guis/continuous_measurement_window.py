@@ -1,42 +1,47 @@
 import sys
-import os
 import time
-import shutil
 import numpy as np
-import soundfile as sf
+import matplotlib.pyplot as plt
 
 from PyQt6.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QApplication, QMessageBox, QPlainTextEdit
+    QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QApplication, QMessageBox, QPlainTextEdit, QComboBox
 )
 from PyQt6.QtCore import Qt, QTimer
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 
 from settings_window import load_settings
-from continuous_measurement_functions import schedule_measurement, process_measurement
+from continuous_measurement_functions import (
+    plan_trends, predict_plan_duration, registered_plans, start_plans, stop_plans)
+from measurement_event_listener import MeasurementEventListener, is_plan_progress
 from measurement_plan_window import MeasurementPlanWindow
 
+# Trend periods, in days
+TREND_PERIODS = {"Day": 1, "Week": 7, "Month": 31, "Year": 365}
+
 class ContinuousMeasurementWindow(QWidget):
+    """
+    Registers the measurement plans with the measure service, which
+    measures them at their interval (also when this window is closed),
+    shows the progress of their runs from the plan_progress events and
+    plots the max amplitude trend of the plans from the trend store.
+    """
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Continuous Measurement")
-        self.setGeometry(100, 100, 600, 400)
-        self.continuous_active = False
+        self.setGeometry(100, 100, 800, 700)
         self.plans = []
-        # For each plan, store its next scheduled measurement time (timestamp)
-        self.next_due = {}
-        # The index of the plan currently being measured (or None if idle)
-        self.current_plan_index = None
-        # Global timer for waiting until the next scheduled measurement
-        self.global_timer = QTimer(self)
-        self.global_timer.setSingleShot(True)
-        # (The connection for global_timer will be set in schedule_next_measurement)
-        self.poll_timer = None  # Timer used for polling for a measurement result
-        # Variables for the measurement in progress:
-        self.current_start_time = None
-        self.current_wait_duration = None
-        self.current_existing_files = None
+        # Last plan_progress event per plan name
+        self.plan_progress = {}
+        # Receives the plan progress events of the measure service
+        self.event_listener = MeasurementEventListener(self)
+        self.event_listener.event_received.connect(self.on_measurement_event)
+        self.event_listener.start()
 
         self.init_ui()
         self.load_plans()
+        # The plans keep running when the window was closed
+        self.continuous_active = bool(registered_plans())
+        self.update_buttons()
 
         # Progress display (updates every second)
         self.progress_display = QPlainTextEdit(self)
@@ -46,6 +51,20 @@ class ContinuousMeasurementWindow(QWidget):
         self.progress_timer = QTimer(self)
         self.progress_timer.setInterval(1000)
         self.progress_timer.timeout.connect(self.update_progress)
+        self.progress_timer.start()
+
+        # Trend plot, redrawn when a plan run finished
+        trend_layout = QHBoxLayout()
+        trend_layout.addWidget(QLabel("Max amplitude trend over the last:", self))
+        self.trend_period = QComboBox(self)
+        self.trend_period.addItems(TREND_PERIODS)
+        self.trend_period.currentTextChanged.connect(self.plot_trends)
+        trend_layout.addWidget(self.trend_period)
+        self.layout().addLayout(trend_layout)
+        self.trend_figure, self.trend_ax = plt.subplots()
+        self.trend_canvas = FigureCanvas(self.trend_figure)
+        self.layout().addWidget(self.trend_canvas)
+        self.plot_trends()
 
     def init_ui(self):
         main_layout = QVBoxLayout()
@@ -81,10 +100,9 @@ class ContinuousMeasurementWindow(QWidget):
         if self.plans:
             details = ""
             for i, plan in enumerate(self.plans):
-                details += f"{i+1}. {plan.get('plan_name', 'Unnamed Plan')}: Sequence: {', '.join(plan.get('measurement_sequence', []))}\n"
-                # Initialize next_due to current time + interval (or default 300 s)
                 interval = plan.get("interval", 300)
-                self.next_due[i] = time.time() + interval
+                details += (f"{i+1}. {plan.get('plan_name', 'Unnamed Plan')}: Sequence: {', '.join(plan.get('measurement_sequence', []))}"
+                            f", every {interval}s (~{predict_plan_duration(plan):.1f}s)\n")
             self.plan_details_label.setText(details)
         else:
             self.plan_details_label.setText("No measurement plans available.")
@@ -92,109 +110,89 @@ class ContinuousMeasurementWindow(QWidget):
     def open_plan_window(self):
         self.plan_window = MeasurementPlanWindow()
         self.plan_window.show()
-        self.plan_window.destroyed.connect(self.load_plans)
+        self.plan_window.destroyed.connect(self.plans_changed)
+
+    def plans_changed(self):
+        self.load_plans()
+        # Register the changed plans if they are running
+        if self.continuous_active:
+            start_plans(self.plans)
 
     def toggle_continuous(self):
         if not self.continuous_active:
             if not self.plans:
                 QMessageBox.warning(self, "No Plans", "No measurement plans are available.")
                 return
+            start_plans(self.plans)
             self.continuous_active = True
+        else:
+            stop_plans()
+            self.continuous_active = False
+            self.plan_progress.clear()
+        self.update_buttons()
+
+    def update_buttons(self):
+        if self.continuous_active:
             self.status_label.setText("Status: Measurement Running")
             self.start_stop_btn.setText("Stop")
-            self.progress_timer.start()
-            # Schedule the next measurement (choose the plan with the smallest next_due)
-            self.schedule_next_measurement()
         else:
-            self.continuous_active = False
             self.status_label.setText("Status: Idle")
             self.start_stop_btn.setText("Start")
-            if self.global_timer.isActive():
-                self.global_timer.stop()
-            if self.poll_timer and self.poll_timer.isActive():
-                self.poll_timer.stop()
-            self.progress_timer.stop()
-            self.progress_display.clear()
-
-    def schedule_next_measurement(self):
-        """Find the plan with the earliest next_due and schedule its measurement."""
-        if not self.continuous_active:
-            return
-        now = time.time()
-        next_plan_index = None
-        min_due = float('inf')
-        for idx, due in self.next_due.items():
-            if due < min_due:
-                min_due = due
-                next_plan_index = idx
-        if next_plan_index is None:
-            return
-        delay = max(0, min_due - now)
-        self.status_label.setText(f"Status: Next measurement in {delay:.1f}s")
-        # Set up the global timer to wait until the next plan is due.
-        self.global_timer = QTimer(self)
-        self.global_timer.setSingleShot(True)
-        self.global_timer.timeout.connect(lambda: self.run_scheduled_measurement(next_plan_index))
-        self.global_timer.start(int(delay * 1000))
-
-    def run_scheduled_measurement(self, plan_index):
-        """When the global timer fires, run measurement for the selected plan."""
-        if not self.continuous_active:
-            return
-        self.current_plan_index = plan_index
-        current_plan = self.plans[plan_index]
-        print(f"Starting measurement for plan {current_plan.get('plan_name')}")
-        # Overwrite the global interrupt file with the messages for this plan.
-        estimated_duration, _ = schedule_measurement(current_plan)
-        if estimated_duration is None:
-            # Retry after a short delay if needed.
-            QTimer.singleShot(1000, lambda: self.run_scheduled_measurement(plan_index))
-            return
-        # Compute wait_duration as estimated_duration * 1.5.
-        wait_duration = estimated_duration * 1.1
-        self.current_start_time = time.time()
-        self.current_wait_duration = wait_duration
-        # Use updated audio folder.
-        audio_folder = "/home/plense/plensor_data/audio_data/time_domain_not_processed"
-        if not os.path.exists(audio_folder):
-            os.makedirs(audio_folder)
-        self.current_existing_files = set(os.listdir(audio_folder))
-        # Start a poll timer to check for a new FLAC file.
-        self.poll_timer = QTimer(self)
-        self.poll_timer.setInterval(500)
-        self.poll_timer.timeout.connect(lambda: self.poll_measurement(current_plan, plan_index, audio_folder, wait_duration))
-        self.poll_timer.start()
-
-    def poll_measurement(self, plan, plan_index, audio_folder, wait_duration):
-        result = process_measurement(plan, self.current_start_time, wait_duration, audio_folder, self.current_existing_files)
-        if result and result[0][0] is not None:  # Check if valid file was found
-            # Measurement completed successfully
-            self.poll_timer.stop()
-            source_path, creation_time = result[0]
-            print(f"Plan {plan.get('plan_name')} measured file at {source_path} at t={creation_time:.2f}s")
-            # Update next_due for this plan (add its interval to the previous scheduled time)
-            interval = plan.get("interval", 300)
-            self.next_due[plan_index] += interval
-            self.schedule_next_measurement()
-        else:
-            elapsed = time.time() - self.current_start_time
-            if elapsed >= wait_duration:
-                # Timeout: measurement did not complete in expected time
-                self.poll_timer.stop()
-                print(f"Plan {plan.get('plan_name')} measurement timeout after {elapsed:.2f}s")
-                interval = plan.get("interval", 300)
-                self.next_due[plan_index] += interval
-                self.schedule_next_measurement()
+
+    def on_measurement_event(self, event):
+        if is_plan_progress(event):
+            self.plan_progress[event["plan_name"]] = event
+            if event["status"] != "running":
+                self.plot_trends()
+
+    def plot_trends(self):
+        """
+        Plots the mean and min-max band of the max amplitude of every plan
+        and sensor, read at the resolution that fits the plot width.
+        """
+        days = TREND_PERIODS[self.trend_period.currentText()]
+        max_points = max(self.trend_canvas.width(), 100)
+        self.trend_ax.clear()
+        for plan in self.plans:
+            name = plan.get("plan_name", "Unnamed Plan")
+            for sensor_id, series in plan_trends(name, days, max_points):
+                times = series["timestamp"].astype(np.int64).astype("datetime64[s]")
+                line, = self.trend_ax.plot(times, series["mean"], label=f"{name} #{sensor_id}")
+                if series["resolution"] != "raw":
+                    self.trend_ax.fill_between(times, series["min"], series["max"], color=line.get_color(), alpha=0.2)
+        self.trend_ax.set_ylabel("Max amplitude")
+        if self.trend_ax.has_data():
+            self.trend_ax.legend(loc="upper left", fontsize="small")
+        self.trend_figure.autofmt_xdate()
+        self.trend_canvas.draw_idle()
+
+    def closeEvent(self, event):
+        self.event_listener.stop()
+        super().closeEvent(event)
 
     def update_progress(self):
-        """Update the progress display showing time until next measurement."""
-        if not self.next_due:
-            self.progress_display.setPlainText("No measurement scheduled.")
+        """Update the progress display with the last run of every plan."""
+        if not self.continuous_active:
+            self.progress_display.setPlainText("No measurement plans running.")
             return
         now = time.time()
-        next_due_time = min(self.next_due.values())
-        remaining = max(0, next_due_time - now)
-        self.progress_display.setPlainText(f"Time until next measurement: {remaining:.1f}s")
+        lines = []
+        for plan in self.plans:
+            name = plan.get("plan_name", "Unnamed Plan")
+            progress = self.plan_progress.get(name)
+            if progress is None:
+                lines.append(f"{name}: waiting for the first run")
+                continue
+            started = progress["time"] - progress["elapsed_s"]
+            line = f"{name}: {progress['status']}, {progress['done']}/{progress['total']} messages"
+            if progress["skipped"]:
+                line += f", {progress['skipped']} skipped after the deadline"
+            if progress["status"] == "running":
+                line += f", {now - started:.1f}s of ~{progress['predicted_s']:.1f}s"
+            else:
+                line += f", next run in {max(0, started + plan.get('interval', 300) - now):.1f}s"
+            lines.append(line)
+        self.progress_display.setPlainText("\n".join(lines))
 
 if __name__ == "__main__":
     from PyQt6.QtWidgets import QApplication
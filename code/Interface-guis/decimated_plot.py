@@ -0,0 +1,154 @@
+import os
+import sys
+import numpy as np
+
+from PyQt6.QtCore import QThread, pyqtSignal
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'process-data', 'artifact'))
+from PreviewBuilder import PreviewBuilder
+
+MINMAX = 'minmax'
+LTTB = 'lttb'
+
+
+def minmax_decimate(x, y, width) -> tuple:
+    """
+    Decimates a line to the minimum and maximum of `width` bins (e.g. the
+    width of the axes in pixels), so every peak stays visible. The bins are
+    those of `PreviewBuilder.minmax_envelope`, any number of points works.
+
+    Returns:
+        tuple: (x, y) with 2 points per bin, or the line itself if it has
+            no more points than that.
+    """
+    if len(y) <= 2 * width:
+        return x, y
+    starts, minima, maxima = PreviewBuilder.minmax_envelope(y, width)
+    return np.repeat(x[starts], 2), np.column_stack([minima, maxima]).ravel()
+
+
+def lttb(x, y, threshold) -> tuple:
+    """
+    Decimates a line to `threshold` points with Largest-Triangle-Three-
+    Buckets: of every bucket, the point that makes the largest triangle with
+    the point picked in the previous bucket and the mean of the next bucket
+    is kept, which follows the shape of the line better than min/max bins
+    for spectra.
+
+    Returns:
+        tuple: (x, y), or the line itself if it has no more points.
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return x, y
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # Bucket edges of the points between the first and the last point
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    picked = np.empty(threshold, dtype=np.int64)
+    picked[0], picked[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        mean_x = x[stop:next_stop].mean()
+        mean_y = y[stop:next_stop].mean()
+        areas = np.abs(
+            (x[previous] - mean_x) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (mean_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        picked[i + 1] = previous
+    return x[picked], y[picked]
+
+
+def decimate(x, y, width, method=MINMAX) -> tuple:
+    if method == LTTB:
+        return lttb(x, y, 2 * width)
+    return minmax_decimate(x, y, width)
+
+
+class DecimatedLine:
+    """
+    DecimatedLine plots a long line (a waveform, a spectrum) with only the
+    points of the visible x range, decimated to the width of the axes in
+    pixels. On zoom, pan and resize only the data of the line is replaced,
+    the axes are not redrawn from scratch. `x` must be increasing.
+    """
+
+    def __init__(self, ax, x, y, method=MINMAX, **line_kwargs):
+        self.ax = ax
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.method = method
+        self.line, = ax.plot([], [], **line_kwargs)
+        ax.set_xlim(self.x[0], self.x[-1])
+        self.update()
+        self.xlim_callback = ax.callbacks.connect('xlim_changed', self.update)
+        self.resize_callback = ax.figure.canvas.mpl_connect('resize_event', self.update)
+
+    def update(self, *args) -> None:
+        x_min, x_max = self.ax.get_xlim()
+        # One point beyond both edges, so the line reaches the edges
+        start = max(int(np.searchsorted(self.x, x_min)) - 1, 0)
+        stop = min(int(np.searchsorted(self.x, x_max)) + 1, len(self.x))
+        width = max(int(self.ax.get_window_extent().width), 100)
+        self.line.set_data(*decimate(self.x[start:stop], self.y[start:stop], width, self.method))
+        self.ax.figure.canvas.draw_idle()
+
+    def remove(self) -> None:
+        """
+        Disconnects the callbacks and removes the line from the axes.
+        """
+        self.ax.callbacks.disconnect(self.xlim_callback)
+        self.ax.figure.canvas.mpl_disconnect(self.resize_callback)
+        if self.line.axes is not None:
+            self.line.remove()
+
+
+def power_spectrum_db(data, samplerate) -> tuple:
+    """
+    Returns the frequencies and the power spectrum in dB of a signal.
+    """
+    power = np.abs(np.fft.rfft(data)) ** 2
+    return np.fft.rfftfreq(len(data), d=1 / samplerate), 10 * np.log10(np.maximum(power, 1e-12))
+
+
+class SpectrumWorker(QThread):
+    """
+    Computes the power spectrum of a signal outside the Qt event loop.
+    """
+    spectrum_ready = pyqtSignal(object, object)
+
+    def __init__(self, data, samplerate, parent=None):
+        super().__init__(parent)
+        self.data = data
+        self.samplerate = samplerate
+
+    def run(self):
+        self.spectrum_ready.emit(*power_spectrum_db(self.data, self.samplerate))
+
+
+class MeasurementLoader(QThread):
+    """
+    Loads a measurement file outside the Qt event loop: first its preview
+    (see PreviewBuilder), which is shown at once, then its samples scaled to
+    [-1, 1] for the full resolution plot.
+    """
+    preview_ready = pyqtSignal(str, dict)
+    samples_ready = pyqtSignal(str, object, int)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        self.path = path
+
+    def run(self):
+        try:
+            self.preview_ready.emit(self.path, PreviewBuilder.load_or_build(self.path))
+            import soundfile as sf
+            data, samplerate = sf.read(self.path, dtype='float32')
+            if data.ndim > 1:
+                data = data[:, 0]
+            self.samples_ready.emit(self.path, data, int(samplerate))
+        except Exception as e:
+            self.failed.emit(self.path, str(e))
@@ -3,6 +3,7 @@ import os
 import sys
 import time
 import traceback
+import uuid
 
 
 LOCAL_FILE_PATH = r"Interface-guis\handheld_interface\complex_interrupt.py"
@@ -105,13 +106,50 @@ class ComplexInterrupt:
 
         return runs
     
-    def build_run(self, measurements : dict):
+    def get_sweep(self, measurement_type, measurement_config) -> dict:
+        """
+        Get a compact sweep descriptor, expanded into its runs by the measure
+        service one run at a time (see sweeps.py in measure-plensor).
+        """
+        sweep_id = f"{measurement_type}#{self.measuring_device_id}_{time.strftime('%Y-%m-%dT%H%M%S')}"
+        return {
+            "sensor_id": self.measuring_device_id,
+            "measurement_settings": {
+                "type": "sweep",
+                "sweep_type": measurement_type,
+                "sweep_id": sweep_id,
+                "sweep_configuration": measurement_config
+            }
+        }
+
+    def get_cancel_sweep(self, sweep_id = None) -> dict:
+        """
+        Get the message that cancels a sweep, or all sweeps without a sweep id.
+        """
+        return {"sensor_id": self.measuring_device_id, "measurement_settings": {"type": "cancel_sweep", "sweep_id": sweep_id}}
+
+    def build_run(self, measurements : dict, compact = True, ordered = False):
+        """
+        Build the interrupt messages of the measurements: a sweep descriptor
+        per measurement, or with `compact` False every run as a message.
+        With `ordered`, the measure service measures them in this order
+        instead of grouping them by damping level and command. Every message
+        gets a `run_id` to wait on (see RunManifest in process-data).
+        """
         self.runs = []
 
         for measurement in measurements["sensor_measurements"]:
             measurement_type = measurement["measurement_type"] 
             measurement_config = measurement["measurement_configuation"]
-            self.runs.extend(self.get_runs(measurement_type = measurement_type, measurement_config = measurement_config))
+            if compact:
+                self.runs.append(self.get_sweep(measurement_type = measurement_type, measurement_config = measurement_config))
+            else:
+                self.runs.extend(self.get_runs(measurement_type = measurement_type, measurement_config = measurement_config))
+
+        for run in self.runs:
+            run["run_id"] = uuid.uuid4().hex
+            if ordered:
+                run["measurement_settings"]["ordered"] = True
 
             # if measurement_type == "POINT_SWEEP":
             #     self.runs.extend(self.get_single_frequency_runs(start_freq = measurement_config["start_frequency"], stop_freq = measurement_config["stop_frequency"], step_freq = measurement_config["step_frequency"], repetitions = measurement_config["repetitions"], number_of_wavelengths = measurement_config["number_of_wavelengths"], damping_level = measurement_config["damping_level"], command = measurement_config["command"]))
@@ -0,0 +1,57 @@
+import os
+import sys
+
+from PyQt6.QtCore import QThread, pyqtSignal
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'process-data', 'artifact'))
+from DataLayout import in_tree
+from MeasurementEvents import MEASUREMENT_COMPLETED, PLAN_PROGRESS, EventSubscriber
+
+
+class MeasurementEventListener(QThread):
+    """
+    Receives the events of the measure service in a background thread and
+    emits them to the Qt event loop, so windows can react to a completed
+    measurement without polling the file system.
+
+    Start the listener before triggering the measurement: it only receives
+    events published after it was created.
+    """
+    event_received = pyqtSignal(dict)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.subscriber = EventSubscriber()
+
+    def run(self):
+        while not self.isInterruptionRequested():
+            event = self.subscriber.receive(timeout=0.2)
+            if event is not None:
+                self.event_received.emit(event)
+        self.subscriber.close()
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+
+def is_completed_flac(event, folder, sensor_id=None) -> bool:
+    """
+    Checks whether an event announces a new FLAC file in (a shard of)
+    `folder`, optionally of one sensor.
+    """
+    return (
+        event.get("type") == MEASUREMENT_COMPLETED
+        and event.get("path", "").lower().endswith(".flac")
+        and in_tree(event["path"], folder)
+        and (sensor_id is None or event.get("sensor_id") == sensor_id))
+
+
+def is_plan_progress(event, plan_name=None) -> bool:
+    """
+    Checks whether an event reports the progress of a measurement plan run
+    of the measure service, optionally of one plan.
+    """
+    return (
+        event.get("type") == PLAN_PROGRESS
+        and (plan_name is None or event.get("plan_name") == plan_name))
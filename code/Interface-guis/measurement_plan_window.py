@@ -10,6 +10,7 @@ from PyQt6.QtCore import Qt
 # Import load_settings and save_settings from your settings module,
 # and the SettingsWindow for editing an individual plan.
 from settings_window import load_settings, save_settings, SettingsWindow
+from continuous_measurement_functions import predict_plan_duration
 
 class MeasurementPlanWindow(QWidget):
     def __init__(self):
@@ -28,10 +29,10 @@ class MeasurementPlanWindow(QWidget):
         title_label.setStyleSheet("font-size: 24px; font-weight: bold;")
         layout.addWidget(title_label)
         
-        # Table widget with 5 columns:
-        # Plan Name, Sensors, Sequence, Damping Level, Output Path
-        self.table = QTableWidget(0, 5)
-        self.table.setHorizontalHeaderLabels(["Plan Name", "Sensors", "Sequence", "Damping Level", "Output Path"])
+        # Table widget with 6 columns:
+        # Plan Name, Sensors, Sequence, Damping Level, Output Path, Duration
+        self.table = QTableWidget(0, 6)
+        self.table.setHorizontalHeaderLabels(["Plan Name", "Sensors", "Sequence", "Damping Level", "Output Path", "Duration / Interval"])
         self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
         layout.addWidget(self.table)
         
@@ -91,6 +92,17 @@ class MeasurementPlanWindow(QWidget):
             # Output Path
             out_path = plan.get("output_path", "")
             self.table.setItem(row, 4, QTableWidgetItem(out_path))
+            # Predicted duration (cost model) against the interval
+            interval = plan.get("interval", 300)
+            try:
+                duration = predict_plan_duration(plan)
+                duration_item = QTableWidgetItem(f"{duration:.1f}s / {interval}s")
+                if duration > interval:
+                    duration_item.setForeground(Qt.GlobalColor.red)
+            except (ValueError, TypeError) as e:
+                duration_item = QTableWidgetItem(f"? / {interval}s")
+                print(f"Could not predict the duration of plan {plan.get('plan_name')}: {e}")
+            self.table.setItem(row, 5, duration_item)
         self.table.resizeColumnsToContents()
 
     def add_plan(self):
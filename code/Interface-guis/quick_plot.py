@@ -1,9 +1,11 @@
 import matplotlib.pyplot as plt
-import numpy as np
 import json
 import os
-import soundfile as sf
+import sys
 import logging
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'process-data', 'artifact'))
+from MeasurementCatalog import MeasurementCatalog
+from PreviewBuilder import PreviewBuilder
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,24 +27,24 @@ def plot_audio_files(latest_n: int = 3):
 
     files: list[str] = []  # 1 node, 2 channels/microphones
     # for mic in microphone_names:
-    m_files = [f for f in os.listdir(local_storage_path) if f.endswith(f".flac")]
-    files = m_files[-latest_n:]
+    # The newest measurements from the catalog, oldest first
+    latest = MeasurementCatalog.get_instance().latest(latest_n, root=local_storage_path)
+    files = [m["path"] for m in reversed(latest) if m["name"].endswith(".flac")]
 
     # plot the files
     # for mic_idx, mic in enumerate(microphone_names):
-    for file in files:
-        plotname = file.split(".")[0]+f"_plot"
+    for file_path in files:
+        plotname = os.path.basename(file_path).split(".")[0]+f"_plot"
         plot_file_path = os.path.join(plot_path, f"{plotname}.png")
         if not os.path.exists(plot_file_path):
-            file_path = os.path.join(local_storage_path, file)
             logger.info(f"Plotting {file_path} to {plot_file_path}")
             plot_file(file_path, plot_file_path, plotname=plotname)
 
 
 def plot_file(file_path: str, plot_file_path: str, plotname: str | None = None):
-    data, samplerate = sf.read(file_path)
-    time = np.arange(len(data)) / samplerate
-    plt.plot(time, data)
+    # Plot the min/max envelope from the preview sidecar instead of every sample
+    preview = PreviewBuilder.load_or_build(file_path)
+    plt.fill_between(preview["envelope_time"], preview["envelope_min"], preview["envelope_max"], linewidth=0.5)
     if plotname:
         plt.title(plotname)
     plt.xlabel("Time [s]")
@@ -1,22 +1,39 @@
 import sys
 import os
 import json
-import time
 import shutil
+import time
 import numpy as np
-import soundfile as sf
 import matplotlib.pyplot as plt
 
 from PyQt6.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QComboBox, QApplication, QMessageBox
 )
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QTimer
 from settings_window import SettingsWindow, load_settings
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qtagg import NavigationToolbar2QT as NavigationToolbar
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'process-data', 'artifact'))
+from MeasurementCatalog import MeasurementCatalog
+from RunManifest import DONE, RunManifest, new_run_id
+from measurement_event_listener import MeasurementEventListener, is_completed_flac
+from decimated_plot import LTTB, DecimatedLine, MeasurementLoader, SpectrumWorker
+
+TIME_DOMAIN_FOLDER = "/home/plense/plensor_data/audio_data/time_domain_not_processed"
+MEASUREMENT_TIMEOUT_MS = 20000
 
 class SingleMeasurementInspection(QWidget):
     def __init__(self):
         super().__init__()
+        self.event_listener = None
+        self.wait_timer = None
+        self.waiting_run_ids = set()
+        # The measurement is loaded and its spectrum computed in threads
+        self.loader = None
+        self.spectrum_worker = None
+        self.shown_path = None
+        self.time_line = None
+        self.spectrum_line = None
         self.init_ui()
 
     def init_ui(self):
@@ -66,6 +83,8 @@ class SingleMeasurementInspection(QWidget):
         self.ax_time.grid(True)
         self.ax_power.grid(True)
         self.time_power_canvas = FigureCanvas(self.fig)
+        # Zoom and pan redraw the visible range at full resolution
+        main_layout.addWidget(NavigationToolbar(self.time_power_canvas, self))
         main_layout.addWidget(self.time_power_canvas)
 
         self.setLayout(main_layout)
@@ -79,7 +98,7 @@ class SingleMeasurementInspection(QWidget):
         Build the measurement interrupt (excluding any DAMPING command),
         and for BLOCK and SINE commands add a "damping_level" field.
         Then write the interrupt file (always named message_interrupt.json)
-        and scan for a new FLAC file.
+        and wait for the "measurement completed" event of one of its runs.
         """
         config = load_settings()
         selected_sensor = self.sensor_dropdown.currentText()
@@ -112,8 +131,17 @@ class SingleMeasurementInspection(QWidget):
                 if "damping" in settings:
                     settings["command"] = settings.pop("damping")
                 msg["measurement_settings"].update(settings)
+                msg["run_id"] = new_run_id()
                 interrupt.append(msg)
         
+        # Subscribe before the measurement is triggered, so the event of the
+        # new file cannot be missed.
+        self.stop_waiting()
+        self.waiting_run_ids = {msg["run_id"] for msg in interrupt}
+        self.event_listener = MeasurementEventListener(self)
+        self.event_listener.event_received.connect(self.on_measurement_event)
+        self.event_listener.start()
+
         # Write the interrupt file (always named message_interrupt.json).
         metadata_dir = "/home/plense/metadata"
         if not os.path.exists(metadata_dir):
@@ -129,22 +157,55 @@ class SingleMeasurementInspection(QWidget):
         self.damping_level_label.setText(f"Damping Level: {damping_value}")
         self.measurement_sequence_label.setText(f"Measurement Sequence: {', '.join(measurement_sequence)}")
 
-        # Scan for new .flac file.
-        time_domain_folder = "/home/plense/plensor_data/audio_data/time_domain_not_processed"
-        existing_files = set(os.listdir(time_domain_folder))
+        # Wait for the new .flac file without blocking the event loop.
+        self.measure_button.setEnabled(False)
+        self.wait_timer = QTimer(self)
+        self.wait_timer.setSingleShot(True)
+        self.wait_timer.timeout.connect(self.measurement_timeout)
+        self.wait_timer.start(MEASUREMENT_TIMEOUT_MS)
+        print(f"Waiting for new .flac file in {TIME_DOMAIN_FOLDER}...")
+
+    def on_measurement_event(self, event):
+        if is_completed_flac(event, TIME_DOMAIN_FOLDER) and event.get("run_id") in self.waiting_run_ids:
+            self.stop_waiting()
+            self.show_measurement(event["path"])
+
+    def measurement_timeout(self):
+        """
+        No event arrived in time. Fall back to the run manifest, in case the
+        measure service runs without the event publisher.
+        """
+        self.stop_waiting()
         new_flac_file = None
-        t0 = time.time()
-        while time.time() - t0 < 20:
-            current_files = set(os.listdir(time_domain_folder))
-            for file in current_files - existing_files:
-                if file.lower().endswith(".flac"):
-                    new_flac_file = os.path.join(time_domain_folder, file)
-                    break
-            if new_flac_file:
+        for run in RunManifest.get_instance().get_many(self.waiting_run_ids).values():
+            if run["status"] == DONE and (run["path"] or "").lower().endswith(".flac"):
+                new_flac_file = run["path"]
                 break
-            time.sleep(0.5)
-            print(f"Waiting for new .flac file in {time_domain_folder}...")
-        
+        self.show_measurement(new_flac_file)
+
+    def stop_waiting(self):
+        if self.wait_timer is not None:
+            self.wait_timer.stop()
+            self.wait_timer = None
+        if self.event_listener is not None:
+            self.event_listener.stop()
+            self.event_listener = None
+        self.measure_button.setEnabled(True)
+
+    def closeEvent(self, event):
+        self.stop_waiting()
+        for worker in (self.loader, self.spectrum_worker):
+            if worker is not None:
+                worker.wait()
+        super().closeEvent(event)
+
+    def show_measurement(self, new_flac_file):
+        """
+        Moves the new .flac file to the output folder of the settings and
+        loads it in a thread: its preview is plotted first, then its samples
+        at full resolution.
+        """
+        config = load_settings()
         if new_flac_file:
             print(f"Found new .flac file: {new_flac_file}")
             output_folder = config.get("metadata", {}).get("output_path", "")
@@ -154,43 +215,111 @@ class SingleMeasurementInspection(QWidget):
                 os.makedirs(output_folder)
             destination = os.path.join(output_folder, os.path.basename(new_flac_file))
             shutil.move(new_flac_file, destination)
-            try:
-                data, samplerate = sf.read(destination)
-                self.plot_data(data, samplerate)
-                max_abs = np.max(np.abs(data))
-                self.max_abs_label.setText(f"Max Absolute: {max_abs}")
-                self.output_path_label.setText(f"Output Path: {destination}")
-            except Exception as e:
-                QMessageBox.warning(self, "Error", f"Failed to load FLAC file: {e}")
+            MeasurementCatalog.get_instance().move(new_flac_file, destination)
+            self.shown_path = destination
+            self.output_path_label.setText(f"Output Path: {destination}")
+            self.loader = MeasurementLoader(destination, self)
+            self.loader.preview_ready.connect(self.on_preview)
+            self.loader.samples_ready.connect(self.on_samples)
+            self.loader.failed.connect(self.on_load_failed)
+            self.loader.start()
         else:
             QMessageBox.warning(self, "File Not Found", "No new .flac file detected.")
             self.clear_data()
 
-    def plot_data(self, data, samplerate):
+    def on_preview(self, path, preview):
+        # Results of a measurement that is no longer shown are dropped
+        if path != self.shown_path:
+            return
+        self.plot_preview(preview)
+        self.max_abs_label.setText(f"Max Absolute: {preview['max_abs']}")
+
+    def on_samples(self, path, data, samplerate):
+        if path == self.shown_path:
+            self.plot_data(data, samplerate)
+
+    def on_load_failed(self, path, error):
+        if path == self.shown_path:
+            QMessageBox.warning(self, "Error", f"Failed to load FLAC file: {error}")
+
+    def remove_lines(self):
+        for line in (self.time_line, self.spectrum_line):
+            if line is not None:
+                line.remove()
+        self.time_line = None
+        self.spectrum_line = None
+
+    def plot_preview(self, preview):
+        """
+        Plots the preview products of a measurement: the min/max waveform
+        envelope and the log-binned power spectrum.
+        """
+        self.remove_lines()
         self.fig.clf()
         self.ax_time = self.fig.add_subplot(211)
         self.ax_power = self.fig.add_subplot(212)
-        t = np.linspace(0, len(data) / samplerate, num=len(data))
-        self.ax_time.plot(t, data, color='blue')
+        self.ax_time.fill_between(
+            preview["envelope_time"], preview["envelope_min"], preview["envelope_max"],
+            color='blue', linewidth=0.5)
         self.ax_time.set_title("Time Domain")
         self.ax_time.set_xlabel("Time (s)")
         self.ax_time.set_ylabel("Amplitude")
         self.ax_time.set_ylim(-1, 1)
         self.ax_time.grid(True)
-        fft_data = np.fft.rfft(data)
-        freqs = np.fft.rfftfreq(len(data), d=1/samplerate)
-        power = np.abs(fft_data) ** 2
-        epsilon = 1e-12
-        power_db = 10 * np.log10(np.maximum(power, epsilon))
-        self.ax_power.plot(freqs, power_db, color='red')
-        self.ax_power.set_title("Power Spectrum (dB)")
+        self.ax_power.semilogx(preview["psd_frequency"], preview["psd_db"], color='red')
+        self.ax_power.set_title("Power Spectral Density (dB)")
         self.ax_power.set_xlabel("Frequency (Hz)")
         self.ax_power.set_ylabel("Power (dB)")
         self.ax_power.grid(True)
         self.fig.tight_layout(pad=3)
         self.time_power_canvas.draw()
 
+    def plot_data(self, data, samplerate):
+        """
+        Plots the waveform of a measurement, min/max-decimated to the width
+        of the axes, and computes its power spectrum in a thread. The
+        spectrum of the preview stays until the full spectrum is computed.
+        """
+        plot_started = time.perf_counter()
+        if self.time_line is not None:
+            self.time_line.remove()
+        self.ax_time.clear()
+        t = np.arange(len(data)) / samplerate
+        self.time_line = DecimatedLine(self.ax_time, t, data, color='blue', linewidth=0.5)
+        self.ax_time.set_title("Time Domain")
+        self.ax_time.set_xlabel("Time (s)")
+        self.ax_time.set_ylabel("Amplitude")
+        self.ax_time.set_ylim(-1, 1)
+        self.ax_time.grid(True)
+        self.time_power_canvas.draw()
+        print(f"Plotted {len(data)} samples in {1000 * (time.perf_counter() - plot_started):.0f} ms")
+
+        path = self.shown_path
+        self.spectrum_worker = SpectrumWorker(data, samplerate, self)
+        self.spectrum_worker.spectrum_ready.connect(
+            lambda freqs, power_db: self.plot_spectrum(path, freqs, power_db))
+        self.spectrum_worker.start()
+
+    def plot_spectrum(self, path, freqs, power_db):
+        """
+        Plots the full power spectrum, LTTB-decimated to the width of the
+        axes.
+        """
+        if path != self.shown_path:
+            return
+        if self.spectrum_line is not None:
+            self.spectrum_line.remove()
+        self.ax_power.clear()
+        self.spectrum_line = DecimatedLine(self.ax_power, freqs, power_db, method=LTTB, color='red', linewidth=0.5)
+        self.ax_power.set_ylim(power_db.min(), power_db.max() + 3)
+        self.ax_power.set_title("Power Spectrum (dB)")
+        self.ax_power.set_xlabel("Frequency (Hz)")
+        self.ax_power.set_ylabel("Power (dB)")
+        self.ax_power.grid(True)
+        self.time_power_canvas.draw_idle()
+
     def clear_data(self):
+        self.remove_lines()
         self.fig.clf()
         self.ax_time = self.fig.add_subplot(211)
         self.ax_power = self.fig.add_subplot(212)
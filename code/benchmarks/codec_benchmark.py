@@ -0,0 +1,129 @@
+"""
+Storage codec benchmark.
+
+Encodes and decodes a set of measurements with every storage codec
+configuration (see storage_codec.py in the measure service) and reports the
+encode and decode throughput in MB/s of int16 samples, the compression ratio
+against raw int16, and the throughput of the parallel writer pool. Use it to
+pick the `storage_codec` app setting per deployment.
+
+Usage:
+    python codec_benchmark.py                                   # raw measurement dir
+    python codec_benchmark.py /path/to/*.flac --workers 4
+    python codec_benchmark.py --synthetic 20                    # without measurements
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'measure-plensor', 'artifact'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'process-data', 'artifact'))
+from storage_codec import StorageCodec, StorageWriter
+from DataLayout import RAW_DIR, list_measurement_files
+
+CODECS = [
+    ('flac PCM_16 level 0.0', dict(format='flac', subtype='PCM_16', compression_level=0.0)),
+    ('flac PCM_16 level 0.5', dict(format='flac', subtype='PCM_16', compression_level=0.5)),
+    ('flac PCM_16 level 1.0', dict(format='flac', subtype='PCM_16', compression_level=1.0)),
+    ('flac PCM_24 level 0.5', dict(format='flac', subtype='PCM_24', compression_level=0.5)),
+    ('wav PCM_16', dict(format='wav', subtype='PCM_16')),
+    ('npy int16', dict(format='npy')),
+]
+
+
+class PrintLogger:
+    def log_error(self, message):
+        print(message)
+
+
+def load_signals(paths, limit):
+    signals = []
+    for path in paths[:limit]:
+        signal, sample_rate = StorageCodec.decode(path, dtype='int16')
+        signals.append((os.path.basename(path), signal, sample_rate))
+    return signals
+
+
+def synthetic_signals(count, seed=0):
+    """
+    BLOCK-like test signals: 10 repetitions of a decaying 20-100 kHz chirp
+    with noise, at 500 kHz.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(25000) / 500000
+    signals = []
+    for i in range(count):
+        phase = 2 * np.pi * (20000 * t + 0.5 * 80000 / t[-1] * t ** 2)
+        repetition = 8000 * np.exp(-t / 0.01) * np.sin(phase)
+        signal = np.tile(repetition, 10) + rng.normal(0, 100, 250000)
+        signals.append((f"synthetic_{i}", np.clip(signal, -32768, 32767).astype(np.int16), 500000))
+    return signals
+
+
+def benchmark_codec(codec, signals, directory):
+    raw_bytes = sum(signal.nbytes for _, signal, _ in signals)
+    start = time.perf_counter()
+    paths = [codec.encode(os.path.join(directory, name), signal, sample_rate)
+             for name, signal, sample_rate in signals]
+    encode_s = time.perf_counter() - start
+    stored_bytes = sum(os.path.getsize(path) for path in paths)
+
+    start = time.perf_counter()
+    for path in paths:
+        StorageCodec.decode(path, dtype='int16')
+    decode_s = time.perf_counter() - start
+    return {
+        "encode_mb_s": raw_bytes / encode_s / 1e6,
+        "decode_mb_s": raw_bytes / decode_s / 1e6,
+        "ratio": raw_bytes / stored_bytes,
+    }
+
+
+def benchmark_writer(settings, signals, directory, workers):
+    raw_bytes = sum(signal.nbytes for _, signal, _ in signals)
+    writer = StorageWriter(PrintLogger(), StorageCodec(**settings), workers=workers)
+    start = time.perf_counter()
+    for name, signal, sample_rate in signals:
+        writer.submit(os.path.join(directory, name), signal, sample_rate)
+    writer.close()
+    return raw_bytes / (time.perf_counter() - start) / 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Storage codec benchmark")
+    parser.add_argument('files', nargs='*', help="measurement files (default: the raw measurement dir)")
+    parser.add_argument('--limit', type=int, default=50, help="maximum number of files")
+    parser.add_argument('--synthetic', type=int, default=0, help="use this many synthetic signals")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help="writer pool size")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        signals = synthetic_signals(args.synthetic)
+    else:
+        files = args.files or list_measurement_files(RAW_DIR, suffixes=('.flac',))
+        if not files:
+            sys.exit("No measurement files found, pass files or use --synthetic")
+        signals = load_signals(files, args.limit)
+    total_mb = sum(signal.nbytes for _, signal, _ in signals) / 1e6
+    print(f"{len(signals)} signals, {total_mb:.1f} MB as int16\n")
+
+    tmp_dir = tempfile.mkdtemp(prefix='codec_benchmark_')
+    try:
+        print(f"{'codec':<24}{'encode MB/s':>13}{'decode MB/s':>13}{'ratio':>8}"
+              f"{'pool x' + str(args.workers) + ' MB/s':>16}")
+        for name, settings in CODECS:
+            directory = os.path.join(tmp_dir, name.replace(' ', '_'))
+            os.makedirs(directory)
+            result = benchmark_codec(StorageCodec(**settings), signals, directory)
+            shutil.rmtree(directory)
+            os.makedirs(directory)
+            pool_mb_s = benchmark_writer(settings, signals, directory, args.workers)
+            print(f"{name:<24}{result['encode_mb_s']:>13.1f}{result['decode_mb_s']:>13.1f}"
+                  f"{result['ratio']:>8.2f}{pool_mb_s:>16.1f}")
+    finally:
+        shutil.rmtree(tmp_dir)
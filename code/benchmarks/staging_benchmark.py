@@ -0,0 +1,104 @@
+"""
+Staging tier write amplification benchmark.
+
+Writes the output of a number of measurement cycles (measurement files,
+small JSON files and log lines) to a directory on persistent storage, once
+directly as the services do without staging and once through the RAM
+staging tier (see StagingTier.py in process-data). For both runs it reports
+the write requests and bytes that reached the block device, read from
+/proc/diskstats, and the write amplification: device bytes per payload
+byte. Run it on an otherwise idle Pi, the device counters include the
+writes of all processes.
+
+Usage:
+    python staging_benchmark.py                                 # in /home/plense
+    python staging_benchmark.py /path/on/sd --cycles 20 --files 12
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'process-data', 'artifact'))
+from StagingTier import StagingTier, disk_write_counters
+
+
+def cycle_output(cycle, files, file_kb):
+    """
+    The output of one measurement cycle: a measurement file and a metadata
+    JSON file per sensor command, and a log line per file.
+    """
+    for i in range(files):
+        name = f"BLOCK#{cycle:04d}_{i:02d}"
+        yield f"{name}.flac", os.urandom(file_kb * 1024)
+        yield f"{name}.json", json.dumps({"cycle": cycle, "index": i, "created_at": time.time()}, indent=2)
+
+
+def write_direct(directory, args, logger):
+    for cycle in range(args.cycles):
+        for name, data in cycle_output(cycle, args.files, args.file_kb):
+            path = os.path.join(directory, name)
+            with open(path, 'w' if isinstance(data, str) else 'wb') as f:
+                f.write(data)
+            logger.error(f"Saved {path}")
+        time.sleep(args.interval)
+
+
+def write_staged(directory, args, logger):
+    tier = StagingTier('staging-benchmark', max_loss_s=args.max_loss_s, persistent_path=directory)
+    tier.buffer_log(logger)
+    try:
+        for cycle in range(args.cycles):
+            for name, data in cycle_output(cycle, args.files, args.file_kb):
+                path = tier.write(os.path.join(directory, name), data)
+                logger.error(f"Saved {path}")
+            time.sleep(args.interval)
+    finally:
+        tier.close()
+
+
+def run(label, write, directory, args):
+    os.makedirs(directory)
+    logger = logging.getLogger(label)
+    logger.propagate = False
+    log_handler = logging.FileHandler(os.path.join(directory, 'benchmark.log'))
+    logger.addHandler(log_handler)
+    os.sync()
+    requests_start, written_start = disk_write_counters(directory)
+    start = time.perf_counter()
+    write(directory, args, logger)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    log_handler.close()
+    os.sync()
+    elapsed = time.perf_counter() - start
+    requests, written = disk_write_counters(directory)
+    payload = sum(entry.stat().st_size for entry in os.scandir(directory))
+    requests, written = requests - requests_start, written - written_start
+    print(f"{label:<10}{elapsed:>10.1f}{requests:>12}{written / 1e6:>14.2f}{payload / 1e6:>14.2f}"
+          f"{written / payload if payload else 0:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Staging tier write amplification benchmark")
+    parser.add_argument('directory', nargs='?', default='/home/plense', help="directory on persistent storage")
+    parser.add_argument('--cycles', type=int, default=10, help="number of measurement cycles")
+    parser.add_argument('--files', type=int, default=10, help="measurement files per cycle")
+    parser.add_argument('--file-kb', type=int, default=200, help="size of a measurement file in kB")
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between cycles")
+    parser.add_argument('--max-loss-s', type=float, default=5.0, help="max_loss_s of the staging tier")
+    args = parser.parse_args()
+
+    if disk_write_counters(args.directory) == (0, 0):
+        sys.exit(f"No block device statistics for {args.directory}")
+    tmp_dir = tempfile.mkdtemp(prefix='staging_benchmark_', dir=args.directory)
+    try:
+        print(f"{'run':<10}{'time s':>10}{'requests':>12}{'device MB':>14}{'payload MB':>14}{'amplif.':>12}")
+        run('direct', write_direct, os.path.join(tmp_dir, 'direct'), args)
+        run('staged', write_staged, os.path.join(tmp_dir, 'staged'), args)
+    finally:
+        shutil.rmtree(tmp_dir)
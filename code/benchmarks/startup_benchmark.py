@@ -0,0 +1,178 @@
+"""
+Startup benchmark of the edge services.
+
+Measures, per service, the cold import time of its modules (median over a
+number of fresh interpreters, with the slowest dependencies from
+`python -X importtime`), and reads the startup milestones the services record
+themselves (time to first bus command, time to first file processed, see
+StartupTiming.py in process-data). Results can be saved as a baseline,
+and a later run compared against it exits with status 1 on a regression.
+
+Usage:
+    python startup_benchmark.py                          # print results
+    python startup_benchmark.py --save-baseline base.json
+    python startup_benchmark.py --baseline base.json     # flag regressions
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+STARTUP_TIMING_DIR = '/home/plense/error_logs/startup_timing'
+
+# Modules imported at start of each service, relative to its directory
+SERVICE_MODULES = {
+    'measure-plensor': ('measure-plensor/artifact', ['message_handler', 'queue_manager', 'sensor', 'app']),
+    'process-data': ('process-data/artifact', ['xedge_plense_tools', 'PreProcessor', 'FeatureTable', 'app']),
+    'interface-guis': ('Interface-guis', ['app', 'single_measurement_window', 'quick_plot']),
+    'log-manager': ('log-manager/artifact', ['app']),
+}
+
+
+def parse_importtime(stderr) -> dict:
+    """
+    Parses the output of `python -X importtime` into
+    {module: cumulative seconds}.
+    """
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+            cumulative[name.strip()] = int(cumulative_us) / 1e6
+        except ValueError:
+            continue
+    return cumulative
+
+
+def measure_import(service_dir, module, repeats=5, top=5) -> dict:
+    """
+    Imports a module in `repeats` fresh interpreters and returns the median
+    import time and its slowest top-level dependencies.
+    """
+    cwd = os.path.join(CODE_DIR, service_dir)
+    env = dict(os.environ, PYTHONPATH=cwd, QT_QPA_PLATFORM='offscreen', MPLBACKEND='Agg')
+    times, dependencies = [], {}
+    for _ in range(repeats):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=cwd, env=env, capture_output=True, text=True, timeout=300)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'unknown error'
+            return {"error": error}
+        cumulative = parse_importtime(result.stderr)
+        times.append(cumulative.get(module, 0.0))
+        for name, seconds in cumulative.items():
+            if '.' not in name and name != module:
+                dependencies.setdefault(name, []).append(seconds)
+    slowest = sorted(((statistics.median(v), k) for k, v in dependencies.items()), reverse=True)[:top]
+    return {
+        "import_s": statistics.median(times),
+        "slowest_dependencies": {name: round(seconds, 4) for seconds, name in slowest},
+    }
+
+
+def read_milestones(directory=STARTUP_TIMING_DIR) -> dict:
+    """
+    Reads the startup milestones recorded by the services.
+    """
+    milestones = {}
+    if not os.path.isdir(directory):
+        return milestones
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.json'):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    timing = json.load(f)
+                milestones[timing.get("service", filename[:-5])] = timing.get("milestones", {})
+            except (OSError, ValueError) as e:
+                print(f"Could not read {filename}: {e}")
+    return milestones
+
+
+def run_benchmark(repeats=5, services=None) -> dict:
+    results = {"imports": {}, "milestones": read_milestones()}
+    for service, (service_dir, modules) in SERVICE_MODULES.items():
+        if services and service not in services:
+            continue
+        for module in modules:
+            measurement = measure_import(service_dir, module, repeats=repeats)
+            results["imports"][f"{service}:{module}"] = measurement
+    return results
+
+
+def compare(results, baseline, tolerance=0.2, min_delta=0.05) -> list:
+    """
+    Compares results to a baseline. A timing is a regression if it is more
+    than `tolerance` (relative) and `min_delta` seconds slower.
+
+    Returns:
+        list: Descriptions of the regressions.
+    """
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for key, seconds in current.items():
+        reference = previous.get(key)
+        if reference is not None and seconds > reference * (1 + tolerance) and seconds - reference > min_delta:
+            regressions.append(f"{key}: {reference:.3f}s -> {seconds:.3f}s")
+    return regressions
+
+
+def flatten(results) -> dict:
+    flat = {}
+    for key, measurement in results.get("imports", {}).items():
+        if "import_s" in measurement:
+            flat[f"import {key}"] = measurement["import_s"]
+    for service, milestones in results.get("milestones", {}).items():
+        for milestone, seconds in milestones.items():
+            flat[f"{service}:{milestone}"] = seconds
+    return flat
+
+
+def print_results(results):
+    print(f"{'module':<45}{'import (s)':>12}  slowest dependencies")
+    for key, measurement in results["imports"].items():
+        if "error" in measurement:
+            print(f"{key:<45}{'failed':>12}  {measurement['error']}")
+            continue
+        dependencies = ", ".join(f"{k} {v:.3f}" for k, v in measurement["slowest_dependencies"].items())
+        print(f"{key:<45}{measurement['import_s']:>12.3f}  {dependencies}")
+    print()
+    if not results["milestones"]:
+        print(f"No startup milestones recorded in {STARTUP_TIMING_DIR}")
+    for service, milestones in results["milestones"].items():
+        for milestone, seconds in milestones.items():
+            print(f"{service + ':' + milestone:<45}{seconds:>12.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup benchmark of the edge services")
+    parser.add_argument('--repeats', type=int, default=5, help="fresh interpreters per module")
+    parser.add_argument('--service', action='append', help="only benchmark this service (repeatable)")
+    parser.add_argument('--save-baseline', help="save the results to this file")
+    parser.add_argument('--baseline', help="compare the results to this baseline file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    results = run_benchmark(repeats=args.repeats, services=args.service)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        if regressions:
+            print("\nStartup regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo startup regressions.")
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'process-data', 'artifact'))
+
+
+class AcquisitionProcessor:
+    """
+    AcquisitionProcessor produces the processed output of BLOCK/SINE
+    measurements in the measure service itself: the repetitions are averaged
+    (see SpectralAverager) on a worker thread while the next repetition is
+    measured, so the processed output is ready when the last repetition
+    arrives instead of after process-data has loaded the stored file.
+
+    The output goes through the Preprocessor of process-data (processed
+    file, feature vector, preview, catalog) and the raw file is recorded as
+    done in the processing manifest, so process-data does not process it
+    again. Storing the raw file is optional with `persist_raw`; without it,
+    the raw file is only stored when the processing fails.
+    """
+
+    def __init__(self, logger, preprocessor, persist_raw=True):
+        self.logger = logger
+        self.preprocessor = preprocessor
+        self.persist_raw = persist_raw
+        # One worker, so the repetitions of a measurement are folded in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='averaging')
+
+    @classmethod
+    def from_settings(cls, settings, logger, catalog=None, staging=None):
+        """
+        Creates the processor from the `on_acquisition` entry of the app
+        settings, or returns None if it is not enabled.
+        """
+        if not settings or not settings.get("enabled", False):
+            return None
+        # Imported here, the service only loads the processing stack when
+        # it is enabled
+        from FeatureTable import FeatureTable
+        from PreProcessor import Preprocessor
+        from PreviewBuilder import DEFAULT_PREVIEW_DIR
+        from ProcessingManifest import ProcessingManifest
+        preprocessor = Preprocessor(
+            manifest=ProcessingManifest.get_instance(),
+            remove_raw=False,
+            feature_table=FeatureTable.get_instance(),
+            preview_dir=DEFAULT_PREVIEW_DIR,
+            catalog=catalog,
+            staging=staging)
+        return cls(logger, preprocessor, persist_raw=settings.get("persist_raw", True))
+
+    def averager(self, repetitions):
+        """
+        Returns a SpectralAverager for a new measurement of `repetitions`
+        repetitions, folding on the worker of this processor.
+        """
+        from SpectralAverager import SpectralAverager
+        return SpectralAverager(repetitions, executor=self.executor)
+
+    def finish(self, raw_path, averager, measurement, sample_rate, on_failure=None):
+        """
+        Records the measurement in the manifest as being processed, before
+        its raw file is written, and finishes the processing on the worker
+        once the last repetition is folded. A row left processing by a crash
+        is re-queued by process-data (see ProcessingManifest.requeue_stale).
+
+        Parameters:
+            raw_path (str): Path of the raw file, the key of the measurement
+                in the manifest.
+            averager (SpectralAverager): The averager the repetitions were
+                added to.
+            measurement (list): The raw samples of all repetitions.
+            sample_rate (int): Sample rate of the samples.
+            on_failure (callable): Called without arguments if the
+                processing fails, to store the raw file that was not going
+                to be stored. process-data then processes it.
+
+        Returns:
+            Future: Resolves to (maximum amplitude, processed file path), or
+                None if the processing failed.
+        """
+        manifest = self.preprocessor.manifest
+        manifest.register_source(raw_path, 2 * len(measurement), time.time())
+        manifest.mark_started(raw_path)
+        return self.executor.submit(self._finish, raw_path, averager, measurement, sample_rate, on_failure)
+
+    def _finish(self, raw_path, averager, measurement, sample_rate, on_failure=None):
+        import numpy as np
+        try:
+            # Without an averaged result, the samples are transformed whole,
+            # with the same segments as process-data
+            result = self.preprocessor.process_samples(
+                raw_path, np.int16(measurement), sample_rate, segments=averager.segments,
+                remove_raw=False, processed=averager.result())
+        except Exception as e:
+            self.logger.log_error(f"Processing on acquisition failed for {raw_path}: {e}")
+            self.preprocessor.manifest.mark_failed(raw_path, e)
+            result = None
+        if result is None and on_failure is not None:
+            # process-data registers the raw file again once it is written
+            self.preprocessor.manifest.forget(raw_path)
+            try:
+                on_failure()
+                self.logger.log_error(f"Storing {raw_path} for process-data")
+            except Exception as e:
+                self.logger.log_error(f"Storing {raw_path} after the failed processing failed: {e}")
+        return result
+
+    def close(self) -> None:
+        """
+        Waits for the measurements that are being processed.
+        """
+        self.executor.shutdown(wait=True)
@@ -3,18 +3,35 @@ import os
 import platform
 import pytz
 import queue
+import signal
+import sys
 import time
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from acquisition_processing import AcquisitionProcessor
 from datetime import datetime, timedelta
 from error_logger import ErrorLogger
 from json_handler import JSONHandler
 from message_handler import MessageHandler
+from plan_scheduler import PLAN_SYNC_S, PlanScheduler
 from queue_manager import QueueManager
+from run_planner import plan_messages
 from sensor import Sensor
 from serial_communication_setup import SerialCommunicationSetup
-from threading import Event
-
+from storage_codec import StorageWriter
+from sweeps import Sweep
+from threading import Event, RLock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'process-data', 'artifact'))
+from MeasurementCatalog import MeasurementCatalog
+from MeasurementCostModel import MeasurementCostModel
+from MeasurementEvents import RUN_PLAN, SWEEP_PROGRESS, EventPublisher
+from MeasurementHandoff import HandoffSender
+from RunManifest import RunManifest
+from StagingTier import StagingTier
+from StartupTiming import record_milestone
+from TimeSeriesStore import TimeSeriesStore
+from TrendStore import TrendStore
 
 scs = SerialCommunicationSetup()
 
@@ -70,8 +87,25 @@ class MeasureProcessManager():
             directory='/home/plense/error_logs',
             log_level=20)
         self.logger.log_error("Measure Plensor app has started.")
+        # Pool that encodes the measurement files, configured by the app
+        # settings. Written files are added to the measurement catalog and
+        # announced to the GUIs with a "measurement completed" event.
+        self.catalog = MeasurementCatalog.get_instance(logger=self.logger)
+        self.event_publisher = EventPublisher(logger=self.logger)
+        # Status, file and timings of every measure message by run id, for
+        # the GUIs waiting on the runs they submitted
+        self.runs = RunManifest.get_instance(logger=self.logger)
+        self.storage_writer = StorageWriter(
+            self.logger, catalog=self.catalog, publisher=self.event_publisher, runs=self.runs)
         # Load app settings from JSON file
+        self.staging_settings = {}
+        self.handoff_settings = {}
+        self.on_acquisition_settings = {}
         self.load_app_settings()
+        # Optional RAM staging tier, measurement files and log lines are
+        # flushed to the SD card in batches
+        self.staging = StagingTier.from_settings(self.staging_settings, 'measure-plensor', logger=self.logger)
+        self.storage_writer.staging = self.staging
 
         # Initialize directories
         if metadata_directory is None:
@@ -108,7 +142,39 @@ class MeasureProcessManager():
 
         scs.setup_gpio()
 
-        self.mh = MessageHandler(self.logger, self.json_handler, self.sensors, self.measurement_queue, self.measurement_dir, self)
+        self.timeseries = TimeSeriesStore.get_instance(logger=self.logger)
+        self.trends = TrendStore.get_instance(logger=self.logger)
+        # Sweeps in the queue that are being expanded, by sweep id
+        self.sweeps = {}
+        # Held while messages are taken from the queue, by the measurement
+        # cycle or by a plan run measured between two cycles
+        self.queue_lock = RLock()
+        # Measurement plans registered by the GUIs, measured by the scheduler
+        self.plan_scheduler = PlanScheduler(self, os.path.join(self.metadata_directory, 'measurement_plans.json'))
+        # Optional shared-memory hand-off of fresh measurements to process-data
+        self.handoff = HandoffSender(logger=self.logger) if self.handoff_settings.get("enabled", False) else None
+        # Optional averaging of BLOCK/SINE repetitions while they arrive
+        self.acquisition_processor = AcquisitionProcessor.from_settings(
+            self.on_acquisition_settings, self.logger, catalog=self.catalog, staging=self.staging)
+        self.mh = MessageHandler(
+            self.logger, self.json_handler, self.sensors, self.measurement_queue, self.measurement_dir, self,
+            storage_writer=self.storage_writer, timeseries=self.timeseries, trends=self.trends, handoff=self.handoff,
+            persist_raw=self.handoff_settings.get("persist_raw", True),
+            acquisition_processor=self.acquisition_processor, runs=self.runs)
+        if self.staging is not None:
+            # Files a crashed process staged are flushed and cataloged,
+            # before anything new is staged
+            self.staging.recover(on_recover=self.recover_staged_file)
+        record_milestone('measure-plensor', 'ready')
+
+    def recover_staged_file(self, path):
+        """
+        Finishes a file that a previous process of the service staged and
+        did not flush: a measurement file or a file processed on acquisition.
+        """
+        self.storage_writer.recovered(path)
+        if self.acquisition_processor is not None:
+            self.acquisition_processor.preprocessor.finish_recovered_file(path)
 
     def load_app_settings(self):
         """
@@ -120,6 +186,10 @@ class MeasureProcessManager():
             if settings:
                 self.log_level = settings.get("log_level", "INFO")
                 self.measurement_interval = settings.get("measurement_interval", 300)
+                self.storage_writer.configure(settings.get("storage_codec", {}))
+                self.staging_settings = settings.get("staging", {})
+                self.handoff_settings = settings.get("handoff", {})
+                self.on_acquisition_settings = settings.get("on_acquisition", {})
                 self.logger.log_error(f"Loaded app settings: log_level={self.log_level}, measurement_interval={self.measurement_interval}")
             else:
                 self.log_level = "INFO"
@@ -176,8 +246,12 @@ class MeasureProcessManager():
                 with open(interrupt_file_path, 'r') as file:
                     interrupt_data = json.load(file)
 
-                # Process each interrupt message
-                for interrupt_message in interrupt_data:
+                interrupt_data = self.plan_batch(interrupt_data)
+                self.runs.submit(interrupt_data)
+
+                # Process each interrupt message, in reverse so they are
+                # measured in the order of the plan
+                for interrupt_message in reversed(interrupt_data):
                     self.measurement_queue.queue.appendleft(interrupt_message)
                     self.logger.log_error(f"Interrupt messages: {interrupt_message}")
 
@@ -190,6 +264,33 @@ class MeasureProcessManager():
         except Exception as e:
             self.logger.log_error(f"Error handling interrupt: {e}")
 
+    def plan_batch(self, messages) -> list:
+        """
+        Reorders a batch of messages within each sensor to group damping
+        levels and commands (see run_planner), and logs and publishes the
+        estimated cost before and after. The batch is kept as it is if it
+        cannot be planned.
+        """
+        current_damping = {
+            sensor.sensor_id: sensor.applied_damping_level
+            for sensor in self.sensors if sensor.damping_applied}
+        try:
+            planned, report = plan_messages(messages, current_damping)
+        except Exception as e:
+            self.logger.log_error(f"Error planning {len(messages)} messages, keeping their order: {e}")
+            return messages
+        before, after = report["before"], report["after"]
+        self.logger.log_error(
+            f"Planned {report['messages']} messages, {report['moved']} moved: "
+            f"{before['damping_switches']} -> {after['damping_switches']} damping switches, "
+            f"{before['command_switches']} -> {after['command_switches']} command switches, "
+            f"estimated {before['estimated_s']} -> {after['estimated_s']} s")
+        try:
+            self.event_publisher.publish(RUN_PLAN, **report)
+        except Exception as e:
+            self.logger.log_error(f"Error publishing the run plan: {e}")
+        return planned
+
     def handle_metadata_update(self):
         """
         Updates the sensor objects if the update metadata flag
@@ -271,6 +372,12 @@ class MeasureProcessManager():
         function based on the message type.
         Periodically checks for interrupt messages.
         """
+        with self.queue_lock:
+            self._process_measurement_queue()
+        # Plan runs queued while the cycle was finishing
+        self.drain_plan_messages()
+
+    def _process_measurement_queue(self) -> None:
         try:
             self.load_app_settings()
             self.last_cycle_start_time = time.time()
@@ -288,25 +395,16 @@ class MeasureProcessManager():
             while not self.measurement_queue.empty():
                 print(f"Measurement queue is not empty: {len(self.measurement_queue.queue)}")
 
-                if 'message_interrupt.json' in metadata_files:
+                # Checked before every message, so a long sweep can be
+                # interrupted or cancelled
+                if os.path.exists(os.path.join(self.metadata_directory, 'message_interrupt.json')):
                     self.handle_interrupt()
 
                 # After checking for user interrupt queue alteration,
                 # move on to the message handling
                 message = self.measurement_queue.get()
-                message_type = message["measurement_settings"].get("type")
-                sensor_id = message["sensor_id"]
-
-                if message_type == "get_byte":
-                    self.mh.handle_get_byte_msg(sensor_id, message)
-                elif message_type == "reset":
-                    self.mh.handle_reset_msg(sensor_id, message)
-                elif message_type == "calibrate":
-                    self.mh.handle_calibrate_msg(sensor_id, message)
-                elif message_type == "measure":
-                    self.mh.handle_measure_msg(sensor_id, message)
-                else:
-                    self.logger.log_error(f"Unknown message type: {message_type}")
+                if self.handle_message(message):
+                    record_milestone('measure-plensor', 'first_bus_command')
             else:
                 print("Measurement queue is emptied, initializing again")
                 self.qm.initialize_measurement_queue()
@@ -324,12 +422,148 @@ class MeasureProcessManager():
             self.logger.log_error(f"Measurement queue is empty. Waiting for new messages.")
             time.sleep(1)
 
+    def handle_message(self, message) -> bool:
+        """
+        Invokes the handler of a message taken from the queue.
+
+        Returns:
+            bool: True if a message was sent to a sensor.
+        """
+        plan_run = self.plan_scheduler.run_of(message)
+        if plan_run is not None and plan_run.expired():
+            self.logger.log_error(f"Plan run {plan_run.plan_run_id} is past its deadline, skipping a message")
+            self.runs.skip(message.get("run_id"), f"Plan run {plan_run.plan_run_id} is past its deadline")
+            self.plan_scheduler.message_done(message, skipped=True)
+            return False
+        message_type = message["measurement_settings"].get("type")
+        if message_type == "sweep":
+            message = self.expand_sweep(message)
+            if message is None:
+                return False
+            message_type = message["measurement_settings"].get("type")
+        elif message_type == "cancel_sweep":
+            self.cancel_sweep(message["measurement_settings"].get("sweep_id"))
+            return False
+        sensor_id = message["sensor_id"]
+        run_id = self.runs.start(message)
+
+        try:
+            if message_type == "get_byte":
+                self.mh.handle_get_byte_msg(sensor_id, message)
+            elif message_type == "reset":
+                self.mh.handle_reset_msg(sensor_id, message)
+            elif message_type == "calibrate":
+                self.mh.handle_calibrate_msg(sensor_id, message)
+            elif message_type == "measure":
+                self.mh.handle_measure_msg(sensor_id, message)
+            else:
+                self.logger.log_error(f"Unknown message type: {message_type}")
+                return False
+        finally:
+            self.runs.settle(run_id)
+            if plan_run is not None:
+                self.plan_scheduler.message_done(message)
+        if message.get("sweep_id") in self.sweeps:
+            sweep = self.sweeps[message["sweep_id"]]
+            sweep.run_done()
+            self.publish_sweep_progress(sweep)
+        return True
+
+    def drain_plan_messages(self):
+        """
+        Measures the plan run messages at the front of the queue right away
+        if no measurement cycle is running; a running cycle takes them
+        before its next message.
+        """
+        def plan_message_next():
+            with self.measurement_queue.mutex:
+                return bool(self.measurement_queue.queue) and "plan_run_id" in self.measurement_queue.queue[0]
+
+        while plan_message_next():
+            if not self.queue_lock.acquire(blocking=False):
+                return
+            try:
+                while True:
+                    with self.measurement_queue.mutex:
+                        if not (self.measurement_queue.queue and "plan_run_id" in self.measurement_queue.queue[0]):
+                            break
+                        message = self.measurement_queue.queue.popleft()
+                    self.handle_message(message)
+            finally:
+                self.queue_lock.release()
+
+    def expand_sweep(self, message):
+        """
+        Takes the next run of a sweep descriptor (see Sweep) and puts the
+        descriptor back at the front of the queue for the runs after it.
+
+        Returns:
+            dict: The message of the run, or None if the sweep is finished,
+                cancelled or invalid.
+        """
+        settings = message["measurement_settings"]
+        sweep_id = settings.setdefault(
+            "sweep_id", f"{settings.get('sweep_type')}#{message['sensor_id']}_{datetime.now().strftime('%Y-%m-%dT%H%M%S')}")
+        sweep = self.sweeps.get(sweep_id)
+        if sweep is None:
+            self.runs.start(message)
+            try:
+                sweep = Sweep(message)
+            except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+                self.logger.log_error(f"Invalid sweep {sweep_id}: {e}")
+                self.runs.fail(message.get("run_id"), f"Invalid sweep: {e}")
+                return None
+            self.sweeps[sweep_id] = sweep
+            self.logger.log_error(f"Starting sweep {sweep_id} of {sweep.total} runs")
+        run = sweep.next_message()
+        if run is None:
+            del self.sweeps[sweep_id]
+            self.runs.done(sweep.run_id)
+            self.publish_sweep_progress(sweep)
+            return None
+        self.measurement_queue.queue.appendleft(message)
+        return run
+
+    def cancel_sweep(self, sweep_id=None):
+        """
+        Cancels a sweep, or all sweeps without a `sweep_id`: its remaining
+        runs are not measured.
+        """
+        with self.measurement_queue.mutex:
+            queued = [m for m in self.measurement_queue.queue
+                      if m["measurement_settings"].get("type") == "sweep"
+                      and sweep_id in (None, m["measurement_settings"].get("sweep_id"))]
+            for message in queued:
+                self.measurement_queue.queue.remove(message)
+        for message in queued:
+            queued_id = message["measurement_settings"].get("sweep_id")
+            sweep = self.sweeps.pop(queued_id, None)
+            if sweep is not None:
+                sweep.cancel()
+                self.publish_sweep_progress(sweep)
+            self.runs.skip(message.get("run_id"), "Sweep cancelled")
+            self.logger.log_error(f"Sweep {queued_id} cancelled")
+
+    def publish_sweep_progress(self, sweep):
+        """
+        Logs the progress of a sweep and publishes it as event.
+        """
+        progress = sweep.progress()
+        self.logger.log_error(f"Sweep {sweep.sweep_id}: {progress['done']}/{progress['total']} runs, {progress['status']}")
+        try:
+            self.event_publisher.publish(SWEEP_PROGRESS, **progress)
+        except Exception as e:
+            self.logger.log_error(f"Error publishing the progress of sweep {sweep.sweep_id}: {e}")
+
     def start(self):
         """
         Start the measurement loop using APScheduler.
         """
         midnight_trigger = CronTrigger(hour=0, minute=0, timezone=pytz.timezone('Europe/Amsterdam'))
         self.scheduler.add_job(self.midnight_initialize_queue, midnight_trigger)
+        self.refit_cost_model()
+        self.import_legacy_trends()
+        self.scheduler.add_job(self.plan_scheduler.sync, 'interval', seconds=PLAN_SYNC_S, next_run_time=datetime.now())
 
     def mark_sensor_unresponsive(self, sensor_id):
         """
@@ -375,10 +609,42 @@ class MeasureProcessManager():
         self.qm.initialize_get_byte_queue()
         self.qm.initialize_calibrate_queue()
         self.logger.log_error(f"Midnight get byte and calibration loop initialized.")
+        self.refit_cost_model()
+        self.logger.log_error(f"Pruned {self.runs.prune()} runs from the run manifest.")
+        self.trends.prune()
+
+    def import_legacy_trends(self):
+        """
+        Moves the per-day tables of `continuous_measurements.db` of the old
+        continuous measurement window into the trend store, once.
+        """
+        legacy_path = os.path.join(self.metadata_directory, 'continuous_measurements.db')
+        if not os.path.exists(legacy_path):
+            return
+        try:
+            count = self.trends.import_legacy(legacy_path, drop=True)
+            os.rename(legacy_path, f"{legacy_path}.imported")
+            self.logger.log_error(f"Imported {count} trend points from {legacy_path}")
+        except Exception as e:
+            self.logger.log_error(f"Error importing the trends of {legacy_path}: {e}")
+
+    def refit_cost_model(self):
+        """
+        Fits the cost model (see MeasurementCostModel) on the timings in the
+        event log, for the planners of the measure service and the GUIs.
+        """
+        try:
+            model = MeasurementCostModel.get_instance()
+            parameters = model.refit(self.event_publisher.log_path)
+            self.logger.log_error(f"Cost model fitted on {model.samples} runs: {parameters}")
+        except Exception as e:
+            self.logger.log_error(f"Error fitting the cost model: {e}")
 
 
 if __name__ == "__main__":
     mpm = MeasureProcessManager()
+    # Stop through the shutdown below on SIGTERM, so staged files are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     # Run the process measurement queue function directly once
     mpm.process_measurement_queue()
     # And then start the scheduler
@@ -391,3 +657,16 @@ if __name__ == "__main__":
     except (KeyboardInterrupt, SystemExit):
         scs.close_gpio()
         mpm.scheduler.shutdown()
+        # Before the storage writer, a failed processing stores its raw file
+        if mpm.acquisition_processor is not None:
+            mpm.acquisition_processor.close()
+        mpm.storage_writer.close()
+        if mpm.handoff is not None:
+            mpm.handoff.close()
+        if mpm.staging is not None:
+            mpm.staging.close()
+        mpm.timeseries.close()
+        mpm.trends.close()
+        mpm.catalog.close()
+        mpm.runs.close()
+        mpm.event_publisher.close()
@@ -0,0 +1,103 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from signal_conditioning import SAMPLE_RATE
+
+
+class LongAcquisitionWriter:
+    """
+    LongAcquisitionWriter streams the chunks of a long acquisition (see
+    `measure_long`) into one growing FLAC file, so an acquisition of
+    seconds is never held in memory and ends up as one continuous stream
+    instead of a file per chunk.
+
+    The chunks are encoded by a worker thread while the next chunk is
+    measured. The file is written under a `.part` name and renamed once
+    complete. Next to it, `<file>.json` holds the timing of every chunk:
+    its first sample in the stream, its length, when it was requested and
+    received, and the estimated gap before it. The gap is the time between
+    the end of the previous chunk (its request time plus its duration) and
+    the request of this chunk, i.e. the time no samples were taken.
+    """
+
+    def __init__(self, filepath, settings, subtype='PCM_16', sample_rate=SAMPLE_RATE):
+        import soundfile as sf
+        self.filepath = filepath
+        self.settings = settings
+        self.sample_rate = sample_rate
+        self.tmp_path = f"{filepath}.part"
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        self.file = sf.SoundFile(self.tmp_path, 'w', samplerate=sample_rate, channels=1, format='FLAC', subtype=subtype)
+        # One worker, so the chunks are written in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='long-acquisition')
+        self.futures = []
+        self.chunks = []
+        self.num_samples = 0
+
+    def add_chunk(self, samples, duration_us, requested_at, received_at) -> None:
+        """
+        Queues a chunk for writing and records its timing, see `measure_long`.
+        """
+        gap_s = None
+        if self.chunks:
+            previous = self.chunks[-1]
+            gap_s = round(requested_at - previous["requested_at"] - previous["duration_us"] * 1e-6, 6)
+        self.chunks.append({
+            "offset": self.num_samples,
+            "num_samples": len(samples),
+            "duration_us": int(duration_us),
+            "requested_at": requested_at,
+            "received_at": received_at,
+            "gap_s": gap_s,
+        })
+        self.num_samples += len(samples)
+        self.futures.append(self.executor.submit(self._write, samples))
+
+    def _write(self, samples) -> None:
+        import numpy as np
+        self.file.write(np.asarray(samples, dtype=np.int16))
+
+    def close(self, complete=True) -> str:
+        """
+        Writes the queued chunks, the timing sidecar and renames the file.
+
+        Parameters:
+            complete (bool): Whether all chunks were measured, stored in
+                the sidecar.
+
+        Returns:
+            str: The path of the written file, or None if no chunk was written.
+        """
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown(wait=True)
+            self.file.close()
+        if not self.chunks:
+            os.remove(self.tmp_path)
+            return None
+        gaps = [chunk["gap_s"] for chunk in self.chunks if chunk["gap_s"] is not None]
+        sidecar = {
+            "sample_rate": self.sample_rate,
+            "complete": complete,
+            "num_samples": self.num_samples,
+            "num_chunks": len(self.chunks),
+            "max_gap_s": max(gaps) if gaps else 0.0,
+            "measurement_settings": self.settings,
+            "chunks": self.chunks,
+        }
+        with open(f"{self.filepath}.json.part", 'w') as f:
+            json.dump(sidecar, f)
+        os.replace(f"{self.filepath}.json.part", f"{self.filepath}.json")
+        os.replace(self.tmp_path, self.filepath)
+        return self.filepath
+
+    def abort(self) -> None:
+        """
+        Stops writing and removes the partial file.
+        """
+        self.executor.shutdown(wait=True)
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
@@ -1,14 +1,34 @@
+import time
 from datetime import datetime
 from message_packing_functions import MessagePackingFunctions as mpf
 from message_unpacking_functions import MessageUnpackingFunctions as muf
 
+# The duration of a BLOCK/SINE command is sent in 2 bytes of microseconds,
+# longer acquisitions are chained from chunks of at most this duration
+MAX_CHUNK_DURATION_US = 65000
+WAVEFORM_COMMAND_BYTES = {'BLOCK': [0x5E], 'SINE': [0x5C]}
+
 
 class MeasurePlensorMixin:
     """
     Mixin class for measurement commands to be inherited by the Sensor
     object classes.
     """
-    def measure_block_or_sine(self, measurement_settings):
+    def measure_block_or_sine(self, measurement_settings, on_repetition=None, quality_gate=None):
+        """
+        Measures the repetitions of a BLOCK or SINE command.
+
+        Parameters:
+            measurement_settings (dict): The measurement settings of the message.
+            on_repetition (callable): Called with the samples of every
+                successful repetition as soon as it arrives, e.g. to average
+                it while the next repetition is measured.
+            quality_gate (RepetitionQualityGate): Checks every repetition as
+                it arrives, a repetition it rejects is requested again.
+
+        Returns:
+            list: The samples of all repetitions, or None if the measurement failed.
+        """
         try:
             # Construct message
             if measurement_settings['command'] == 'BLOCK':
@@ -33,31 +53,20 @@ class MeasurePlensorMixin:
 
             while successful_reps < measurement_settings['repetitions'] and retry < 3:
                 self.logger.log_error(f"[{self.sensor_id}]: Repetition: {successful_reps+1}, retry: {retry}")
-                response = muf.receive_response(message_bytes, timeout)
+                audio = self.request_audio(message_bytes, timeout)
 
-                if response:
-                    ack_nak, payload = muf.extract_payload(response, self.sensor_id)
-                    if payload is not None:
-                        self.logger.log_error(f"[{self.sensor_id}]: Confirmation: {ack_nak}, Payload: {payload[0:20].hex()}")
-
-                    if ack_nak == "ACK":
-                        if payload is not None:
-                            audio = muf.extract_audio(payload)
-                        else:
-                            self.logger.log_error("[{self.sensor_id}]: Payload mismatch or processing error, skipping this repetition.")
-                            audio = None
-                    else:
-                        self.logger.log_error(f"[{self.sensor_id}]: NAK or Error: {ack_nak}, skipping this repetition.")
-                        audio = None
-                else:
-                    self.logger.log_error(f"[{self.sensor_id}]: No response received within timeout period.")
-                    audio = None
+                if audio is not None and quality_gate is not None and not quality_gate.accept(audio):
+                    self.logger.log_error(
+                        f"[{self.sensor_id}]: Repetition {successful_reps+1} flagged {quality_gate.last_flags}, requesting it again")
+                    continue
 
                 if audio is not None:
                     self.logger.log_error(f"[{self.sensor_id}]: Length audio: {len(audio)}")
                     aggregated_data = aggregated_data + audio
                     # aggregated_data.append(audio)
                     successful_reps += 1
+                    if on_repetition is not None:
+                        on_repetition(audio)
                 else:
                     self.logger.log_error(f"[{self.sensor_id}]: No audio. Retrying...")
                     retry += 1
@@ -68,6 +77,81 @@ class MeasurePlensorMixin:
             self.logger.log_error(f"Error while measuring block or sine: {e}")
             return None
 
+    def request_audio(self, message_bytes, timeout):
+        """
+        Sends a BLOCK or SINE command and waits for its audio.
+
+        Returns:
+            list: The samples, or None if there was no valid response.
+        """
+        response = muf.receive_response(message_bytes, timeout)
+
+        if response:
+            ack_nak, payload = muf.extract_payload(response, self.sensor_id)
+            if payload is not None:
+                self.logger.log_error(f"[{self.sensor_id}]: Confirmation: {ack_nak}, Payload: {payload[0:20].hex()}")
+
+            if ack_nak == "ACK":
+                if payload is not None:
+                    return muf.extract_audio(payload)
+                self.logger.log_error(f"[{self.sensor_id}]: Payload mismatch or processing error, skipping this repetition.")
+            else:
+                self.logger.log_error(f"[{self.sensor_id}]: NAK or Error: {ack_nak}, skipping this repetition.")
+        else:
+            self.logger.log_error(f"[{self.sensor_id}]: No response received within timeout period.")
+        return None
+
+    def measure_long(self, measurement_settings, on_chunk):
+        """
+        Measures a BLOCK or SINE acquisition longer than one command allows,
+        as back-to-back commands of at most `chunk_duration` microseconds.
+        Every chunk excites the full start to stop frequency range. Only the
+        bus transfer happens between two chunks: `on_chunk` is called with
+        every chunk as soon as it arrives and has to return quickly.
+
+        Parameters:
+            measurement_settings (dict): `waveform` (BLOCK or SINE),
+                `start_frequency`, `stop_frequency`, `duration` (total, in
+                microseconds) and optionally `chunk_duration`.
+            on_chunk (callable): Called as on_chunk(samples, duration_us,
+                requested_at, received_at), times in epoch seconds.
+
+        Returns:
+            bool: True if all chunks were measured, False if a chunk failed
+                three times (the chunks before it were passed to `on_chunk`).
+        """
+        try:
+            command_byte = WAVEFORM_COMMAND_BYTES[measurement_settings.get('waveform', 'BLOCK')]
+            chunk_duration = min(int(measurement_settings.get('chunk_duration', MAX_CHUNK_DURATION_US)), MAX_CHUNK_DURATION_US)
+            remaining = int(measurement_settings['duration'])
+            messages = {}
+
+            while remaining > 0:
+                duration = min(chunk_duration, remaining)
+                if duration not in messages:
+                    payload_bytes = mpf.construct_payload_bytes_sine_block(
+                        command_byte,
+                        measurement_settings['start_frequency'],
+                        measurement_settings['stop_frequency'],
+                        duration)
+                    messages[duration] = mpf.construct_message(self.sensor_id, payload_bytes)
+                timeout = mpf.set_timeout(duration)
+
+                for retry in range(3):
+                    requested_at = time.time()
+                    audio = self.request_audio(messages[duration], timeout)
+                    if audio is not None:
+                        break
+                    self.logger.log_error(f"[{self.sensor_id}]: No audio for chunk, retry: {retry}")
+                else:
+                    return False
+                on_chunk(audio, duration, requested_at, time.time())
+                remaining -= duration
+            return True
+        except Exception as e:
+            self.logger.log_error(f"[{self.sensor_id}]: Error while measuring long acquisition: {e}")
+            return False
+
     def measure_env(self):
         """
         Function to measure the environmental variables.
@@ -1,12 +1,18 @@
 import os
-import numpy as np
-import soundfile as sf
+import sys
 import time
 from datetime import datetime
+from storage_codec import StorageWriter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'process-data', 'artifact'))
+from DataLayout import measurement_path
+from RunManifest import RunManifest
+from TimeSeriesStore import TimeSeriesStore, env_values
+from TrendStore import TrendStore, max_amplitude
 
 
 class MessageHandler:
-    def __init__(self, logger, json_handler, sensors, queue, measurement_dir, measurement_process_handler):
+    def __init__(self, logger, json_handler, sensors, queue, measurement_dir, measurement_process_handler, storage_writer=None, timeseries=None, handoff=None, persist_raw=True, acquisition_processor=None, runs=None, trends=None):
         self.sensors = sensors
         self.logger = logger
         self.json_handler = json_handler
@@ -14,7 +20,24 @@ class MessageHandler:
         self.env_dir = measurement_dir + '/environment_data'
         self.audio_dir = measurement_dir + '/audio_data/time_domain_not_processed'
         self.tof_dir = measurement_dir + '/audio_data/tof'
+        self.long_dir = measurement_dir + '/audio_data/long_acquisition'
         self.measurement_process_handler = measurement_process_handler
+        self.storage_writer = storage_writer or StorageWriter(logger)
+        # ENV and TOF readings go to the time series store instead of a JSON
+        # file per reading
+        self.timeseries = timeseries or TimeSeriesStore.get_instance(logger=logger)
+        # Trend metrics of every BLOCK/SINE run, per sensor and plan
+        self.trends = trends or TrendStore.get_instance(logger=logger)
+        # Optional shared-memory hand-off of BLOCK/SINE samples to
+        # process-data. Without `persist_raw`, handed off measurements are
+        # not stored as a file.
+        self.handoff = handoff
+        self.persist_raw = persist_raw
+        # Optional processing of BLOCK/SINE measurements while their
+        # repetitions arrive, see AcquisitionProcessor
+        self.acquisition_processor = acquisition_processor
+        # The handlers record the runs that measured, see RunManifest
+        self.runs = runs or RunManifest.get_instance(logger=logger)
 
     def handle_get_byte_msg(self, sensor_id, get_byte_msg) -> None:
         """
@@ -65,6 +88,8 @@ class MessageHandler:
             (s for s in self.sensors if s.sensor_id == sensor_id), None)
         if sensor:
             try:
+                # The damping level is sent again after a reset
+                sensor.forget_damping()
                 success = sensor.reset_plensor()
                 self.logger.log_error(f"[{sensor_id}]: Reset succes: {success}")
             except Exception as e:
@@ -99,6 +124,7 @@ class MessageHandler:
         sensor = next((s for s in self.sensors if s.sensor_id == sensor_id), None)
         if sensor:
             try:
+                sensor.forget_damping()
                 calibration_result = sensor.calibrate_plensor()
             except Exception as e:
                 self.logger.log_error(f"[{sensor_id}]: Calibration failed: {e}")
@@ -147,6 +173,8 @@ class MessageHandler:
                     self.handle_tof_msg(sensor, measure_msg)
                 elif measure_msg['measurement_settings']['command'] == 'TOF_BLOCK':
                     self.handle_tof_block_msg(sensor, measure_msg)
+                elif measure_msg['measurement_settings']['command'] == 'LONG':
+                    self.handle_long_msg(sensor, measure_msg)
         except Exception as e:
             self.logger.log_error(f" Error while handling measure msg: {e}")
 
@@ -176,7 +204,18 @@ class MessageHandler:
             damping_success = sensor.set_damping_byte(damping_level)
 
             if damping_success:
-                measurement = sensor.measure_block_or_sine(measure_msg['measurement_settings'])
+                # Imported on first use, see save_time_domain
+                from repetition_quality import RepetitionQualityGate
+                quality_gate = RepetitionQualityGate.from_settings(measure_msg['measurement_settings'])
+                averager = None
+                if (self.acquisition_processor is not None and not test_meas
+                        and self.storage_writer.codec.format != 'container'):
+                    averager = self.acquisition_processor.averager(measure_msg['measurement_settings']['repetitions'])
+                measurement_started = time.time()
+                measurement = sensor.measure_block_or_sine(
+                    measure_msg['measurement_settings'], on_repetition=averager.add if averager else None,
+                    quality_gate=quality_gate)
+                measurement_finished = time.time()
                 if measurement is not None:
                     # Save the audio measurement
                     record_timestamp = f"{datetime.now().strftime('%Y-%m-%d')}T{datetime.now().strftime('%H%M%S')}"
@@ -186,11 +225,42 @@ class MessageHandler:
                         f"{self.create_identifier(measure_msg, sensor)}"
                         f"#{str(sensor.sensor_id).zfill(5)}_{record_timestamp}.flac"
                     )
+                    run_id = measure_msg.get("run_id")
                     if not test_meas:
-                        sf.write(
-                            os.path.join(self.audio_dir, filename),
-                            np.int16(measurement),
-                            samplerate=500000)
+                        self.trends.add(
+                            sensor.sensor_id, measure_msg.get("plan_name", ""), 'max_amplitude',
+                            measurement_finished, max_amplitude(measurement))
+                        settings = measure_msg['measurement_settings']
+                        filepath = measurement_path(self.audio_dir, filename)
+                        retries = quality_gate.retries_used if quality_gate else 0
+                        self.runs.measured(
+                            run_id, self.storage_writer.codec.with_extension(filepath),
+                            measurement_started, measurement_finished, retries)
+                        future = self.save_time_domain(
+                            filepath,
+                            measurement,
+                            settings,
+                            averager=averager,
+                            quality=quality_gate.summary() if quality_gate else None,
+                            event={
+                                "sensor_id": sensor.sensor_id,
+                                "command": settings['command'],
+                                "start_frequency": settings.get('start_frequency'),
+                                "stop_frequency": settings.get('stop_frequency'),
+                                "damping_level": settings.get('damping_level'),
+                                "duration": settings.get('duration'),
+                                "repetitions": settings.get('repetitions'),
+                                "retries": retries,
+                                "damping_s": sensor.last_damping_s,
+                                "measurement_started": measurement_started,
+                                "measurement_finished": measurement_finished,
+                                "run_id": run_id,
+                            })
+                        if future is None:
+                            # Handed off or processed on acquisition, no file
+                            self.runs.done(run_id)
+                    else:
+                        self.runs.done(run_id)
 
                     # And add the measurement message at the end of the queue   
                     # self.measurement_queue.put(measure_msg)
@@ -198,26 +268,184 @@ class MessageHandler:
                 # If measurement failed, add a get_byte message to the front of the queue
                 # which also includes the original measure message
                 else:
+                    # The sensor may have restarted, send the damping level again
+                    sensor.forget_damping()
                     get_byte_msg = sensor.create_message(message_type="get_byte", calibrate_after=True)
                     self.measurement_queue.queue.appendleft(get_byte_msg)
 
         except Exception as e:
             self.logger.log_error(
                 f"BLOCK or SINE measurement failed for sensor {sensor.sensor_id}: {e}")
+            self.runs.fail(measure_msg.get("run_id"), e)
+
+    def save_time_domain(self, filepath, measurement, measurement_settings, event=None, averager=None, quality=None):
+        """
+        Saves a BLOCK/SINE measurement with the configured storage codec (FLAC
+        by default, see StorageCodec). The file is encoded by the storage
+        writer pool, so this returns before the file is written.
+
+        If the command has a `storage` entry in its measurement settings, the
+        measurement is band-limited and decimated first (see
+        SignalConditioner) and the decimation factor and filter spec are
+        stored as JSON in the file comment. If that fails, the measurement is
+        stored at full rate.
+
+        Parameters:
+            filepath (str): Path of the file, the extension follows the codec.
+            measurement (list): The raw measurement samples.
+            measurement_settings (dict): The measurement settings of the message.
+            event (dict): Fields of the "measurement completed" event that is
+                published once the file is written.
+            averager (SpectralAverager): Averager the repetitions were added
+                to while they arrived. The measurement is then processed by
+                the AcquisitionProcessor instead of process-data, and the
+                file is only written with its `persist_raw` or when the
+                processing failed.
+            quality (dict): Per-repetition quality flags (see
+                RepetitionQualityGate), stored in the file metadata.
+
+        With a hand-off, the samples are first handed over to process-data
+        in shared memory. The file is then only written with `persist_raw`,
+        or when the hand-off failed.
+
+        Returns:
+            Future: Resolves to the written path, or None if encoding failed.
+                None if the measurement was only handed off or processed.
+        """
+        from signal_conditioning import SAMPLE_RATE
+
+        codec = self.storage_writer.codec
+        processed = False
+        if averager is not None:
+            # Without persist_raw the samples are kept until the processing
+            # succeeded, and stored if it fails
+            store_raw = None if self.acquisition_processor.persist_raw else (
+                lambda: self.store_time_domain(filepath, measurement, measurement_settings, event, quality))
+            try:
+                self.acquisition_processor.finish(
+                    codec.with_extension(filepath), averager, measurement, SAMPLE_RATE, on_failure=store_raw)
+                processed = True
+                if store_raw is not None:
+                    return None
+            except Exception as e:
+                self.logger.log_error(f"Processing on acquisition failed, storing {filepath} for process-data: {e}")
+        return self.store_time_domain(filepath, measurement, measurement_settings, event, quality, processed)
+
+    def store_time_domain(self, filepath, measurement, measurement_settings, event=None, quality=None, processed=False):
+        """
+        Band-limits (if configured) and stores a BLOCK/SINE measurement, see
+        `save_time_domain`. Measurements that were not `processed` on
+        acquisition are handed off to process-data if there is a hand-off.
+
+        Returns:
+            Future: Resolves to the written path, or None if encoding failed.
+                None if the measurement was only handed off.
+        """
+        # Imported on first use, the service starts handling bus commands
+        # without loading numpy
+        import numpy as np
+        from signal_conditioning import SAMPLE_RATE, SignalConditioner
+
+        codec = self.storage_writer.codec
+        signal = np.int16(measurement)
+        sample_rate = SAMPLE_RATE
+        metadata = None
+        try:
+            storage = SignalConditioner.get_storage_settings(measurement_settings)
+            if storage is not None:
+                signal, sample_rate, metadata = SignalConditioner.band_limit_and_decimate(
+                    signal, storage, sample_rate=SAMPLE_RATE,
+                    repetitions=measurement_settings.get('repetitions', 1))
+        except Exception as e:
+            self.logger.log_error(f"Band-limiting failed, storing {filepath} at full rate: {e}")
+            signal, sample_rate, metadata = np.int16(measurement), SAMPLE_RATE, None
+        if quality is not None:
+            metadata = {**(metadata or {}), "quality": quality}
+
+        if self.handoff is not None and not processed and codec.format != 'container':
+            handed_off = self.handoff.send(
+                codec.with_extension(filepath), signal, sample_rate, metadata, persisted=self.persist_raw)
+            if handed_off and not self.persist_raw:
+                return None
+        return self.storage_writer.submit(filepath, signal, sample_rate, metadata, event=event)
+
+    def handle_long_msg(self, sensor, measure_msg) -> None:
+        """
+        Measures a long acquisition: a BLOCK or SINE of any duration, chained
+        from firmware-sized chunks and streamed into one FLAC file in
+        `audio_data/long_acquisition` (see LongAcquisitionWriter). The file
+        is named like a BLOCK/SINE file with command letter L, the chunk
+        duration and the number of chunks, e.g.
+        `02000L10000l000d65r031#00122_2025-01-01T120000.flac`.
+        """
+        # Imported on first use, see save_time_domain
+        from long_acquisition import LongAcquisitionWriter
+        from measure_plensor_mixin import MAX_CHUNK_DURATION_US
+
+        settings = measure_msg['measurement_settings']
+        writer = None
+        try:
+            damping_level = settings.get('damping_level', None)
+            if not sensor.set_damping_byte(damping_level):
+                return
+            if damping_level is None:
+                damping_level = sensor.damping_level_base
+
+            chunk_duration = min(int(settings.get('chunk_duration', MAX_CHUNK_DURATION_US)), MAX_CHUNK_DURATION_US)
+            chunks = -(-int(settings['duration']) // chunk_duration)
+            if chunks > 999:
+                self.logger.log_error(f"[{sensor.sensor_id}]: Long acquisition of {chunks} chunks is too long, at most 999")
+                return
+            record_timestamp = datetime.now().strftime('%Y-%m-%dT%H%M%S')
+            filename = (
+                f"{str(int(settings['start_frequency']/10)).zfill(5)}L{str(int(settings['stop_frequency']/10)).zfill(5)}"
+                f"l{str(damping_level).zfill(3)}d{str(chunk_duration // 1000).zfill(2)}r{str(chunks).zfill(3)}"
+                f"#{str(sensor.sensor_id).zfill(5)}_{record_timestamp}.flac"
+            )
+            writer = LongAcquisitionWriter(
+                measurement_path(self.long_dir, filename), settings, subtype=self.storage_writer.codec.subtype)
+            measurement_started = time.time()
+            complete = sensor.measure_long(settings, writer.add_chunk)
+            measurement_finished = time.time()
+            writer_sample_rate = writer.sample_rate
+            path = writer.close(complete=complete)
+            writer = None
+            if path is None:
+                sensor.forget_damping()
+                get_byte_msg = sensor.create_message(message_type="get_byte", calibrate_after=True)
+                self.measurement_queue.queue.appendleft(get_byte_msg)
+                return
+            self.logger.log_error(
+                f"[{sensor.sensor_id}]: Long acquisition saved to {path}, complete: {complete}, "
+                f"{measurement_finished - measurement_started:.2f} s")
+            self.runs.measured(measure_msg.get("run_id"), path, measurement_started, measurement_finished)
+            self.storage_writer.announce(
+                path, writer_sample_rate, measurement_started, {
+                    "sensor_id": sensor.sensor_id,
+                    "command": 'LONG',
+                    "waveform": settings.get('waveform', 'BLOCK'),
+                    "start_frequency": settings.get('start_frequency'),
+                    "stop_frequency": settings.get('stop_frequency'),
+                    "damping_level": damping_level,
+                    "duration": settings.get('duration'),
+                    "complete": complete,
+                    "measurement_started": measurement_started,
+                    "measurement_finished": measurement_finished,
+                    "run_id": measure_msg.get("run_id"),
+                })
+        except Exception as e:
+            self.logger.log_error(f"Long acquisition failed for sensor {sensor.sensor_id}: {e}")
+            self.runs.fail(measure_msg.get("run_id"), e)
+            if writer is not None:
+                writer.abort()
 
     def handle_env_msg(self, sensor, measure_msg) -> None:
         try:
             measurement = sensor.measure_env()
             if measurement is not None:
                 # Save the env measurement
-                record_timestamp = f"{datetime.now().strftime('%Y-%m-%d')}T{datetime.now().strftime('%H%M%S')}"
-                filename = (
-                    f"ENV#{str(sensor.sensor_id).zfill(5)}_{record_timestamp}.json"
-                )
-                self.json_handler.save_to_json(
-                    measurement,
-                    os.path.join(self.env_dir, filename)
-                )
+                self.timeseries.add_env(sensor.sensor_id, time.time(), *env_values(measurement))
+                self.runs.done(measure_msg.get("run_id"))
 
                 # And add the measurement message at the end of the queue
                 # self.measurement_queue.put(measure_msg)
@@ -226,6 +454,7 @@ class MessageHandler:
             # which also includes the original measure message
             else:
                 self.logger.log_error(f"[{sensor.sensor_id}]: No env measurement success")
+                sensor.forget_damping()
                 get_byte_msg = sensor.create_message(message_type="get_byte", calibrate_after=True)
                 get_byte_msg["original_measure_msg"] = measure_msg
                 self.measurement_queue.queue.appendleft(get_byte_msg)
@@ -242,15 +471,12 @@ class MessageHandler:
             if damping_success:
                 measurement = sensor.measure_tof_impulse(measure_msg['measurement_settings'])
                 if measurement is not None:
-                    # Save the env measurement
-                    record_timestamp = f"{datetime.now().strftime('%Y-%m-%d')}T{datetime.now().strftime('%H%M%S')}"
-                    filename = (
-                        f"TOF#{str(sensor.sensor_id).zfill(5)}_{record_timestamp}.json"
-                    )
-                    self.json_handler.save_to_json(
-                        measurement,
-                        os.path.join(self.tof_dir, filename)
-                    )
+                    # Save the tof measurement
+                    self.timeseries.add_tof(
+                        sensor.sensor_id, time.time(), measurement, command='TOF',
+                        repetitions=measure_msg['measurement_settings'].get('repetitions'),
+                        damping_level=damping_level)
+                    self.runs.done(measure_msg.get("run_id"))
         except Exception as e:
             self.logger.log_error(
                 f"TOF measurement failed for sensor {sensor.sensor_id}: {e}")
@@ -264,21 +490,13 @@ class MessageHandler:
             if damping_success:
                 measurement = sensor.measure_tof_block(measure_msg['measurement_settings'])
                 if measurement is not None:
-                    # Save the env measurement
-                    record_timestamp = f"{datetime.now().strftime('%Y-%m-%d')}T{datetime.now().strftime('%H%M%S')}"
-                    # Get settings for filename
-                    half_periods = str(measure_msg['measurement_settings']['tof_half_periods']).zfill(3)
-                    repetitions = str(measure_msg['measurement_settings']['repetitions']).zfill(3)
-                    damping_level = str(measure_msg['measurement_settings'].get('damping_level', 0)).zfill(3)
-                    
-                    filename = (
-                        f"TOF_BLOCKh{half_periods}r{repetitions}l{damping_level}#"
-                        f"{str(sensor.sensor_id).zfill(5)}_{record_timestamp}.json"
-                    )
-                    self.json_handler.save_to_json(
-                        measurement,
-                        os.path.join(self.tof_dir, filename)
-                    )
+                    # Save the tof block measurement
+                    self.timeseries.add_tof(
+                        sensor.sensor_id, time.time(), measurement, command='TOF_BLOCK',
+                        tof_half_periods=measure_msg['measurement_settings']['tof_half_periods'],
+                        repetitions=measure_msg['measurement_settings']['repetitions'],
+                        damping_level=measure_msg['measurement_settings'].get('damping_level', 0))
+                    self.runs.done(measure_msg.get("run_id"))
         except Exception as e:
             self.logger.log_error(
                 f"TOF Block measurement failed for sensor {sensor.sensor_id}: {e}")
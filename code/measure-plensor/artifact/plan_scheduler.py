@@ -0,0 +1,170 @@
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'process-data', 'artifact'))
+from MeasurementCostModel import MeasurementCostModel
+from MeasurementEvents import PLAN_PROGRESS
+from MeasurementPlans import DEFAULT_INTERVAL, plan_messages, read_plans
+
+# How often the plans file is checked for changes, in seconds
+PLAN_SYNC_S = 5
+
+
+class PlanRun:
+    """
+    One run of a measurement plan: its messages in the queue, tagged with
+    `plan_run_id`, and the deadline they have to be measured by. Messages
+    taken after the deadline are skipped, so an overrunning plan does not
+    pile up behind itself.
+    """
+
+    def __init__(self, plan, messages, scheduled_at, predicted_s):
+        self.plan_name = plan.get("plan_name", "Unnamed Plan")
+        self.plan_run_id = f"{self.plan_name}#{datetime.fromtimestamp(scheduled_at).strftime('%Y-%m-%dT%H%M%S')}"
+        interval = float(plan.get("interval", DEFAULT_INTERVAL))
+        self.deadline = scheduled_at + float(plan.get("deadline_s", interval))
+        self.total = len(messages)
+        self.predicted_s = predicted_s
+        self.done = 0
+        self.skipped = 0
+        self.status = 'running'
+        self.started_at = scheduled_at
+
+    def expired(self) -> bool:
+        return time.time() > self.deadline
+
+    def message_done(self, skipped=False) -> None:
+        if skipped:
+            self.skipped += 1
+        else:
+            self.done += 1
+        if self.done + self.skipped >= self.total:
+            self.status = 'overrun' if self.skipped else 'finished'
+
+    def progress(self) -> dict:
+        return {
+            "plan_name": self.plan_name,
+            "plan_run_id": self.plan_run_id,
+            "status": self.status,
+            "done": self.done,
+            "skipped": self.skipped,
+            "total": self.total,
+            "predicted_s": self.predicted_s,
+            "deadline": self.deadline,
+            "elapsed_s": round(time.time() - self.started_at, 3),
+        }
+
+
+class PlanScheduler:
+    """
+    PlanScheduler measures the measurement plans registered in
+    `measurement_plans.json` (see MeasurementPlans) from the scheduler of
+    the measure service, so they keep running without a GUI.
+
+    Every plan is an interval job. When it fires, the messages of the plan
+    are planned (see run_planner) and put at the front of the queue; when
+    the measurement loop is idle, they are measured right away instead of
+    at the next cycle. Progress is published as `plan_progress` events.
+    """
+
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.logger = manager.logger
+        self.path = path
+        self.plans = {}
+        self.runs = {}
+        self.loaded_mtime = None
+
+    def sync(self) -> None:
+        """
+        Registers the plans of the plans file with the scheduler when the
+        file changed: new and changed plans are (re)scheduled, removed and
+        disabled plans are unscheduled.
+        """
+        try:
+            mtime = os.path.getmtime(self.path) if os.path.exists(self.path) else None
+            if mtime == self.loaded_mtime:
+                return
+            self.loaded_mtime = mtime
+            plans = {plan.get("plan_name", "Unnamed Plan"): plan for plan in read_plans(self.path)
+                     if plan.get("enabled", True)}
+            for name in list(self.plans):
+                if plans.get(name) != self.plans[name]:
+                    self.manager.scheduler.remove_job(self._job_id(name))
+                    del self.plans[name]
+                    self.logger.log_error(f"Measurement plan {name} unscheduled")
+            for name, plan in plans.items():
+                if name not in self.plans:
+                    self.schedule(plan)
+        except Exception as e:
+            self.logger.log_error(f"Error syncing the measurement plans from {self.path}: {e}")
+
+    @staticmethod
+    def _job_id(name) -> str:
+        return f"plan:{name}"
+
+    def schedule(self, plan) -> None:
+        name = plan.get("plan_name", "Unnamed Plan")
+        interval = float(plan.get("interval", DEFAULT_INTERVAL))
+        predicted_s = MeasurementCostModel.get_instance().predict_messages(plan_messages(plan))["estimated_s"]
+        if predicted_s > interval:
+            self.logger.log_warning(
+                f"Measurement plan {name} takes {predicted_s:.1f}s, longer than its interval of {interval:.0f}s")
+        self.manager.scheduler.add_job(
+            self.trigger, 'interval', seconds=interval, args=[plan], id=self._job_id(name),
+            replace_existing=True, max_instances=1, coalesce=True, next_run_time=datetime.now())
+        self.plans[name] = plan
+        self.logger.log_error(f"Measurement plan {name} scheduled every {interval:.0f}s, predicted {predicted_s:.1f}s")
+
+    def trigger(self, plan) -> None:
+        """
+        Puts the messages of a plan run at the front of the queue and
+        measures them if the measurement loop is idle.
+        """
+        try:
+            messages = self.manager.plan_batch(plan_messages(plan))
+            predicted_s = MeasurementCostModel.get_instance().predict_messages(messages)["estimated_s"]
+            run = PlanRun(plan, messages, time.time(), predicted_s)
+            for message in messages:
+                message["plan_run_id"] = run.plan_run_id
+                message["plan_name"] = run.plan_name
+            self.manager.runs.submit(messages)
+            if run.total == 0:
+                run.status = 'finished'
+                self.publish(run)
+                return
+            self.runs[run.plan_run_id] = run
+            with self.manager.measurement_queue.mutex:
+                self.manager.measurement_queue.queue.extendleft(reversed(messages))
+            self.logger.log_error(f"Measurement plan run {run.plan_run_id}: {run.total} messages queued")
+            self.publish(run)
+            self.manager.drain_plan_messages()
+        except Exception as e:
+            self.logger.log_error(f"Error running measurement plan {plan.get('plan_name')}: {e}")
+
+    def run_of(self, message):
+        return self.runs.get(message.get("plan_run_id"))
+
+    def message_done(self, message, skipped=False) -> None:
+        """
+        Records a measured (or skipped) message of a plan run.
+        """
+        run = self.run_of(message)
+        if run is None:
+            return
+        run.message_done(skipped=skipped)
+        if run.status != 'running':
+            del self.runs[run.plan_run_id]
+        self.publish(run)
+
+    def publish(self, run) -> None:
+        progress = run.progress()
+        self.logger.log_error(
+            f"Plan run {run.plan_run_id}: {progress['done']}/{progress['total']} messages, "
+            f"{progress['skipped']} skipped, {progress['status']}")
+        try:
+            self.manager.event_publisher.publish(PLAN_PROGRESS, **progress)
+        except Exception as e:
+            self.logger.log_error(f"Error publishing the progress of plan run {run.plan_run_id}: {e}")
@@ -0,0 +1,154 @@
+import numpy as np
+
+FLAG_ZERO = 'zero'
+FLAG_DC_STUCK = 'dc_stuck'
+FLAG_CLIPPED = 'clipped'
+FLAG_MS_OUTLIER = 'ms_outlier'
+
+INT16_RAILS = (-32768, 32767)
+
+
+class RepetitionQualityGate:
+    """
+    RepetitionQualityGate checks every repetition of a BLOCK/SINE
+    measurement as it arrives, so a bad repetition is requested again while
+    the sensor is still on the bus, instead of being dropped by
+    `preprocess_pp002` long after the measurement.
+
+    A repetition is flagged when:
+        - zero: the payload is all zeros.
+        - dc_stuck: the peak-to-peak amplitude is below `min_peak_to_peak`.
+        - clipped: more than `max_clipped_fraction` of the samples sit on
+          the int16 rails.
+        - ms_outlier: its mean square (without the first and last 2%, as in
+          pp002) is more than `max_ms_ratio` times above or below the median
+          of the accepted repetitions, once there are `min_reference` of them.
+
+    Flagged repetitions are requested again while the `retries` budget of
+    the measurement lasts; after that they are kept with their flags. The
+    gate is configured per command with a `quality` entry in the
+    measurement settings of measure_settings.json, e.g.:
+
+        "quality": {
+            "max_clipped_fraction": 0.001,
+            "min_peak_to_peak": 4,
+            "max_ms_ratio": 4.0,
+            "min_reference": 3,
+            "retries": 3
+        }
+
+    Without a `quality` entry, repetitions are not checked, as before.
+    """
+
+    def __init__(self, max_clipped_fraction=0.001, min_peak_to_peak=4, max_ms_ratio=4.0, min_reference=3, retries=3):
+        self.max_clipped_fraction = max_clipped_fraction
+        self.min_peak_to_peak = min_peak_to_peak
+        self.max_ms_ratio = max_ms_ratio
+        self.min_reference = min_reference
+        self.retries = retries
+        self.retries_used = 0
+        self.attempts = 1
+        self.last_flags = []
+        # Mean squares of the accepted repetitions without flags
+        self.reference = []
+        # Per accepted repetition
+        self.flags = []
+        self.mean_squares = []
+        self.attempts_per_repetition = []
+
+    @staticmethod
+    def from_settings(measurement_settings):
+        """
+        Returns the gate for a measurement, or None when the measurement
+        settings have no `quality` entry.
+        """
+        quality = measurement_settings.get('quality')
+        if not quality or not quality.get('enabled', True):
+            return None
+        return RepetitionQualityGate(
+            max_clipped_fraction=float(quality.get('max_clipped_fraction', 0.001)),
+            min_peak_to_peak=int(quality.get('min_peak_to_peak', 4)),
+            max_ms_ratio=float(quality.get('max_ms_ratio', 4.0)),
+            min_reference=int(quality.get('min_reference', 3)),
+            retries=int(quality.get('retries', 3)))
+
+    def check(self, samples) -> tuple:
+        """
+        Checks a repetition against the criteria of the gate.
+
+        Returns:
+            tuple: (list of flags, mean square of the repetition)
+        """
+        signal = np.asarray(samples, dtype=np.int16)
+        edge = len(signal) // 50
+        mean_square = float(np.mean(np.square(signal[edge:len(signal) - edge], dtype=np.float64))) if len(signal) else 0.0
+        flags = []
+        if not np.any(signal):
+            flags.append(FLAG_ZERO)
+        elif int(signal.max()) - int(signal.min()) < self.min_peak_to_peak:
+            flags.append(FLAG_DC_STUCK)
+        clipped = np.count_nonzero((signal == INT16_RAILS[0]) | (signal == INT16_RAILS[1]))
+        if clipped > self.max_clipped_fraction * len(signal):
+            flags.append(FLAG_CLIPPED)
+        if not flags and len(self.reference) >= self.min_reference:
+            median = float(np.median(self.reference))
+            if median > 0 and not median / self.max_ms_ratio <= mean_square <= median * self.max_ms_ratio:
+                flags.append(FLAG_MS_OUTLIER)
+        return flags, mean_square
+
+    def accept(self, samples) -> bool:
+        """
+        Checks a repetition and records it if it is kept.
+
+        Returns:
+            bool: True if the repetition is kept, False if it has to be
+                requested again. The flags are in `last_flags`.
+        """
+        flags, mean_square = self.check(samples)
+        self.last_flags = flags
+        if flags and self.retries_used < self.retries:
+            self.retries_used += 1
+            self.attempts += 1
+            return False
+        self.flags.append(flags)
+        self.mean_squares.append(round(mean_square, 1))
+        self.attempts_per_repetition.append(self.attempts)
+        if not flags:
+            self.reference.append(mean_square)
+        self.attempts = 1
+        return True
+
+    def summary(self) -> dict:
+        """
+        Returns the per-repetition quality flags, stored with the measurement.
+        """
+        return {
+            "flags": self.flags,
+            "mean_square": self.mean_squares,
+            "attempts": self.attempts_per_repetition,
+            "retries": self.retries_used,
+            "flagged": sum(1 for flags in self.flags if flags),
+        }
+
+
+if __name__ == "__main__":
+    # Check of the criteria on a noisy chirp: a clean measurement passes,
+    # the faulty repetitions are requested again.
+    from scipy.signal import chirp
+
+    rng = np.random.default_rng(0)
+    t = np.arange(25000) / 500000
+    repetition = 12000 * chirp(t, f0=20000, t1=t[-1], f1=100000)
+
+    def make(scale=1.0):
+        noisy = scale * repetition + rng.normal(0, 200, len(t))
+        return np.clip(np.round(noisy), -32768, 32767).astype(np.int16)
+
+    gate = RepetitionQualityGate(retries=4)
+    arrivals = [make(), make(), make(), np.zeros(len(t), dtype=np.int16), make(),
+                make(scale=4.0), make(), np.full(len(t), 117, dtype=np.int16), make(scale=0.2), make(), make()]
+    expected = [True, True, True, False, True, False, True, False, False, True, True]
+    results = [gate.accept(samples) for samples in arrivals]
+    passed = results == expected and gate.summary()["flagged"] == 0 and gate.retries_used == 4
+    print(f"accepted {results}, summary {gate.summary()} {'OK' if passed else 'FAILED'}")
+    raise SystemExit(0 if passed else 1)
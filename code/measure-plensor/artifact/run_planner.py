@@ -0,0 +1,167 @@
+import os
+import sys
+from sweeps import sweep_runs
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'process-data', 'artifact'))
+from MeasurementCostModel import MeasurementCostModel
+
+MEASURE_TYPES = ('measure', 'sweep')
+# Messages after which the damping level of the sensor is unknown
+RESET_TYPES = ('reset', 'calibrate')
+
+# Damping level of a run that keeps the current level
+_KEEP = object()
+
+
+class _Unit:
+    """
+    A message of a batch as the planner sees it: a run, or a sweep with the
+    damping level and command of each of its runs.
+    """
+
+    def __init__(self, index, message):
+        self.index = index
+        self.message = message
+        settings = message["measurement_settings"]
+        if settings.get("type") == "sweep":
+            runs = list(sweep_runs(settings["sweep_type"], settings["sweep_configuration"]))
+        else:
+            runs = [settings]
+        # (damping level, command) per run; ENV does not set the damping.
+        # A damping level of 0 selects the base level, as in set_damping_byte
+        self.steps = [(run.get("damping_level") or None, run.get("command")) if run.get("command") != "ENV"
+                      else (_KEEP, "ENV") for run in runs]
+
+
+def _is_barrier(message) -> bool:
+    settings = message.get("measurement_settings", {})
+    return settings.get("type") not in MEASURE_TYPES or bool(settings.get("ordered", False))
+
+
+def _expanded(messages):
+    """
+    Yields the messages with every sweep descriptor replaced by its runs.
+    """
+    for message in messages:
+        settings = message.get("measurement_settings", {})
+        if settings.get("type") != "sweep":
+            yield message
+            continue
+        for run in sweep_runs(settings["sweep_type"], settings["sweep_configuration"]):
+            yield {"sensor_id": message["sensor_id"], "measurement_settings": run}
+
+
+def estimate_cost(messages, current_damping=None, model=None) -> dict:
+    """
+    Estimates the bus time of a batch of messages in the given order, with
+    the cost model (see MeasurementCostModel).
+
+    Parameters:
+        messages (list): Queue messages; runs and sweep descriptors are
+            costed, other messages are not.
+        current_damping (dict): Damping level per sensor id the sensors are
+            known to be at, see `Sensor.applied_damping_level`.
+        model (MeasurementCostModel): Defaults to the fitted model.
+
+    Returns:
+        dict: damping_switches, command_switches, run_s and estimated_s.
+    """
+    model = model or MeasurementCostModel.get_instance()
+    return model.predict_messages(_expanded(messages), current_damping)
+
+
+def _starts_at(unit, damping, command) -> bool:
+    if not unit.steps:
+        return True
+    level, run_command = unit.steps[0]
+    return (level is _KEEP or level == damping) and (command is None or run_command == command)
+
+
+def _apply(unit, damping, command):
+    """
+    Returns the damping level and command a sensor is at after a unit.
+    """
+    for level, run_command in unit.steps:
+        if level is not _KEEP:
+            damping = level
+        command = run_command
+    return damping, command
+
+
+def _order(units, damping):
+    """
+    Orders the units of one sensor: the next unit is the first that starts
+    at the current damping level and command, else the first at the current
+    damping level, else the first remaining. Units with the same damping
+    level and command keep their order.
+    """
+    remaining = list(units)
+    ordered = []
+    command = None
+    while remaining:
+        unit = (next((u for u in remaining if command is not None and _starts_at(u, damping, command)), None)
+                or next((u for u in remaining if _starts_at(u, damping, None)), None)
+                or remaining[0])
+        remaining.remove(unit)
+        ordered.append(unit)
+        damping, command = _apply(unit, damping, command)
+    return ordered, damping
+
+
+def plan_messages(messages, current_damping=None, model=None):
+    """
+    Reorders a batch of messages (e.g. the interrupt file) so the runs of a
+    sensor are grouped by damping level and command, with fewer SET DAMPING
+    commands on the bus. Runs only move within their sensor: every position
+    of a sensor in the batch is taken by a run of that same sensor.
+
+    Messages that are not runs or sweeps (get_byte, reset, calibrate,
+    cancel_sweep) and messages with `"ordered": true` in their measurement
+    settings keep their position, and nothing moves across them.
+
+    Parameters:
+        messages (list): The batch of queue messages, in the order given.
+        current_damping (dict): Damping level per sensor id the sensors are
+            known to be at.
+        model (MeasurementCostModel): Defaults to the fitted model.
+
+    Returns:
+        tuple: (planned messages, report) with the cost estimate `before`
+            and `after` (see `estimate_cost`) and the number of messages
+            `moved` in the report.
+    """
+    damping = dict(current_damping or {})
+    planned = list(messages)
+    segment = []
+    for index, message in enumerate(messages + [None]):
+        if message is not None and not _is_barrier(message):
+            segment.append(_Unit(index, message))
+            continue
+        by_sensor = {}
+        for unit in segment:
+            by_sensor.setdefault(unit.message["sensor_id"], []).append(unit)
+        for sensor_id, units in by_sensor.items():
+            ordered, level = _order(units, damping.get(sensor_id, _KEEP))
+            for position, unit in zip([u.index for u in units], ordered):
+                planned[position] = unit.message
+            if level is not _KEEP:
+                damping[sensor_id] = level
+        segment = []
+        if message is None:
+            continue
+        sensor_id = message.get("sensor_id")
+        message_type = message.get("measurement_settings", {}).get("type")
+        if message_type in MEASURE_TYPES:
+            level, _ = _apply(_Unit(index, message), damping.get(sensor_id, _KEEP), None)
+            if level is not _KEEP:
+                damping[sensor_id] = level
+        elif message_type in RESET_TYPES:
+            # The damping level of the sensor is unknown afterwards
+            damping.pop(sensor_id, None)
+    report = {
+        "messages": len(messages),
+        "moved": sum(1 for a, b in zip(messages, planned) if a is not b),
+        "before": estimate_cost(messages, current_damping, model),
+        "after": estimate_cost(planned, current_damping, model),
+    }
+    return planned, report
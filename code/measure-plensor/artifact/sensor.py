@@ -48,6 +48,10 @@ class Sensor(
         self.json_handler = JSONHandler.get_instance()
         self.damping_level_base = self.get_damping_level()
         self.damping_level_bytes_base = self.extract_damping()
+        # Damping level acknowledged by the sensor, None for the base level
+        self.damping_applied = False
+        self.applied_damping_level = None
+        self.last_damping_s = None
         print(f"Damping level from metadata: {self.damping_level_bytes_base}")
 
     def get_plensor_measurement_settings(self) -> dict:
@@ -1,5 +1,6 @@
 from datetime import datetime
 import json
+import time
 
 from message_packing_functions import MessagePackingFunctions as mpf
 from message_unpacking_functions import MessageUnpackingFunctions as muf
@@ -9,8 +10,18 @@ class SetDampingMixin:
     def set_damping_byte(self, damping_level: int = None) -> bool:
         """
         Calibrates the Plensor.
+
+        The SET DAMPING is skipped when the sensor acknowledged the same
+        damping level before and was not reset or calibrated since, see
+        `applied_damping_level`.
         """
         try:
+            requested_level = damping_level or None
+            if getattr(self, 'damping_applied', False) and self.applied_damping_level == requested_level:
+                self.logger.log_error(f"[{self.sensor_id}]: Damping level {damping_level} already set")
+                self.last_damping_s = None
+                return True
+            started = time.time()
             if damping_level:
                 self.damping_level = damping_level
                 self.damping_level_bytes = self._process_damping_level(damping_level)
@@ -31,16 +42,36 @@ class SetDampingMixin:
 
                 if payload is not None:
                     self.logger.log_error(f"[{self.sensor_id}]: Confirmation: {ack_nak}, Payload: {payload[0:20].hex()}")
+                    if ack_nak == "ACK":
+                        self.damping_applied = True
+                        self.applied_damping_level = requested_level
+                        # Time of the SET DAMPING, recorded for the cost model
+                        self.last_damping_s = time.time() - started
+                    else:
+                        # Not applied, the next run sends the damping level again
+                        self.forget_damping()
+                        self.last_damping_s = None
                     return True
 
                 else:
                     self.logger.log_error(f"[{self.sensor_id}]: NAK or Error: {ack_nak}, skipping this repetition.")
+                    self.forget_damping()
                     return None
             else:
                 self.logger.log_error(f"[{self.sensor_id}]: No response received within timeout period.")
+                self.forget_damping()
                 return None
         except Exception as e:
             self.logger.log_error(f"[{self.sensor_id}]: Exception setting damping byte {e}")
+            self.forget_damping()
+
+    def forget_damping(self) -> None:
+        """
+        Marks the damping level of the sensor as unknown, so the next
+        `set_damping_byte` sends it again.
+        """
+        self.damping_applied = False
+        self.applied_damping_level = None
 
     def _process_damping_level(self, damping_level: int) -> bytes:
         """
@@ -0,0 +1,170 @@
+import numpy as np
+
+SAMPLE_RATE = 500000
+STORAGE_MODE_FULL_RATE = 'full_rate'
+STORAGE_MODE_BANDPASS_DECIMATE = 'bandpass_decimate'
+
+
+class SignalConditioner:
+    """
+    SignalConditioner band-limits and decimates a BLOCK/SINE measurement
+    before it is stored. The Plensor excitation only covers 20-100 kHz, so
+    a polyphase FIR band-pass followed by decimation keeps the band of
+    interest at a fraction of the 500 kHz samples.
+
+    The storage mode is configured per command with a `storage` entry in the
+    measurement settings of measure_settings.json, e.g.:
+
+        "storage": {
+            "mode": "bandpass_decimate",
+            "decimation": 2,
+            "band": [20000, 100000],
+            "numtaps": 129
+        }
+
+    Without a `storage` entry (or with mode `full_rate`) the measurement is
+    stored at the full sample rate, as before.
+    """
+
+    @staticmethod
+    def get_storage_settings(measurement_settings) -> dict:
+        """
+        Returns the storage settings of a measurement, or None when the
+        measurement should be stored at full rate.
+        """
+        storage = measurement_settings.get('storage')
+        if not storage or storage.get('mode', STORAGE_MODE_FULL_RATE) == STORAGE_MODE_FULL_RATE:
+            return None
+        if storage['mode'] != STORAGE_MODE_BANDPASS_DECIMATE:
+            raise ValueError(f"Unknown storage mode: {storage['mode']}")
+        return storage
+
+    @staticmethod
+    def design_bandpass(band, numtaps, sample_rate, decimation) -> np.ndarray:
+        """
+        Designs the linear-phase FIR band-pass that is applied by the
+        polyphase decimator. The upper band edge has to stay below the
+        Nyquist frequency after decimation, otherwise the band aliases.
+
+        Parameters:
+            band (list): [low, high] band edges in Hz.
+            numtaps (int): Number of filter taps (odd).
+            sample_rate (int): Sample rate of the input signal in Hz.
+            decimation (int): Decimation factor.
+
+        Returns:
+            np.ndarray: The filter coefficients.
+        """
+        from scipy.signal import firwin
+        low, high = band
+        nyquist_after = sample_rate / decimation / 2
+        if not 0 < low < high < nyquist_after:
+            raise ValueError(
+                f"Band {low}-{high} Hz does not fit below the Nyquist frequency "
+                f"of {nyquist_after} Hz after decimation by {decimation}")
+        if numtaps % 2 == 0:
+            numtaps += 1
+        return firwin(numtaps, [low, high], pass_zero=False, fs=sample_rate)
+
+    @staticmethod
+    def band_limit_and_decimate(signal, storage, sample_rate=SAMPLE_RATE, repetitions=1) -> tuple:
+        """
+        Applies the FIR band-pass and decimation with
+        `scipy.signal.resample_poly`. Every repetition is filtered on its own,
+        so the filter does not smear one repetition into the next and the
+        stored signal still splits into equal repetitions.
+
+        Parameters:
+            signal (np.ndarray): The int16 measurement signal.
+            storage (dict): The storage settings, see the class docstring.
+            sample_rate (int): Sample rate of the signal in Hz.
+            repetitions (int): Number of repetitions in the signal.
+
+        Returns:
+            tuple: (int16 signal, new sample rate, metadata dict for the file)
+        """
+        from scipy.signal import resample_poly
+        decimation = int(storage.get('decimation', 2))
+        band = storage.get('band', [20000, 100000])
+        numtaps = int(storage.get('numtaps', 129))
+        signal = np.asarray(signal)
+        repetitions = max(1, int(repetitions or 1))
+        if decimation < 1 or len(signal) % repetitions != 0 or (len(signal) // repetitions) % decimation != 0:
+            raise ValueError(
+                f"Cannot decimate {len(signal)} samples in {repetitions} repetitions by {decimation}")
+
+        taps = SignalConditioner.design_bandpass(band, numtaps, sample_rate, decimation)
+        segments = signal.astype(np.float64).reshape(repetitions, -1)
+        decimated = resample_poly(segments, 1, decimation, axis=1, window=taps)
+        decimated = np.clip(np.round(decimated), -32768, 32767).astype(np.int16).reshape(-1)
+
+        metadata = {
+            "storage_mode": STORAGE_MODE_BANDPASS_DECIMATE,
+            "original_sample_rate": int(sample_rate),
+            "sample_rate": int(sample_rate // decimation),
+            "decimation": decimation,
+            "repetitions": repetitions,
+            "filter": {
+                "type": "firwin_bandpass",
+                "band_hz": [float(band[0]), float(band[1])],
+                "numtaps": int(len(taps)),
+                "window": "hamming",
+            },
+        }
+        return decimated, int(sample_rate // decimation), metadata
+
+
+def compare_in_band_spectra(full_rate, full_rate_sample_rate, decimated, decimated_sample_rate, band) -> dict:
+    """
+    Compares the amplitude spectra of a full-rate and a decimated signal
+    within a band. Both spectra are in amplitude per Hz, so they are
+    comparable despite the different lengths.
+
+    Returns:
+        dict: max and rms error in dB, and the energy ratio in the band.
+    """
+    def amplitude_spectrum(x, fs):
+        spectrum = np.abs(np.fft.rfft(x - np.mean(x))) / fs
+        return np.fft.rfftfreq(len(x), d=1 / fs), spectrum
+
+    freqs_full, spectrum_full = amplitude_spectrum(np.asarray(full_rate, dtype=np.float64), full_rate_sample_rate)
+    freqs_dec, spectrum_dec = amplitude_spectrum(np.asarray(decimated, dtype=np.float64), decimated_sample_rate)
+    in_band = (freqs_dec >= band[0]) & (freqs_dec <= band[1])
+    reference = np.interp(freqs_dec[in_band], freqs_full, spectrum_full)
+    error_db = 20 * np.log10(np.maximum(spectrum_dec[in_band], 1e-12) / np.maximum(reference, 1e-12))
+    return {
+        "max_error_db": float(np.max(np.abs(error_db))),
+        "rms_error_db": float(np.sqrt(np.mean(error_db ** 2))),
+        "energy_ratio": float(np.sum(spectrum_dec[in_band] ** 2) / np.sum(reference ** 2)),
+    }
+
+
+if __name__ == "__main__":
+    # Accuracy check against the full-rate spectrum: a 20-100 kHz chirp with
+    # noise, 10 repetitions of 50 ms, decimated by 2 and by 4 (band limited
+    # to what fits below the new Nyquist frequency).
+    from scipy.signal import chirp
+
+    rng = np.random.default_rng(0)
+    t = np.arange(25000) / SAMPLE_RATE
+    repetition = 12000 * chirp(t, f0=20000, t1=t[-1], f1=100000)
+    signal = np.tile(repetition, 10) + rng.normal(0, 200, 250000)
+    signal = np.clip(np.round(signal), -32768, 32767).astype(np.int16)
+
+    checks = [
+        ({"mode": STORAGE_MODE_BANDPASS_DECIMATE, "decimation": 2, "band": [20000, 100000]}, (25000, 95000)),
+        ({"mode": STORAGE_MODE_BANDPASS_DECIMATE, "decimation": 4, "band": [20000, 55000]}, (25000, 50000)),
+    ]
+    failed = False
+    for storage, check_band in checks:
+        decimated, new_rate, metadata = SignalConditioner.band_limit_and_decimate(
+            signal, storage, repetitions=10)
+        result = compare_in_band_spectra(signal, SAMPLE_RATE, decimated, new_rate, check_band)
+        # The in-band spectrum may only deviate by the filter ripple and the
+        # int16 rounding; the band energy has to be preserved within 5%.
+        passed = result["rms_error_db"] < 0.5 and abs(result["energy_ratio"] - 1) < 0.05
+        failed |= not passed
+        print(f"decimation {metadata['decimation']}: {len(signal)} -> {len(decimated)} samples, "
+              f"rms error {result['rms_error_db']:.3f} dB, max error {result['max_error_db']:.2f} dB, "
+              f"energy ratio {result['energy_ratio']:.4f} {'OK' if passed else 'FAILED'}")
+    raise SystemExit(1 if failed else 0)
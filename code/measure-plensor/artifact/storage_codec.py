@@ -0,0 +1,301 @@
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Supported storage formats and their file extension
+FORMAT_EXTENSIONS = {
+    'flac': '.flac',
+    'wav': '.wav',
+    'npy': '.npy',
+    'container': '.flac',
+}
+SUBTYPES = ('PCM_16', 'PCM_24')
+
+
+class StorageCodec:
+    """
+    StorageCodec encodes a time domain measurement to a file in one of the
+    supported storage formats:
+
+        - flac: lossless FLAC, `compression_level` from 0.0 (fastest) to
+          1.0 (smallest), as supported by soundfile/libsndfile.
+        - wav: uncompressed WAV, for deployments where CPU is the bottleneck.
+        - npy: raw int16 samples, the cheapest format for a hot tier that
+          is processed soon after. The sample rate and metadata are stored
+          in a `.json` sidecar next to the `.npy` file.
+        - container: appended as FLAC block to the per-day container of the
+          sensor (see MeasurementContainer in process-data) instead of a
+          file per measurement. The filename becomes the record name.
+
+    `subtype` selects PCM_16 or PCM_24 for flac and wav. Files are written
+    under a temporary name and renamed when complete, so the processing
+    loop never picks up a partial file.
+    """
+
+    def __init__(self, format='flac', subtype='PCM_16', compression_level=None):
+        if format not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unknown storage format: {format}")
+        if subtype not in SUBTYPES:
+            raise ValueError(f"Unknown subtype: {subtype}")
+        if compression_level is not None and not 0.0 <= compression_level <= 1.0:
+            raise ValueError("compression_level must be between 0.0 and 1.0")
+        self.format = format
+        self.subtype = subtype
+        self.compression_level = compression_level
+        self._container_writer = None
+
+    @classmethod
+    def from_settings(cls, settings) -> 'StorageCodec':
+        """
+        Creates a codec from a `storage_codec` settings dict, e.g.
+        {"format": "flac", "subtype": "PCM_16", "compression_level": 0.2}.
+        """
+        settings = settings or {}
+        return cls(
+            format=settings.get('format', 'flac'),
+            subtype=settings.get('subtype', 'PCM_16'),
+            compression_level=settings.get('compression_level'))
+
+    @property
+    def extension(self) -> str:
+        return FORMAT_EXTENSIONS[self.format]
+
+    def with_extension(self, filepath) -> str:
+        """
+        Returns `filepath` with the extension of this codec.
+        """
+        return os.path.splitext(filepath)[0] + self.extension
+
+    def encode(self, filepath, signal, sample_rate, metadata=None) -> str:
+        """
+        Encodes a signal to `filepath` (with the extension of the codec).
+
+        Parameters:
+            filepath (str): Path of the file, the extension is replaced.
+            signal (np.ndarray): The samples, int16 (or int32 for PCM_24).
+            sample_rate (int): Sample rate in Hz.
+            metadata (dict): Metadata stored in the FLAC/WAV comment or the
+                npy sidecar.
+
+        Returns:
+            str: The path of the written file.
+        """
+        import numpy as np
+        filepath = self.with_extension(filepath)
+        if self.format == 'container':
+            return self._append_to_container(filepath, signal, sample_rate)
+        tmp_path = f"{filepath}.part"
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        if self.format == 'npy':
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(signal, dtype=np.int16))
+            sidecar = {"sample_rate": int(sample_rate), **(metadata or {})}
+            with open(f"{filepath}.json.part", 'w') as f:
+                json.dump(sidecar, f)
+            os.replace(f"{filepath}.json.part", f"{filepath}.json")
+        else:
+            import soundfile as sf
+            extra = {}
+            if self.format == 'flac' and self.compression_level is not None:
+                extra['compression_level'] = self.compression_level
+            with sf.SoundFile(tmp_path, 'w', samplerate=sample_rate, channels=1,
+                              format=self.format.upper(), subtype=self.subtype, **extra) as f:
+                if metadata:
+                    f.comment = json.dumps(metadata)
+                f.write(signal)
+        os.replace(tmp_path, filepath)
+        return filepath
+
+    def _append_to_container(self, filepath, signal, sample_rate) -> str:
+        """
+        Appends a measurement to its per-day container, the containers are
+        kept open by the codec between measurements. The containers are
+        stored next to the raw measurement directory, in `containers/`. The
+        sample rate is kept in the container index, other metadata is not.
+
+        Returns:
+            str: The source id of the record.
+        """
+        if self._container_writer is None:
+            sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'process-data', 'artifact'))
+            from MeasurementContainer import ContainerWriter
+            self._container_writer = ContainerWriter(
+                os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(filepath))), 'containers'))
+        return self._container_writer.append(os.path.basename(filepath), signal, sample_rate)
+
+    def close(self) -> None:
+        """
+        Closes the containers kept open by the codec.
+        """
+        if self._container_writer is not None:
+            self._container_writer.close()
+
+    @staticmethod
+    def decode(filepath, dtype='int16') -> tuple:
+        """
+        Decodes a file written by any of the codecs.
+
+        Returns:
+            tuple: (samples, sample rate)
+        """
+        if filepath.endswith('.npy'):
+            import numpy as np
+            with open(f"{filepath}.json") as f:
+                sample_rate = json.load(f)["sample_rate"]
+            return np.load(filepath).astype(dtype, copy=False), sample_rate
+        import soundfile as sf
+        return sf.read(filepath, dtype=dtype)
+
+
+class StorageWriter:
+    """
+    StorageWriter encodes measurements in a pool of worker threads, so the
+    measurement loop can move on to the next bus command while the previous
+    file is compressed. libsndfile releases the GIL while encoding, so the
+    workers run in parallel on the cores of the Pi.
+
+    At most `max_pending` encodes are queued; `submit` blocks beyond that,
+    which bounds the memory held by unwritten measurements. With a
+    `catalog` (MeasurementCatalog in process-data), every written file is
+    added to the catalog. With a `publisher` (EventPublisher in
+    process-data), a "measurement completed" event is published for every
+    written file that was submitted with event fields.
+
+    With a `runs` manifest (RunManifest in process-data), the run of an
+    event with a `run_id` is recorded as done once its file is written, or
+    as failed if encoding failed.
+
+    With a `staging` tier (StagingTier in process-data), files are encoded
+    to RAM and cataloged and announced once the tier has flushed them to
+    persistent storage. Container records are appended in place.
+    """
+
+    def __init__(self, logger, codec=None, workers=2, max_pending=8, catalog=None, publisher=None, staging=None,
+                 runs=None):
+        self.logger = logger
+        self.codec = codec or StorageCodec()
+        self.catalog = catalog
+        self.publisher = publisher
+        self.runs = runs
+        self.staging = staging
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='storage')
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.settings = None
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def configure(self, settings) -> None:
+        """
+        Switches to the codec of a `storage_codec` settings dict, if the
+        settings changed. Encodes that are already queued keep their codec.
+        """
+        settings = settings or {}
+        if settings == self.settings:
+            return
+        try:
+            codec = StorageCodec.from_settings(settings)
+        except ValueError as e:
+            self.logger.log_error(f"Invalid storage codec settings {settings}: {e}")
+            return
+        self.flush()
+        self.codec.close()
+        self.codec = codec
+        self.settings = settings
+
+    def submit(self, filepath, signal, sample_rate, metadata=None, event=None):
+        """
+        Queues a measurement for encoding.
+
+        Parameters:
+            event (dict): Fields of the "measurement completed" event that is
+                published once the file is written (sensor, command, timings).
+
+        Returns:
+            Future: Resolves to the written path, or None if encoding failed.
+        """
+        self.pending.acquire()
+        future = self.executor.submit(self._encode, self.codec, filepath, signal, sample_rate, metadata, event)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _encode(self, codec, filepath, signal, sample_rate, metadata, event=None):
+        encode_started = time.time()
+        staging = self.staging if codec.format != 'container' else None
+        try:
+            path = codec.encode(staging.stage_path(filepath) if staging else filepath, signal, sample_rate, metadata)
+        except Exception as e:
+            self.logger.log_error(f"Error encoding {filepath}: {e}")
+            if self.runs is not None and event is not None:
+                self.runs.fail(event.get("run_id"), f"Error encoding: {e}")
+            return None
+        name = os.path.basename(codec.with_extension(filepath))
+        if staging is None:
+            self._written(path, name, sample_rate, encode_started, event)
+            return path
+        if codec.format == 'npy':
+            staging.commit(f"{path}.json")
+        return staging.commit(
+            path, callback=lambda final_path: self._written(final_path, name, sample_rate, encode_started, event))
+
+    def _written(self, path, name, sample_rate, encode_started, event):
+        """
+        Catalogs a written file and publishes its event.
+        """
+        if self.catalog is not None:
+            # Container records are cataloged under the name of the file
+            self.catalog.add(path, name=name)
+        if self.runs is not None and event is not None:
+            self.runs.done(event.get("run_id"), path)
+        if self.publisher is not None and event is not None:
+            try:
+                from MeasurementEvents import MEASUREMENT_COMPLETED
+                self.publisher.publish(
+                    MEASUREMENT_COMPLETED, path=path, sample_rate=int(sample_rate),
+                    encode_started=encode_started, written_at=time.time(), **event)
+            except Exception as e:
+                self.logger.log_error(f"Error publishing the event of {path}: {e}")
+
+    def announce(self, path, sample_rate, started, event=None) -> None:
+        """
+        Catalogs a file that was written outside the writer pool, e.g. a
+        long acquisition, and publishes its event.
+        """
+        self._written(path, os.path.basename(path), sample_rate, started, event)
+
+    def recovered(self, path) -> None:
+        """
+        Catalogs a file that a previous process of the service measured and
+        staged, once it is flushed (see StagingTier.recover), and records
+        its run as done. Its event is not published again, the GUIs that
+        waited on it find the run in the run manifest.
+        """
+        if self.runs is None or not self.runs.written(path):
+            return
+        if self.catalog is not None:
+            self.catalog.add(path)
+
+    def _done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.pending.release()
+
+    def flush(self) -> None:
+        """
+        Waits until all queued encodes are written.
+        """
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        """
+        Writes all queued encodes and stops the workers.
+        """
+        self.executor.shutdown(wait=True)
+        self.codec.close()
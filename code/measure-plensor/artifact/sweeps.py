@@ -0,0 +1,153 @@
+import time
+
+POINT_SWEEP = 'POINT_SWEEP'
+SEGMENT_SWEEP = 'SEGMENT_SWEEP'
+SINGLE_SWEEP = 'SINGLE_SWEEP'
+DAMPING_SWEEP = 'DAMPING_SWEEP'
+TOF_SWEEP = 'TOF_SWEEP'
+SWEEP_TYPES = (POINT_SWEEP, SEGMENT_SWEEP, SINGLE_SWEEP, DAMPING_SWEEP, TOF_SWEEP)
+
+# Maximum TOF timeout of the firmware in microseconds
+MAX_TOF_TIMEOUT_US = 1000
+
+
+def block_sine_settings(command, duration, start_frequency, stop_frequency, damping_level, repetitions) -> dict:
+    return {
+        "type": "measure",
+        "command": command,
+        "duration": duration,
+        "start_frequency": start_frequency,
+        "stop_frequency": stop_frequency,
+        "damping_level": damping_level,
+        "repetitions": repetitions
+    }
+
+
+def tof_settings(timeout_us, repetitions, tof_half_periods, damping_level) -> dict:
+    return {
+        "type": "measure",
+        "command": "TOF_BLOCK",
+        "timeout_duration": min(timeout_us, MAX_TOF_TIMEOUT_US),
+        "tof_half_periods": tof_half_periods,
+        "repetitions": repetitions,
+        "damping_level": damping_level
+    }
+
+
+def _steps(sweep_type, config) -> range:
+    """
+    Returns the range a sweep steps through (frequency, damping level or
+    half periods), with an exclusive stop as in ComplexInterrupt.
+    """
+    if sweep_type == POINT_SWEEP:
+        return range(config["start_frequency"], config["stop_frequency"], config["step_frequency"])
+    if sweep_type == SEGMENT_SWEEP:
+        return range(config["start_frequency"], config["stop_frequency"], config["sweep_frequency"])
+    if sweep_type == SINGLE_SWEEP:
+        return range(config["start_frequency"], config["stop_frequency"], config["stop_frequency"] - config["start_frequency"])
+    if sweep_type == DAMPING_SWEEP:
+        return range(config["damping_level_start"], config["damping_level_stop"], config["damping_level_step"])
+    if sweep_type == TOF_SWEEP:
+        return range(config["tof_half_periods_start"], config["tof_half_periods_stop"], config["tof_half_periods_step"])
+    raise ValueError(f"Unknown sweep type: {sweep_type}")
+
+
+def sweep_runs(sweep_type, config):
+    """
+    Expands a sweep into the measurement settings of its runs, one at a
+    time. The runs are the same as the messages of the get_*_runs
+    functions of ComplexInterrupt.
+
+    Parameters:
+        sweep_type (str): One of SWEEP_TYPES.
+        config (dict): The sweep configuration, with the keys of the
+            measurement template of the handheld interface.
+
+    Yields:
+        dict: The measurement settings of the next run.
+    """
+    for step in _steps(sweep_type, config):
+        if sweep_type == POINT_SWEEP:
+            yield block_sine_settings(
+                config["command"], int(1000000 / step * config["number_of_wavelengths"]), step, step,
+                config["damping_level"], config["repetitions"])
+        elif sweep_type in (SEGMENT_SWEEP, SINGLE_SWEEP):
+            width = config["sweep_frequency"] if sweep_type == SEGMENT_SWEEP else config["stop_frequency"] - config["start_frequency"]
+            yield block_sine_settings(
+                config["command"], config["duration_us"], step, step + width,
+                config["damping_level"], config["repetitions"])
+        elif sweep_type == DAMPING_SWEEP:
+            yield block_sine_settings(
+                config["command"], config["duration_us"], config["frequency"], config["frequency"],
+                step, config["repetitions"])
+        else:
+            yield tof_settings(config["timeout_us"], config["repetitions"], step, config["damping_level"])
+
+
+class Sweep:
+    """
+    Sweep is a compact sweep descriptor in the measurement queue, expanded
+    into its runs one at a time by the measure service, e.g.:
+
+        {"sensor_id": 122, "measurement_settings": {
+            "type": "sweep", "sweep_type": "POINT_SWEEP", "sweep_id": "point-122",
+            "sweep_configuration": {"start_frequency": 20000, "stop_frequency": 100000,
+                                    "step_frequency": 1000, "number_of_wavelengths": 200,
+                                    "repetitions": 1, "damping_level": 0, "command": "SINE"}}}
+
+    The descriptor stays at the front of the queue until its last run is
+    taken, so only one run exists as a message at a time. A sweep can be
+    cancelled between two runs; `progress` reports the runs done. With a
+    `run_id` on the descriptor, its runs get run ids `<run_id>.<n>`.
+    """
+
+    def __init__(self, message):
+        settings = message["measurement_settings"]
+        if settings["sweep_type"] not in SWEEP_TYPES:
+            raise ValueError(f"Unknown sweep type: {settings['sweep_type']}")
+        self.sensor_id = message["sensor_id"]
+        self.sweep_type = settings["sweep_type"]
+        self.sweep_id = settings["sweep_id"]
+        self.run_id = message.get("run_id")
+        self.total = len(_steps(self.sweep_type, settings["sweep_configuration"]))
+        self.runs = sweep_runs(self.sweep_type, settings["sweep_configuration"])
+        self.done = 0
+        self.taken = 0
+        self.status = 'running'
+        self.started_at = time.time()
+
+    def next_message(self):
+        """
+        Returns the message of the next run, or None when the sweep is
+        finished or cancelled.
+        """
+        if self.status != 'running':
+            return None
+        settings = next(self.runs, None)
+        if settings is None:
+            self.status = 'finished'
+            return None
+        message = {"sensor_id": self.sensor_id, "measurement_settings": settings, "sweep_id": self.sweep_id}
+        if self.run_id is not None:
+            message["run_id"] = f"{self.run_id}.{self.taken}"
+            message["parent_run_id"] = self.run_id
+        self.taken += 1
+        return message
+
+    def run_done(self) -> None:
+        self.done += 1
+
+    def cancel(self) -> None:
+        if self.status == 'running':
+            self.status = 'cancelled'
+
+    def progress(self) -> dict:
+        return {
+            "sweep_id": self.sweep_id,
+            "sweep_type": self.sweep_type,
+            "sensor_id": self.sensor_id,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "elapsed_s": round(time.time() - self.started_at, 3),
+        }
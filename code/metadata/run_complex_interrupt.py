@@ -99,6 +99,18 @@ def get_damping_runs(frequency = 20000, repetitions = 1, duration_us = 50000, da
 
     return runs
 
+def get_sweep(sweep_type, sweep_configuration, sweep_id = None) -> dict:
+    """
+    Get a compact sweep descriptor, expanded into its runs by the measure
+    service one run at a time (see sweeps.py in measure-plensor). The sweep
+    configuration takes the keyword arguments of the matching get_*_runs
+    function: POINT_SWEEP, SEGMENT_SWEEP, SINGLE_SWEEP, DAMPING_SWEEP or TOF_SWEEP.
+    """
+    settings = {"type": "sweep", "sweep_type": sweep_type, "sweep_configuration": sweep_configuration}
+    if sweep_id is not None:
+        settings["sweep_id"] = sweep_id
+    return {"sensor_id": MEASURING_DEVICE_ID, "measurement_settings": settings}
+
 def get_TOF_runs(timeout_us = 1000, repetitions = 5, tof_half_periods_start = 1, tof_half_periods_stop = 15, tof_half_periods_step = 1, damping_level = 0):
     """
     Get the TOF runs.
@@ -116,7 +128,8 @@ if __name__ == "__main__":
     #runs.extend(get_single_frequency_runs(start_freq = 20000, stop_freq = 100000, step_freq = 1000, repetitions = 1, number_of_wavelengths = 200, damping_level = 0, command = "SINE"))
     #runs.extend(get_linear_sweep_runs(start_freq = 20000, stop_freq = 100000, sweep_freq = 10000, repetitions = 1, duration_us = 50000, damping_level = 0, command = "SINE"))
     #runs.extend(get_damping_runs(frequency = 20000, repetitions = 1, duration_us = 10000, damping_level_start = 0, damping_level_stop = 100, damping_level_step = 10, command = "SINE"))
-    runs.extend(get_TOF_runs(timeout_us = 1000, repetitions = 5, tof_half_periods_start = 1, tof_half_periods_stop = 15, tof_half_periods_step = 1, damping_level = 0))
+    # runs.extend(get_TOF_runs(timeout_us = 1000, repetitions = 5, tof_half_periods_start = 1, tof_half_periods_stop = 15, tof_half_periods_step = 1, damping_level = 0))
+    runs.append(get_sweep("TOF_SWEEP", {"timeout_us": 1000, "repetitions": 5, "tof_half_periods_start": 1, "tof_half_periods_stop": 15, "tof_half_periods_step": 1, "damping_level": 0}))
     runs.extend(iterate_single_frequency_runs(run_frequency = 20000, iterations = 100, number_of_wavelengths = 200, repetitions = 1, damping_level = 0, command = "SINE"))
 
     with open(JSON_FILE_PATH, "w") as f:
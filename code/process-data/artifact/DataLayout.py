@@ -0,0 +1,231 @@
+"""
+Sharded directory layout of the measurement files.
+
+Every kind of measurement file (raw, processed, previews) has its own root
+directory. Below it, files are stored per day and sensor:
+
+    <root>/<yyyy>/<mm>/<dd>/<sensor_id:05d>/<filename>
+
+The day and sensor come from the filename, so the path of a file follows
+from its name alone and every writer and reader resolves paths with
+`measurement_path`. A directory holds the files of one sensor on one day,
+so listing, creating and removing files costs O(files per day) instead of
+O(all files ever). Names that are not measurement names stay in the root.
+
+Files written before the sharded layout are in the root itself. They are
+still found by `list_measurement_files`, and `migrate` moves them into
+their shard in place.
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+
+from MeasurementContainer import describe_measurement_name
+
+DATA_ROOT = '/home/plense/plensor_data'
+RAW_DIR = os.path.join(DATA_ROOT, 'audio_data', 'time_domain_not_processed')
+PROCESSED_DIR = os.path.join(DATA_ROOT, 'audio_data', 'time_domain_processed')
+PREVIEW_DIR = os.path.join(DATA_ROOT, 'audio_data', 'previews')
+LONG_DIR = os.path.join(DATA_ROOT, 'audio_data', 'long_acquisition')
+
+# Unfinished files of a writer, never moved by the migration
+PARTIAL_SUFFIXES = ('.part', '.tmp')
+
+
+def shard_dir(root, sensor_id, timestamp) -> str:
+    """
+    Returns the shard of a sensor on the day of `timestamp` (epoch seconds).
+    """
+    day = datetime.fromtimestamp(timestamp)
+    return os.path.join(root, f"{day:%Y}", f"{day:%m}", f"{day:%d}", f"{int(sensor_id):05d}")
+
+
+def measurement_path(root, filename) -> str:
+    """
+    Returns the path of a measurement file (or preview sidecar) in the
+    sharded layout below `root`, or `<root>/<filename>` if the filename is
+    not a measurement name.
+    """
+    try:
+        fields = describe_measurement_name(filename)
+    except ValueError:
+        return os.path.join(root, filename)
+    return os.path.join(shard_dir(root, fields["sensor_id"], fields["timestamp"]), filename)
+
+
+def in_tree(path, root) -> bool:
+    """
+    Checks whether `path` is in the directory tree of `root`.
+    """
+    return os.path.abspath(path).startswith(os.path.abspath(root).rstrip(os.sep) + os.sep)
+
+
+def day_dirs(root, start=None, end=None) -> list:
+    """
+    Returns the existing day directories below `root`, oldest first,
+    optionally only the days from `start` up to `end` (epoch seconds).
+    Only the year and month directories in the range are listed.
+    """
+    first = datetime.fromtimestamp(start).date() if start is not None else None
+    last = datetime.fromtimestamp(end).date() if end is not None else None
+    days = []
+    for year in _numbered(root, 4):
+        if (first and int(year) < first.year) or (last and int(year) > last.year):
+            continue
+        for month in _numbered(os.path.join(root, year), 2):
+            month_start = datetime(int(year), int(month), 1).date()
+            month_end = (month_start + timedelta(days=31)).replace(day=1)
+            if (first and month_end <= first) or (last and month_start > last):
+                continue
+            for day in _numbered(os.path.join(root, year, month), 2):
+                date = month_start.replace(day=int(day))
+                if (first and date < first) or (last and date > last):
+                    continue
+                days.append(os.path.join(root, year, month, day))
+    return days
+
+
+def _numbered(directory, digits) -> list:
+    try:
+        return sorted(name for name in os.listdir(directory) if len(name) == digits and name.isdigit())
+    except FileNotFoundError:
+        return []
+
+
+def list_measurement_files(root, start=None, end=None, sensor_id=None, suffixes=None, include_flat=True) -> list:
+    """
+    Returns the paths of the measurement files below `root`, listing only
+    the shards of the days from `start` up to `end` (epoch seconds) and of
+    `sensor_id`. With `include_flat`, files in the root itself (the layout
+    before sharding) are included.
+
+    Parameters:
+        suffixes (tuple): If given, only files with these suffixes.
+
+    Returns:
+        list: The paths, sorted by filename within a shard.
+    """
+    def matches(name):
+        return not name.endswith(PARTIAL_SUFFIXES) and (suffixes is None or name.endswith(suffixes))
+
+    paths = []
+    for day in day_dirs(root, start, end):
+        sensors = [f"{int(sensor_id):05d}"] if sensor_id is not None else _numbered(day, 5)
+        for sensor in sensors:
+            try:
+                names = sorted(os.listdir(os.path.join(day, sensor)))
+            except FileNotFoundError:
+                continue
+            paths.extend(os.path.join(day, sensor, name) for name in names if matches(name))
+    if include_flat:
+        paths.extend(path for path in _flat_files(root) if matches(os.path.basename(path)))
+    return paths
+
+
+def _flat_files(root) -> list:
+    try:
+        with os.scandir(root) as entries:
+            return sorted(entry.path for entry in entries if entry.is_file(follow_symlinks=False))
+    except FileNotFoundError:
+        return []
+
+
+def prune_empty_shards(directory) -> None:
+    """
+    Removes a sensor shard and its day, month and year directories while
+    they are empty, after the last file of the shard was removed. Does
+    nothing for a directory that is not a shard.
+    """
+    directory = os.path.abspath(directory)
+    for digits in (5, 2, 2, 4):
+        name = os.path.basename(directory)
+        if len(name) != digits or not name.isdigit():
+            return
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+def migrate(root, catalog=None, manifest=None, logger=None, limit=None) -> dict:
+    """
+    Moves the files in the root of a measurement directory into their shard.
+
+    Each file is first updated in the catalog and the processing manifest
+    and then renamed, so an interrupted migration continues where it
+    stopped when it is run again: moved files are no longer in the root,
+    and the path updates of a file that was not renamed yet are no-ops.
+    The `.json` sidecar of a `.npy` file moves with it.
+
+    Parameters:
+        root (str): Root of the measurement directory.
+        catalog (MeasurementCatalog): Catalog to update the paths in.
+        manifest (ProcessingManifest): Manifest to update the source and
+            output paths in.
+        limit (int): Maximum number of files to move in this run.
+
+    Returns:
+        dict: The number of moved and skipped files.
+    """
+    root = root.rstrip(os.sep)
+    moved, skipped = 0, 0
+    started = time.monotonic()
+    for path in _flat_files(root):
+        name = os.path.basename(path)
+        if name.endswith(PARTIAL_SUFFIXES) or name.endswith('.npy.json'):
+            continue
+        target = measurement_path(root, name)
+        if os.path.dirname(target) == root:
+            skipped += 1
+            continue
+        if os.path.exists(target):
+            # Written again in the sharded layout, keep the existing file
+            if logger is not None:
+                logger.log_error(f"Not migrating {path}, {target} exists")
+            skipped += 1
+            continue
+        if catalog is not None:
+            catalog.move(path, target)
+        if manifest is not None:
+            manifest.move(path, target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if name.endswith('.npy') and os.path.exists(f"{path}.json"):
+            os.rename(f"{path}.json", f"{target}.json")
+        os.rename(path, target)
+        moved += 1
+        if moved % 1000 == 0:
+            print(f"{root}: moved {moved} files in {time.monotonic() - started:.0f} s")
+        if limit is not None and moved >= limit:
+            break
+    return {"moved": moved, "skipped": skipped}
+
+
+if __name__ == "__main__":
+    import argparse
+    from MeasurementCatalog import MeasurementCatalog
+    from ProcessingManifest import ProcessingManifest
+
+    parser = argparse.ArgumentParser(description="Sharded measurement directory layout")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help="move flat measurement files into their shard")
+    migrate_parser.add_argument('roots', nargs='*', default=[RAW_DIR, PROCESSED_DIR, PREVIEW_DIR])
+    migrate_parser.add_argument('--limit', type=int, help="maximum number of files to move per root")
+    path_parser = subparsers.add_parser('path', help="print the sharded path of a filename")
+    path_parser.add_argument('filename')
+    path_parser.add_argument('--root', default=RAW_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'path':
+        print(measurement_path(args.root, args.filename))
+    else:
+        catalog = MeasurementCatalog.get_instance()
+        manifest = ProcessingManifest.get_instance()
+        for root in args.roots:
+            start = time.monotonic()
+            result = migrate(root, catalog=catalog, manifest=manifest, limit=args.limit)
+            print(f"{root}: moved {result['moved']}, skipped {result['skipped']} files "
+                  f"in {time.monotonic() - start:.1f} s")
+        catalog.close()
+        manifest.close()
@@ -0,0 +1,171 @@
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from ErrorLogger import ErrorLogger
+from xedge_plense_tools import LocalDataLoader_edge, SignalOperator_edge
+
+
+class FeatureTable:
+    """
+    FeatureTable stores the acoustic feature vector of every processed
+    measurement as one row in a SQLite table, with one typed column per
+    feature. It replaces the per-metric JSON files and makes trend queries
+    over a sensor and time range a single indexed query.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, db_path='/home/plense/plensor_data/index/features.db'):
+        if cls._instance is None:
+            cls._instance = cls(db_path)
+        return cls._instance
+
+    def __init__(self, db_path='/home/plense/plensor_data/index/features.db', bands=SignalOperator_edge.FEATURE_BANDS):
+        """
+        Opens (and if needed creates) the feature table.
+
+        Parameters:
+            db_path (str): Path to the SQLite feature database.
+            bands (tuple): Band power ranges, see `SignalOperator_edge._extract_features`.
+        """
+        if self._instance is not None:
+            raise Exception("FeatureTable is a singleton!")
+        self.logger = ErrorLogger.get_instance()
+        self.bands = bands
+        self.feature_columns = SignalOperator_edge._feature_columns(bands)
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.create_table()
+
+    def create_table(self):
+        """
+        Creates the features table, and adds columns for features that were
+        added to the feature vector after the table was created.
+        """
+        feature_definitions = ", ".join(f"{column} REAL" for column in self.feature_columns)
+        with self.lock, self.connection:
+            self.connection.execute(f"""
+                CREATE TABLE IF NOT EXISTS features (
+                    source_file TEXT PRIMARY KEY,
+                    meas_id TEXT,
+                    sensor_id INTEGER,
+                    timestamp REAL,
+                    sample_rate INTEGER,
+                    num_samples INTEGER,
+                    {feature_definitions},
+                    created_at REAL
+                )""")
+            existing = {row[1] for row in self.connection.execute("PRAGMA table_info(features)")}
+            for column in self.feature_columns:
+                if column not in existing:
+                    self.connection.execute(f"ALTER TABLE features ADD COLUMN {column} REAL")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_features_sensor_time ON features(sensor_id, timestamp)")
+
+    def extract_and_add(self, source_file, signal, sample_rate=500000, segments=10):
+        """
+        Extracts the feature vector of a signal and stores it.
+
+        Parameters:
+            source_file (str): The measurement file the signal was read from.
+            signal (np.ndarray): The measurement signal.
+            sample_rate (int): Sample rate of the signal in Hz.
+            segments (int): Number of segments for the per-segment variance.
+
+        Returns:
+            dict: The features, or None if extraction failed.
+        """
+        try:
+            features = SignalOperator_edge._extract_features(
+                signal, sample_rate=sample_rate, bands=self.bands, segments=segments)
+            self.add_row(source_file, features, sample_rate=sample_rate, num_samples=len(signal))
+            return features
+        except Exception as e:
+            self.logger.log_error(f"Error extracting features for {source_file}: {e}")
+            return None
+
+    def add_row(self, source_file, features, sample_rate=None, num_samples=None):
+        """
+        Stores the features of one measurement, replacing an existing row for
+        the same file.
+
+        Parameters:
+            source_file (str): The measurement file the features belong to.
+            features (dict): The features, keyed by column name.
+            sample_rate (int): Sample rate of the measurement.
+            num_samples (int): Number of samples in the measurement.
+        """
+        file_metadata = LocalDataLoader_edge.interpret_measurementfile_basename(source_file) or {}
+        sensor_id = file_metadata.get("sensor_id")
+        record_datetime = file_metadata.get("datetime")
+        columns = ["source_file", "meas_id", "sensor_id", "timestamp",
+                   "sample_rate", "num_samples", *self.feature_columns, "created_at"]
+        values = [
+            os.path.basename(source_file),
+            file_metadata.get("meas_id"),
+            LocalDataLoader_edge.plensor_id_str_to_int(sensor_id) if sensor_id else None,
+            record_datetime.timestamp() if record_datetime else None,
+            sample_rate,
+            num_samples,
+            *[features.get(column) for column in self.feature_columns],
+            time.time(),
+        ]
+        placeholders = ", ".join("?" for _ in columns)
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO features ({', '.join(columns)}) VALUES ({placeholders})",
+                values)
+
+    def query(self, columns=None, sensor_id=None, start=None, end=None, meas_id=None):
+        """
+        Queries the feature table and returns the result column-wise.
+
+        Parameters:
+            columns (list): Feature columns to return, defaults to all features.
+            sensor_id (int): Only return rows of this sensor.
+            start (float): Only return rows at or after this epoch timestamp.
+            end (float): Only return rows before this epoch timestamp.
+            meas_id (str): Only return rows of this measurement identifier.
+
+        Returns:
+            dict: Column name -> np.ndarray, including 'sensor_id' and 'timestamp'.
+        """
+        columns = list(columns or self.feature_columns)
+        for column in columns:
+            if column not in self.feature_columns:
+                raise ValueError(f"Unknown feature column: {column}")
+        conditions, parameters = [], []
+        if sensor_id is not None:
+            conditions.append("sensor_id = ?")
+            parameters.append(sensor_id)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(end)
+        if meas_id is not None:
+            conditions.append("meas_id = ?")
+            parameters.append(meas_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        selected = ["sensor_id", "timestamp", *columns]
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(selected)} FROM features {where} ORDER BY timestamp",
+                parameters).fetchall()
+        if not rows:
+            return {column: np.array([]) for column in selected}
+        data = np.array(rows, dtype=np.float64)
+        return {column: data[:, i] for i, column in enumerate(selected)}
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,376 @@
+import os
+import sqlite3
+import threading
+import time
+
+from DataLayout import PROCESSED_DIR, RAW_DIR
+from MeasurementContainer import (
+    DEFAULT_CONTAINER_ROOT, MeasurementContainer, describe_measurement_name, is_source_id,
+    list_containers, parse_source_id, source_id)
+
+DEFAULT_CATALOG_DB = '/home/plense/plensor_data/index/measurement_catalog.db'
+MEASUREMENT_SUFFIXES = ('.flac', '.wav', '.npy')
+
+# Length of the measurement identifier before the '#', processed files have
+# "24" appended to it
+PROCESSED_IDENTIFIER_LENGTH = 24
+
+# Columns that can be filtered on with an equality in `find`
+SWEEP_FIELDS = ('command', 'start_frequency', 'stop_frequency', 'damping_level', 'duration_us', 'repetitions')
+
+
+class MeasurementCatalog:
+    """
+    MeasurementCatalog indexes every BLOCK/SINE measurement by the metadata
+    in its filename (sensor id, timestamp, command, start/stop frequency,
+    damping level, duration, repetitions) together with its path, directory
+    and size, so measurements can be found with an indexed query instead of
+    listing directories and parsing names.
+
+    The measure service adds a file when the storage writer has written it,
+    the processing service adds the processed file and removes the raw file
+    it deletes. Container records are cataloged under their source id.
+    `backfill` indexes existing directories. The `id` column increases with
+    every added file, so a consumer can follow new files with `after_id`.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, db_path=DEFAULT_CATALOG_DB, logger=None):
+        if cls._instance is None:
+            cls._instance = cls(db_path, logger=logger)
+        return cls._instance
+
+    def __init__(self, db_path=DEFAULT_CATALOG_DB, logger=None):
+        if self._instance is not None:
+            raise Exception("MeasurementCatalog is a singleton!")
+        self.logger = logger
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS measurements (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    path TEXT UNIQUE,
+                    name TEXT,
+                    directory TEXT,
+                    sensor_id INTEGER,
+                    timestamp REAL,
+                    command TEXT,
+                    start_frequency INTEGER,
+                    stop_frequency INTEGER,
+                    damping_level INTEGER,
+                    duration_us INTEGER,
+                    repetitions INTEGER,
+                    processed INTEGER,
+                    size INTEGER,
+                    added_at REAL
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_catalog_sensor_time ON measurements(sensor_id, timestamp)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_catalog_time ON measurements(timestamp)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_catalog_sweep "
+                "ON measurements(command, start_frequency, stop_frequency, damping_level)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_catalog_directory ON measurements(directory, id)")
+
+    def log_error(self, message):
+        if self.logger is not None:
+            self.logger.log_error(message)
+        else:
+            print(message)
+
+    @staticmethod
+    def _row(path, name, size):
+        """
+        Builds the catalog row of a measurement file or container record.
+        """
+        name = name or os.path.basename(path)
+        fields = describe_measurement_name(name)
+        directory = os.path.dirname(parse_source_id(path)[0] if is_source_id(path) else path)
+        if size is None and not is_source_id(path):
+            size = os.path.getsize(path)
+        return (
+            path, name, directory, fields["sensor_id"], fields["timestamp"], fields["command"],
+            fields["start_frequency"], fields["stop_frequency"], fields["damping_level"],
+            fields["duration_us"], fields["repetitions"],
+            int(len(name.split('#', 1)[0]) == PROCESSED_IDENTIFIER_LENGTH), size, time.time())
+
+    def add(self, path, name=None, size=None) -> bool:
+        """
+        Adds (or updates) a measurement in the catalog.
+
+        Parameters:
+            path (str): Path of the file, or the source id of a container record.
+            name (str): Measurement filename, defaults to the basename of `path`.
+            size (int): Size in bytes, defaults to the size of the file.
+
+        Returns:
+            bool: True if the measurement was cataloged, else False.
+        """
+        try:
+            row = self._row(path, name, size)
+        except (OSError, ValueError) as e:
+            self.log_error(f"Not cataloging {path}: {e}")
+            return False
+        return self._insert([row]) == 1
+
+    def _insert(self, rows) -> int:
+        with self.lock, self.connection:
+            self.connection.executemany("""
+                INSERT INTO measurements
+                (path, name, directory, sensor_id, timestamp, command, start_frequency, stop_frequency,
+                 damping_level, duration_us, repetitions, processed, size, added_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET size = excluded.size""", rows)
+        return len(rows)
+
+    def remove(self, path) -> None:
+        """
+        Removes a measurement from the catalog.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM measurements WHERE path = ?", (path,))
+
+    def move(self, old_path, new_path) -> None:
+        """
+        Updates the path of a measurement that was moved or renamed.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE measurements SET path = ?, name = ?, directory = ? WHERE path = ?",
+                (new_path, os.path.basename(new_path), os.path.dirname(new_path), old_path))
+
+    def find(self, sensor_id=None, start=None, end=None, directory=None, root=None, processed=None,
+             after_id=None, after=None, limit=None, newest_first=False, **sweep) -> list:
+        """
+        Returns the cataloged measurements matching all given filters.
+
+        Parameters:
+            sensor_id (int): Only measurements of this sensor.
+            start, end (float): Only measurements with start <= timestamp < end
+                (epoch seconds, from the filename).
+            directory (str): Only measurements in this directory.
+            root (str): Only measurements in this directory tree, e.g. all
+                shards of the raw directory (see DataLayout).
+            processed (bool): Only processed (True) or raw (False) measurements.
+            after_id (int): Only measurements added after the one with this id.
+            after (tuple): Only measurements after this (timestamp, path),
+                ordered by timestamp and path, to page through them.
+            limit (int): Maximum number of measurements.
+            newest_first (bool): Order by timestamp descending instead of ascending.
+            **sweep: Equality filters on SWEEP_FIELDS, e.g. command='BLOCK',
+                start_frequency=20000, damping_level=0.
+
+        Returns:
+            list: The measurements as dicts, ordered by timestamp (or by id
+                if `after_id` is given, by timestamp and path if `after` is).
+        """
+        conditions, parameters = [], []
+        for column, value in (('sensor_id', sensor_id), ('directory', directory)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        if root is not None:
+            condition, root_parameters = self._tree_condition(root)
+            conditions.append(condition)
+            parameters.extend(root_parameters)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(end)
+        if processed is not None:
+            conditions.append("processed = ?")
+            parameters.append(int(processed))
+        if after_id is not None:
+            conditions.append("id > ?")
+            parameters.append(after_id)
+        if after is not None:
+            conditions.append("(timestamp > ? OR (timestamp = ? AND path > ?))")
+            parameters.extend((after[0], after[0], after[1]))
+        for column, value in sweep.items():
+            if column not in SWEEP_FIELDS:
+                raise ValueError(f"Unknown catalog filter: {column}")
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+
+        if after_id is not None:
+            order = "id"
+        elif after is not None:
+            order = "timestamp, path"
+        else:
+            order = "timestamp DESC, id DESC" if newest_first else "timestamp, id"
+        query = f"SELECT * FROM measurements WHERE {' AND '.join(conditions) or '1'} ORDER BY {order}"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        return [dict(row) for row in rows]
+
+    def latest(self, n=1, **filters) -> list:
+        """
+        Returns the `n` newest measurements matching the filters of `find`,
+        newest first.
+        """
+        return self.find(limit=n, newest_first=True, **filters)
+
+    @staticmethod
+    def _tree_condition(root) -> tuple:
+        """
+        Returns the condition and parameters that select the directory tree
+        of `root`, as a range on the directory index.
+        """
+        root = root.rstrip('/')
+        return "(directory = ? OR (directory >= ? AND directory < ?))", (root, root + '/', root + '0')
+
+    def total_size(self, directory=None, root=None) -> int:
+        """
+        Returns the total size in bytes of the cataloged measurements,
+        optionally in one directory or directory tree.
+        """
+        if root is not None:
+            condition, parameters = self._tree_condition(root)
+        else:
+            condition, parameters = ("directory = ?", (directory,)) if directory is not None else ("1", ())
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT COALESCE(SUM(size), 0) AS size FROM measurements WHERE {condition}", parameters).fetchone()
+        return row["size"]
+
+    def remove_container(self, container_path) -> None:
+        """
+        Removes all records of a deleted container from the catalog.
+        """
+        prefix = source_id(container_path, 0)[:-6]
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM measurements WHERE path >= ? AND path < ?",
+                (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+
+    def last_id(self) -> int:
+        """
+        Returns the id of the last added measurement, 0 for an empty catalog.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(id) AS id FROM measurements").fetchone()
+        return row["id"] or 0
+
+    def backfill(self, directories=(RAW_DIR, PROCESSED_DIR), container_root=DEFAULT_CONTAINER_ROOT, prune=True) -> dict:
+        """
+        Catalogs the measurement files in the directory trees of
+        `directories` and the records of the containers under
+        `container_root` that are not cataloged yet. With `prune`, catalog
+        entries in these trees whose file no longer exists are removed.
+
+        Returns:
+            dict: The number of added and pruned measurements.
+        """
+        added, pruned = 0, 0
+        for directory in directories:
+            if not os.path.isdir(directory):
+                self.log_error(f"Directory {directory} does not exist.")
+                continue
+            known = self._known_paths(directory, tree=True)
+            rows, present = [], set()
+            for dirpath, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    if not filename.endswith(MEASUREMENT_SUFFIXES):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    present.add(path)
+                    if path in known:
+                        continue
+                    try:
+                        rows.append(self._row(path, filename, None))
+                    except (OSError, ValueError) as e:
+                        self.log_error(f"Not cataloging {path}: {e}")
+            added += self._insert(rows) if rows else 0
+            if prune:
+                pruned += self._delete(known - present)
+
+        for container_path in list_containers(container_root) if container_root else []:
+            known = self._known_paths(os.path.dirname(container_path))
+            rows = []
+            try:
+                container = MeasurementContainer(container_path)
+                for entry in container.entries():
+                    source = source_id(container_path, entry["record"])
+                    if source not in known:
+                        rows.append(self._row(source, container.name(entry["record"]), entry["length"]))
+                container.close()
+            except Exception as e:
+                self.log_error(f"Error cataloging container {container_path}: {e}")
+            added += self._insert(rows) if rows else 0
+        return {"added": added, "pruned": pruned}
+
+    def _known_paths(self, directory, tree=False) -> set:
+        condition, parameters = self._tree_condition(directory) if tree else ("directory = ?", (directory,))
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT path FROM measurements WHERE {condition}", parameters).fetchall()
+        return {row["path"] for row in rows}
+
+    def _delete(self, paths) -> int:
+        if not paths:
+            return 0
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM measurements WHERE path = ?", [(path,) for path in paths])
+        return len(paths)
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description="Measurement catalog")
+    parser.add_argument('--db', default=DEFAULT_CATALOG_DB)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help="catalog existing measurement directories")
+    backfill_parser.add_argument('directories', nargs='*', default=[RAW_DIR, PROCESSED_DIR])
+    backfill_parser.add_argument('--containers', default=DEFAULT_CONTAINER_ROOT)
+    backfill_parser.add_argument('--no-prune', action='store_true')
+    find_parser = subparsers.add_parser('find', help="print the paths of matching measurements")
+    find_parser.add_argument('--sensor', type=int)
+    find_parser.add_argument('--since', help="start time, YYYY-MM-DD[THH:MM:SS]")
+    find_parser.add_argument('--until', help="end time, YYYY-MM-DD[THH:MM:SS]")
+    find_parser.add_argument('--measurement-command', dest='measurement_command', help="BLOCK or SINE")
+    find_parser.add_argument('--start-frequency', type=int)
+    find_parser.add_argument('--stop-frequency', type=int)
+    find_parser.add_argument('--damping-level', type=int)
+    find_parser.add_argument('--processed', action='store_true', default=None)
+    find_parser.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    catalog = MeasurementCatalog.get_instance(args.db)
+    if args.command == 'backfill':
+        result = catalog.backfill(args.directories, container_root=args.containers, prune=not args.no_prune)
+        print(f"Added {result['added']}, pruned {result['pruned']} measurements in {args.db}")
+    else:
+        for measurement in catalog.find(
+                sensor_id=args.sensor,
+                start=datetime.fromisoformat(args.since).timestamp() if args.since else None,
+                end=datetime.fromisoformat(args.until).timestamp() if args.until else None,
+                processed=args.processed, limit=args.limit,
+                command=args.measurement_command, start_frequency=args.start_frequency,
+                stop_frequency=args.stop_frequency, damping_level=args.damping_level):
+            print(measurement["path"])
+    catalog.close()
@@ -0,0 +1,517 @@
+import io
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from bisect import bisect_left
+from datetime import datetime
+
+DEFAULT_CONTAINER_ROOT = '/home/plense/plensor_data/audio_data/containers'
+CONTAINER_SUFFIX = '.plc'
+INDEX_SUFFIX = '.idx'
+# Separator between the container path and the record number in a source id
+SOURCE_SEPARATOR = '::'
+
+DATA_MAGIC = b'PLNSDAT1'
+INDEX_MAGIC = b'PLNSIDX1'
+HEADER_SIZE = 64
+
+# offset, length, timestamp, sensor_id, command, start_frequency,
+# stop_frequency, damping_level, repetitions, duration_us, sample_rate,
+# num_samples, codec, flags, reserved, crc32
+INDEX_ENTRY = struct.Struct('<QIdI8sIIHHIIIBBHI')
+INDEX_FIELDS = (
+    'offset', 'length', 'timestamp', 'sensor_id', 'command', 'start_frequency',
+    'stop_frequency', 'damping_level', 'repetitions', 'duration_us', 'sample_rate',
+    'num_samples', 'codec', 'flags', 'reserved', 'crc32')
+
+CODEC_RAW = 0
+CODEC_FLAC = 1
+
+
+def describe_measurement_name(name) -> dict:
+    """
+    Interprets a BLOCK/SINE measurement filename, e.g.
+    `02000B10000l000d50r010#00122_2025-01-01T120000.flac`, into the fields of
+    a container index entry.
+    """
+    match = re.match(
+        r'^(\d{5})([A-Z])(\d{5})l(\d{3})d(\d{2})r(\d{3})(?:24)?#(\d+)_(\d{4}-\d{2}-\d{2}T\d{6})',
+        os.path.basename(name))
+    if not match:
+        raise ValueError(f"nonvalid measurement file name: {name}")
+    start, command, stop, damping, duration_ms, repetitions, sensor_id, timestamp = match.groups()
+    return {
+        "timestamp": datetime.strptime(timestamp, "%Y-%m-%dT%H%M%S").timestamp(),
+        "sensor_id": int(sensor_id),
+        "command": {'B': 'BLOCK', 'S': 'SINE'}.get(command, command),
+        "start_frequency": int(start) * 10,
+        "stop_frequency": int(stop) * 10,
+        "damping_level": int(damping),
+        "repetitions": int(repetitions),
+        "duration_us": int(duration_ms) * 1000,
+    }
+
+
+def container_path_for(sensor_id, timestamp, root=DEFAULT_CONTAINER_ROOT) -> str:
+    """
+    Returns the container of a sensor on the day of `timestamp`:
+    `<root>/<YYYY-MM-DD>/<sensor_id:05d>.plc`.
+    """
+    day = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+    return os.path.join(root, day, f"{int(sensor_id):05d}{CONTAINER_SUFFIX}")
+
+
+def source_id(container_path, record) -> str:
+    """
+    Returns the id of a container record as used in the processing manifest.
+    """
+    return f"{container_path}{SOURCE_SEPARATOR}{record:06d}"
+
+
+def parse_source_id(source) -> tuple:
+    """
+    Splits a record source id into (container path, record number).
+    """
+    container_path, record = source.rsplit(SOURCE_SEPARATOR, 1)
+    return container_path, int(record)
+
+
+def is_source_id(source) -> bool:
+    return SOURCE_SEPARATOR in source
+
+
+class MeasurementContainer:
+    """
+    MeasurementContainer is an append-only file holding all time domain
+    measurements of one sensor on one day, so a day of measurements takes two
+    files instead of one small FLAC per measurement.
+
+    The data file (`.plc`) holds the records back to back. Every record is
+    the record name (the original FLAC basename) followed by the compressed
+    samples (FLAC, or raw int16). The index file (`.plc.idx`) holds one
+    fixed-size entry per record with its offset, length, timestamp, sensor
+    ID, command, frequencies, damping level, repetitions, duration, sample
+    rate and a CRC32. Record i is found at a fixed position in the index, and
+    both files are memory-mapped, so reading any record is O(1).
+
+    Records are appended data first, index entry second. A crash can only
+    leave a partial record after the last index entry, which is truncated the
+    next time the container is opened for appending.
+    """
+
+    def __init__(self, path, mode='r'):
+        """
+        Opens a container.
+
+        Parameters:
+            path (str): Path of the data file (`.plc`).
+            mode (str): 'r' to read, 'a' to append (creates the container).
+        """
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.mode = mode
+        self.lock = threading.Lock()
+        self._data_map = None
+        self._index_map = None
+        if mode == 'a':
+            self._open_for_append()
+        elif mode != 'r':
+            raise ValueError(f"Unknown mode: {mode}")
+        elif not os.path.exists(self.index_path):
+            raise FileNotFoundError(f"No container index at {self.index_path}")
+
+    def _open_for_append(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        for filepath, magic in ((self.path, DATA_MAGIC), (self.index_path, INDEX_MAGIC)):
+            if not os.path.exists(filepath) or os.path.getsize(filepath) < HEADER_SIZE:
+                with open(filepath, 'wb') as f:
+                    f.write(magic.ljust(HEADER_SIZE, b'\0'))
+        self.data_file = open(self.path, 'r+b')
+        self.index_file = open(self.index_path, 'r+b')
+        self._recover()
+
+    def _recover(self):
+        """
+        Drops a partial index entry and data after the last indexed record,
+        left behind by an interrupted append.
+        """
+        index_size = os.path.getsize(self.index_path)
+        count = (index_size - HEADER_SIZE) // INDEX_ENTRY.size
+        self.index_file.truncate(HEADER_SIZE + count * INDEX_ENTRY.size)
+        data_end = HEADER_SIZE
+        if count:
+            self.index_file.seek(HEADER_SIZE + (count - 1) * INDEX_ENTRY.size)
+            last = INDEX_ENTRY.unpack(self.index_file.read(INDEX_ENTRY.size))
+            data_end = last[0] + last[1]
+        self.data_file.truncate(data_end)
+        self.data_file.seek(0, os.SEEK_END)
+        self.index_file.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return (os.path.getsize(self.index_path) - HEADER_SIZE) // INDEX_ENTRY.size
+
+    def _maps(self, needed_index, needed_data=0):
+        """
+        Returns the index and data memory maps, remapped if the files grew
+        beyond the mapped size since they were mapped.
+        """
+        if self._index_map is None or len(self._index_map) < needed_index:
+            if self._index_map is not None:
+                self._index_map.close()
+            with open(self.index_path, 'rb') as f:
+                self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if needed_data and (self._data_map is None or len(self._data_map) < needed_data):
+            if self._data_map is not None:
+                self._data_map.close()
+            with open(self.path, 'rb') as f:
+                self._data_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._index_map, self._data_map
+
+    def entry(self, record) -> dict:
+        """
+        Returns the index entry of a record as a dict.
+        """
+        if not 0 <= record < len(self):
+            raise IndexError(f"Record {record} not in {self.path}")
+        position = HEADER_SIZE + record * INDEX_ENTRY.size
+        index_map, _ = self._maps(position + INDEX_ENTRY.size)
+        entry = dict(zip(INDEX_FIELDS, INDEX_ENTRY.unpack_from(index_map, position)))
+        entry["command"] = entry["command"].rstrip(b'\0').decode('ascii')
+        entry["record"] = record
+        return entry
+
+    def entries(self):
+        """
+        Yields the index entries of all records.
+        """
+        for record in range(len(self)):
+            yield self.entry(record)
+
+    def read(self, record, dtype='int16') -> tuple:
+        """
+        Reads the samples of a record.
+
+        Returns:
+            tuple: (samples, sample rate)
+        """
+        import numpy as np
+        entry = self.entry(record)
+        _, data_map = self._maps(0, entry["offset"] + entry["length"])
+        block = data_map[entry["offset"]:entry["offset"] + entry["length"]]
+        if zlib.crc32(block) != entry["crc32"]:
+            raise ValueError(f"CRC mismatch in record {record} of {self.path}")
+        name_length = struct.unpack_from('<H', block)[0]
+        payload = block[2 + name_length:]
+        if entry["codec"] == CODEC_FLAC:
+            import soundfile as sf
+            samples, sample_rate = sf.read(io.BytesIO(payload), dtype=dtype)
+        else:
+            samples = np.frombuffer(payload, dtype='<i2').astype(dtype)
+            sample_rate = entry["sample_rate"]
+        return samples, sample_rate
+
+    def name(self, record) -> str:
+        """
+        Returns the name (original FLAC basename) of a record.
+        """
+        entry = self.entry(record)
+        _, data_map = self._maps(0, entry["offset"] + entry["length"])
+        name_length = struct.unpack_from('<H', data_map, entry["offset"])[0]
+        start = entry["offset"] + 2
+        return data_map[start:start + name_length].decode('utf-8')
+
+    def find(self, start=None, end=None) -> range:
+        """
+        Returns the records with start <= timestamp < end, found with a
+        binary search over the index (records are appended in time order).
+        """
+        timestamps = _TimestampView(self)
+        first = 0 if start is None else bisect_left(timestamps, start)
+        last = len(self) if end is None else bisect_left(timestamps, end)
+        return range(first, last)
+
+    def append(self, signal, sample_rate, name, codec=CODEC_FLAC, fsync=False, **fields) -> int:
+        """
+        Appends a measurement.
+
+        Parameters:
+            signal (np.ndarray): The int16 samples.
+            sample_rate (int): Sample rate in Hz.
+            name (str): Record name, the FLAC basename the measurement
+                would have had. Index fields not given in `fields` are
+                interpreted from it.
+            codec (int): CODEC_FLAC or CODEC_RAW.
+            fsync (bool): Whether to fsync both files after the append.
+            **fields: Index fields (timestamp, sensor_id, command, ...).
+
+        Returns:
+            int: The record number.
+        """
+        import numpy as np
+        if self.mode != 'a':
+            raise ValueError("Container is not opened for appending")
+        signal = np.asarray(signal, dtype=np.int16)
+        if codec == CODEC_FLAC:
+            import soundfile as sf
+            buffer = io.BytesIO()
+            sf.write(buffer, signal, samplerate=sample_rate, format='FLAC', subtype='PCM_16')
+            payload = buffer.getvalue()
+        else:
+            payload = signal.astype('<i2').tobytes()
+        name_bytes = os.path.basename(name).encode('utf-8')
+        block = struct.pack('<H', len(name_bytes)) + name_bytes + payload
+
+        try:
+            described = describe_measurement_name(name)
+        except ValueError:
+            described = {}
+        values = {**described, **fields}
+        with self.lock:
+            offset = self.data_file.seek(0, os.SEEK_END)
+            self.data_file.write(block)
+            self.data_file.flush()
+            entry = INDEX_ENTRY.pack(
+                offset, len(block), float(values.get("timestamp", 0.0)),
+                int(values.get("sensor_id", 0)),
+                str(values.get("command", '')).encode('ascii')[:8],
+                int(values.get("start_frequency", 0)), int(values.get("stop_frequency", 0)),
+                int(values.get("damping_level", 0)), int(values.get("repetitions", 0)),
+                int(values.get("duration_us", 0)), int(sample_rate), len(signal),
+                codec, 0, 0, zlib.crc32(block))
+            self.index_file.seek(0, os.SEEK_END)
+            self.index_file.write(entry)
+            self.index_file.flush()
+            if fsync:
+                os.fsync(self.data_file.fileno())
+                os.fsync(self.index_file.fileno())
+            return len(self) - 1
+
+    def close(self):
+        for resource in (self._index_map, self._data_map):
+            if resource is not None:
+                resource.close()
+        self._index_map = self._data_map = None
+        if self.mode == 'a':
+            self.data_file.close()
+            self.index_file.close()
+
+
+class _TimestampView:
+    """
+    Sequence view of the record timestamps, for bisect.
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.length = len(container)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, record):
+        return self.container.entry(record)["timestamp"]
+
+
+class ContainerWriter:
+    """
+    ContainerWriter appends measurements to the container of their sensor and
+    day, keeping the containers of the current day open. Thread-safe, so the
+    storage writer pool can share one instance: the appends that are running
+    are counted per container, and the containers of earlier days (e.g. of a
+    record that arrives after midnight) are closed once they are idle.
+    """
+
+    def __init__(self, root=DEFAULT_CONTAINER_ROOT, codec=CODEC_FLAC, fsync=False):
+        self.root = root
+        self.codec = codec
+        self.fsync = fsync
+        self.containers = {}
+        # Number of running appends by container path
+        self.appending = {}
+        # Latest day a record was appended to, its containers stay open
+        self.current_day = None
+        self.lock = threading.Lock()
+
+    def append(self, name, signal, sample_rate, **fields) -> str:
+        """
+        Appends a measurement, named like its FLAC file would be.
+
+        Returns:
+            str: The source id of the record.
+        """
+        described = {**describe_measurement_name(name), **fields}
+        path = container_path_for(described["sensor_id"], described["timestamp"], self.root)
+        day = os.path.basename(os.path.dirname(path))
+        with self.lock:
+            container = self.containers.get(path)
+            if container is None:
+                container = self.containers[path] = MeasurementContainer(path, mode='a')
+            self.appending[path] = self.appending.get(path, 0) + 1
+            if self.current_day is None or day > self.current_day:
+                self.current_day = day
+        try:
+            record = container.append(signal, sample_rate, name, codec=self.codec, fsync=self.fsync, **fields)
+        finally:
+            with self.lock:
+                self.appending[path] -= 1
+                self._close_idle()
+        return source_id(path, record)
+
+    def _close_idle(self):
+        """
+        Closes the containers of the days before the current day that no
+        append is using, the lock must be held.
+        """
+        for path in list(self.containers):
+            if self.appending.get(path) == 0 and os.path.basename(os.path.dirname(path)) != self.current_day:
+                self.containers.pop(path).close()
+                del self.appending[path]
+
+    def close(self):
+        with self.lock:
+            for container in self.containers.values():
+                container.close()
+            self.containers.clear()
+            self.appending.clear()
+
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def read_source(source, dtype='int16') -> tuple:
+    """
+    Reads a container record by its source id, keeping the containers open
+    for the next read.
+
+    Returns:
+        tuple: (samples, sample rate)
+    """
+    container_path, record = parse_source_id(source)
+    with _readers_lock:
+        container = _readers.get(container_path)
+        if container is None:
+            container = _readers[container_path] = MeasurementContainer(container_path)
+    return container.read(record, dtype=dtype)
+
+
+def source_name(source) -> str:
+    """
+    Returns the measurement name of a source: the record name for container
+    records, the basename for files.
+    """
+    if not is_source_id(source):
+        return os.path.basename(source)
+    container_path, record = parse_source_id(source)
+    with _readers_lock:
+        container = _readers.get(container_path)
+        if container is None:
+            container = _readers[container_path] = MeasurementContainer(container_path)
+    return container.name(record)
+
+
+def list_containers(root=DEFAULT_CONTAINER_ROOT, days=None) -> list:
+    """
+    Returns the paths of all containers under `root`, oldest day first, or
+    only those of the `days` most recent days.
+    """
+    paths = []
+    if not os.path.isdir(root):
+        return paths
+    day_names = sorted(os.listdir(root))
+    for day in (day_names[-days:] if days else day_names):
+        day_dir = os.path.join(root, day)
+        if os.path.isdir(day_dir):
+            paths.extend(os.path.join(day_dir, name) for name in sorted(os.listdir(day_dir))
+                         if name.endswith(CONTAINER_SUFFIX))
+    return paths
+
+
+def import_flac_files(paths, root=DEFAULT_CONTAINER_ROOT, codec=CODEC_FLAC, remove=False) -> int:
+    """
+    Imports existing FLAC measurement files into the containers of their
+    sensor and day, in time order.
+
+    Returns:
+        int: The number of imported files.
+    """
+    import soundfile as sf
+    writer = ContainerWriter(root, codec=codec)
+    imported = 0
+    try:
+        entries = []
+        for path in paths:
+            try:
+                entries.append((describe_measurement_name(path)["timestamp"], path))
+            except ValueError as e:
+                print(f"Skipping {path}: {e}")
+        for _, path in sorted(entries):
+            signal, sample_rate = sf.read(path, dtype='int16')
+            writer.append(os.path.basename(path), signal, sample_rate)
+            imported += 1
+            if remove:
+                os.remove(path)
+    finally:
+        writer.close()
+    return imported
+
+
+def export_flac_files(container_path, output_dir, records=None) -> list:
+    """
+    Exports container records as FLAC files named by their record name.
+
+    Returns:
+        list: The paths of the written files.
+    """
+    import soundfile as sf
+    os.makedirs(output_dir, exist_ok=True)
+    container = MeasurementContainer(container_path)
+    written = []
+    try:
+        for record in (records if records is not None else range(len(container))):
+            signal, sample_rate = container.read(record)
+            name = os.path.splitext(container.name(record))[0] + '.flac'
+            filepath = os.path.join(output_dir, name)
+            sf.write(filepath, signal, samplerate=sample_rate, subtype='PCM_16')
+            written.append(filepath)
+    finally:
+        container.close()
+    return written
+
+
+if __name__ == "__main__":
+    import argparse
+    from DataLayout import list_measurement_files
+
+    parser = argparse.ArgumentParser(description="Import, export and list measurement containers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="import FLAC files into containers")
+    import_parser.add_argument('directory')
+    import_parser.add_argument('--root', default=DEFAULT_CONTAINER_ROOT)
+    import_parser.add_argument('--raw', action='store_true', help="store raw int16 instead of FLAC")
+    import_parser.add_argument('--remove', action='store_true', help="remove the FLAC files after import")
+    export_parser = subparsers.add_parser('export', help="export a container to FLAC files")
+    export_parser.add_argument('container')
+    export_parser.add_argument('output_dir')
+    list_parser = subparsers.add_parser('list', help="list the records of a container")
+    list_parser.add_argument('container')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        count = import_flac_files(
+            list_measurement_files(args.directory, suffixes=('.flac',)), root=args.root,
+            codec=CODEC_RAW if args.raw else CODEC_FLAC, remove=args.remove)
+        print(f"Imported {count} files into {args.root}")
+    elif args.command == 'export':
+        print(f"Exported {len(export_flac_files(args.container, args.output_dir))} records to {args.output_dir}")
+    else:
+        container = MeasurementContainer(args.container)
+        for entry in container.entries():
+            print(f"{entry['record']:6d} {datetime.fromtimestamp(entry['timestamp'])} "
+                  f"{entry['command']:<6} {entry['start_frequency']}-{entry['stop_frequency']} Hz "
+                  f"l{entry['damping_level']:03d} r{entry['repetitions']:03d} {entry['num_samples']} samples "
+                  f"{container.name(entry['record'])}")
+        container.close()
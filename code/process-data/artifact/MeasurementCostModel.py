@@ -0,0 +1,287 @@
+import json
+import math
+import os
+import statistics
+import time
+from MeasurementEvents import DEFAULT_EVENT_DIR, DEFAULT_EVENT_LOG, MEASUREMENT_COMPLETED, read_events
+
+DEFAULT_COST_MODEL = os.path.join(DEFAULT_EVENT_DIR, 'cost_model.json')
+
+SAMPLE_RATE = 500000
+BYTES_PER_SAMPLE = 2
+# Bus speed of the measure service and bits per byte on the wire
+BAUD_RATE = 921600
+BITS_PER_BYTE = 10
+
+# Parameters before any timing was recorded
+DEFAULT_PARAMETERS = {
+    # Per run: handling the message and submitting the file
+    "run_overhead_s": 0.05,
+    # Per repetition (or chunk, or TOF shot): request and response
+    "repetition_overhead_s": 0.01,
+    "transfer_s_per_byte": BITS_PER_BYTE / BAUD_RATE,
+    # Repetitions requested again, per repetition (see RepetitionQualityGate)
+    "retry_rate": 0.0,
+    "damping_switch_s": 0.1,
+    # Not measured, a change of waveform between two runs of a sensor
+    "command_switch_s": 0.02,
+}
+
+# Minimum number of recorded timings to fit a parameter
+MIN_SAMPLES = 5
+# Number of most recent events the model is fitted on
+MAX_EVENTS = 2000
+# Longest gap between two runs that counts as run overhead, in seconds
+MAX_RUN_GAP_S = 5.0
+
+
+def _robust_line(x, y):
+    """
+    Fits y = intercept + slope * x by least squares, once more without the
+    points more than 3 scaled MADs off the first fit.
+
+    Returns:
+        tuple: (slope, intercept), or (None, None) if x does not vary.
+    """
+    def least_squares(points):
+        mean_x = statistics.fmean(p[0] for p in points)
+        mean_y = statistics.fmean(p[1] for p in points)
+        sxx = sum((p[0] - mean_x) ** 2 for p in points)
+        if sxx == 0:
+            return None, None
+        slope = sum((p[0] - mean_x) * (p[1] - mean_y) for p in points) / sxx
+        return slope, mean_y - slope * mean_x
+
+    points = list(zip(x, y))
+    slope, intercept = least_squares(points)
+    if slope is None:
+        return None, None
+    residuals = [p[1] - intercept - slope * p[0] for p in points]
+    mad = 1.4826 * statistics.median(abs(r) for r in residuals)
+    if mad > 0:
+        kept = [p for p, r in zip(points, residuals) if abs(r) <= 3 * mad]
+        if len(kept) >= MIN_SAMPLES:
+            refit = least_squares(kept)
+            if refit[0] is not None:
+                slope, intercept = refit
+    return slope, intercept
+
+
+class MeasurementCostModel:
+    """
+    MeasurementCostModel predicts how long the measure service takes for a
+    run, a batch of messages or a measurement plan, so every planner and
+    GUI estimates durations the same way. A BLOCK/SINE run of `repetitions`
+    repetitions of `duration` microseconds takes:
+
+        run_overhead_s + repetitions * (1 + retry_rate) *
+            (repetition_overhead_s + duration + transfer_s_per_byte * bytes)
+
+    with `bytes` the int16 samples of one repetition, plus `damping_switch_s`
+    for every SET DAMPING and `command_switch_s` for every change of command
+    of a sensor. LONG, TOF and TOF_BLOCK runs follow the same terms per
+    chunk or shot, ENV only takes the run overhead.
+
+    The parameters start from the bus speed and are fitted by `refit` on
+    the timings of the measurement_completed events of the measure service
+    (acquisition time, retries, SET DAMPING time, gaps between runs). The
+    fitted parameters are stored in `cost_model.json` next to the event log
+    and loaded by `get_instance`, which picks up a newer fit.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, path=DEFAULT_COST_MODEL):
+        if cls._instance is None:
+            cls._instance = cls.load(path)
+        else:
+            cls._instance.reload()
+        return cls._instance
+
+    def __init__(self, parameters=None, path=DEFAULT_COST_MODEL):
+        self.path = path
+        self.parameters = {**DEFAULT_PARAMETERS, **(parameters or {})}
+        self.samples = 0
+        self.fitted_at = None
+        self.loaded_mtime = None
+
+    @classmethod
+    def load(cls, path=DEFAULT_COST_MODEL):
+        """
+        Loads the fitted model, or the default model if there is none.
+        """
+        model = cls(path=path)
+        model.reload()
+        return model
+
+    def reload(self) -> None:
+        """
+        Loads the parameters again if the model file changed.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.loaded_mtime:
+                return
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.parameters = {**DEFAULT_PARAMETERS, **stored.get("parameters", {})}
+        self.samples = stored.get("samples", 0)
+        self.fitted_at = stored.get("fitted_at")
+        self.loaded_mtime = mtime
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.tmp", 'w') as f:
+            json.dump({"parameters": self.parameters, "samples": self.samples, "fitted_at": self.fitted_at}, f, indent=4)
+        os.replace(f"{self.path}.tmp", self.path)
+        self.loaded_mtime = os.path.getmtime(self.path)
+
+    def predict_run(self, settings) -> float:
+        """
+        Predicts the duration of one run in seconds, without switching the
+        damping level or command.
+        """
+        p = self.parameters
+        command = settings.get("command")
+        repetitions = int(settings.get("repetitions", 1)) * (1 + p["retry_rate"])
+        if command in ("BLOCK", "SINE"):
+            duration_s = int(settings.get("duration", 0)) * 1e-6
+            repetition_bytes = duration_s * SAMPLE_RATE * BYTES_PER_SAMPLE
+            return p["run_overhead_s"] + repetitions * (
+                p["repetition_overhead_s"] + duration_s + p["transfer_s_per_byte"] * repetition_bytes)
+        if command == "LONG":
+            duration_s = int(settings.get("duration", 0)) * 1e-6
+            chunk_s = int(settings.get("chunk_duration", 65000)) * 1e-6
+            chunks = math.ceil(duration_s / chunk_s) if chunk_s > 0 else 0
+            return p["run_overhead_s"] + chunks * p["repetition_overhead_s"] + duration_s * (
+                1 + p["transfer_s_per_byte"] * SAMPLE_RATE * BYTES_PER_SAMPLE)
+        if command in ("TOF", "TOF_BLOCK"):
+            timeout_s = int(settings.get("timeout_duration", 0)) * 1e-6
+            return p["run_overhead_s"] + repetitions * (p["repetition_overhead_s"] + timeout_s)
+        return p["run_overhead_s"]
+
+    def predict_messages(self, messages, current_damping=None) -> dict:
+        """
+        Predicts the duration of a batch of queue messages in the given
+        order, with the SET DAMPING commands the measure service sends.
+
+        Parameters:
+            messages (iterable): Queue messages; measure messages are
+                costed, a reset or calibrate makes the damping level of its
+                sensor unknown, other messages are not costed.
+            current_damping (dict): Damping level per sensor id the sensors
+                are known to be at (None for the base level).
+
+        Returns:
+            dict: damping_switches, command_switches, run_s and estimated_s.
+        """
+        damping = dict(current_damping or {})
+        command = {}
+        damping_switches = command_switches = 0
+        run_s = 0.0
+        for message in messages:
+            sensor_id = message.get("sensor_id")
+            settings = message.get("measurement_settings", {})
+            if settings.get("type") in ("reset", "calibrate"):
+                damping.pop(sensor_id, None)
+            if settings.get("type") != "measure":
+                continue
+            run_command = settings.get("command")
+            # ENV does not set the damping, 0 selects the base level
+            if run_command != "ENV":
+                level = settings.get("damping_level") or None
+                if sensor_id not in damping or damping[sensor_id] != level:
+                    damping_switches += 1
+                damping[sensor_id] = level
+            if sensor_id in command and command[sensor_id] != run_command:
+                command_switches += 1
+            command[sensor_id] = run_command
+            run_s += self.predict_run(settings)
+        p = self.parameters
+        return {
+            "damping_switches": damping_switches,
+            "command_switches": command_switches,
+            "run_s": round(run_s, 3),
+            "estimated_s": round(
+                run_s + damping_switches * p["damping_switch_s"] + command_switches * p["command_switch_s"], 3),
+        }
+
+    def pack(self, batches, budget_s, current_damping=None):
+        """
+        Picks the batches that fit in a time budget, in the order given:
+        a batch that does not fit is skipped and the next ones are tried.
+
+        Parameters:
+            batches (list): Lists of queue messages, e.g. one per plan.
+            budget_s (float): Time available, e.g. the measurement interval.
+            current_damping (dict): See `predict_messages`.
+
+        Returns:
+            tuple: (indices of the picked batches, predicted duration in
+                seconds of the picked batches measured one after another)
+        """
+        picked = []
+        messages = []
+        predicted_s = 0.0
+        for index, batch in enumerate(batches):
+            estimated_s = self.predict_messages(messages + list(batch), current_damping)["estimated_s"]
+            if estimated_s <= budget_s:
+                picked.append(index)
+                messages.extend(batch)
+                predicted_s = estimated_s
+        return picked, predicted_s
+
+    def fit(self, events) -> dict:
+        """
+        Fits the parameters on the measurement_completed events of BLOCK
+        and SINE runs. A parameter keeps its value until there are
+        MIN_SAMPLES timings for it.
+
+        Returns:
+            dict: The fitted parameters.
+        """
+        runs = [e for e in events
+                if e.get("type") == MEASUREMENT_COMPLETED and e.get("command") in ("BLOCK", "SINE")
+                and e.get("duration") and e.get("repetitions")
+                and e.get("measurement_started") and e.get("measurement_finished")][-MAX_EVENTS:]
+        p = dict(self.parameters)
+        if len(runs) >= MIN_SAMPLES:
+            repetitions = sum(int(e["repetitions"]) for e in runs)
+            retries = sum(int(e.get("retries") or 0) for e in runs)
+            p["retry_rate"] = retries / repetitions
+            x, y = [], []
+            for e in runs:
+                duration_s = int(e["duration"]) * 1e-6
+                attempts = int(e["repetitions"]) + int(e.get("retries") or 0)
+                x.append(duration_s * SAMPLE_RATE * BYTES_PER_SAMPLE)
+                y.append((e["measurement_finished"] - e["measurement_started"]) / attempts - duration_s)
+            slope, intercept = _robust_line(x, y)
+            if slope is not None and slope > 0:
+                p["transfer_s_per_byte"] = slope
+                p["repetition_overhead_s"] = max(intercept, 0.0)
+            else:
+                p["repetition_overhead_s"] = max(
+                    statistics.median(yi - p["transfer_s_per_byte"] * xi for xi, yi in zip(x, y)), 0.0)
+            # Gaps between consecutive runs, without their SET DAMPING
+            gaps = [b["measurement_started"] - a["measurement_finished"] - (b.get("damping_s") or 0.0)
+                    for a, b in zip(runs, runs[1:])]
+            gaps = [gap for gap in gaps if 0 <= gap <= MAX_RUN_GAP_S]
+            if len(gaps) >= MIN_SAMPLES:
+                p["run_overhead_s"] = statistics.median(gaps)
+        damping = [e["damping_s"] for e in runs if e.get("damping_s")]
+        if len(damping) >= MIN_SAMPLES:
+            p["damping_switch_s"] = statistics.median(damping)
+        self.parameters = p
+        self.samples = len(runs)
+        self.fitted_at = time.time()
+        return p
+
+    def refit(self, log_path=DEFAULT_EVENT_LOG) -> dict:
+        """
+        Fits the model on the event log and stores it.
+        """
+        parameters = self.fit(read_events(log_path))
+        self.save()
+        return parameters
@@ -0,0 +1,338 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+DEFAULT_EVENT_DIR = '/home/plense/plensor_data/events'
+DEFAULT_EVENT_SOCKET = os.path.join(DEFAULT_EVENT_DIR, 'measurement_events.sock')
+DEFAULT_EVENT_LOG = os.path.join(DEFAULT_EVENT_DIR, 'measurement_events.jsonl')
+
+MEASUREMENT_COMPLETED = 'measurement_completed'
+SWEEP_PROGRESS = 'sweep_progress'
+RUN_PLAN = 'run_plan'
+PLAN_PROGRESS = 'plan_progress'
+SUBSCRIBED = 'subscribed'
+# Published many times per measurement, not synced to the log one by one
+PROGRESS_EVENTS = (SWEEP_PROGRESS, PLAN_PROGRESS)
+
+
+def read_events(log_path=DEFAULT_EVENT_LOG, after_seq=0) -> list:
+    """
+    Reads the events with a sequence number above `after_seq` from the
+    event log. A partially written last line is skipped.
+    """
+    events = []
+    try:
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event.get("seq", 0) > after_seq:
+                    events.append(event)
+    except FileNotFoundError:
+        pass
+    return events
+
+
+def read_last_seq(log_path=DEFAULT_EVENT_LOG) -> int:
+    """
+    Returns the sequence number of the last event in the log, 0 if there
+    is none. Only the tail of the log is read.
+    """
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 8192))
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return 0
+    for line in reversed(lines):
+        try:
+            return int(json.loads(line)["seq"])
+        except (ValueError, KeyError):
+            continue
+    return 0
+
+
+class EventPublisher:
+    """
+    EventPublisher publishes measurement events (e.g. "measurement
+    completed" once a measurement file is fully written) to local
+    subscribers over a Unix socket, as one JSON object per line.
+
+    Every event gets a sequence number and is appended to a JSON lines log
+    before it is sent, so the numbers survive a restart. A subscriber sends
+    the last sequence number it has seen when it connects and first gets
+    the events it missed from the log, then the live events. Subscribers
+    that do not keep up are disconnected, they catch up on reconnect.
+
+    `publish` only holds its lock to number the event, append it to the log
+    and queue it for the subscribers, which each have a thread that sends
+    their events, so a slow subscriber or a slow SD card does not hold up
+    the measure loop. The log is synced after every event except progress
+    events (PROGRESS_EVENTS), one sync covers all events written before it.
+    """
+
+    def __init__(self, socket_path=DEFAULT_EVENT_SOCKET, log_path=DEFAULT_EVENT_LOG, logger=None, max_log_events=10000,
+                 max_queued_events=1000):
+        self.socket_path = socket_path
+        self.log_path = log_path
+        self.logger = logger
+        self.max_log_events = max_log_events
+        self.max_queued_events = max_queued_events
+        self.lock = threading.Lock()
+        # Held while the log is synced or replaced, taken after `lock`
+        self.sync_lock = threading.Lock()
+        # Queue of the events to send, by connection
+        self.clients = {}
+        self.running = True
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        self.seq = read_last_seq(log_path)
+        self.written_seq = self.synced_seq = self.seq
+        self.log = open(log_path, 'a')
+        self.logged_events = len(read_events(log_path))
+
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(8)
+        self.accept_thread = threading.Thread(target=self._accept_loop, name='event-publisher', daemon=True)
+        self.accept_thread.start()
+
+    def log_error(self, message):
+        if self.logger is not None:
+            self.logger.log_error(message)
+        else:
+            print(message)
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._subscribe, args=(connection,), daemon=True).start()
+
+    def _subscribe(self, connection):
+        """
+        Reads the subscription request of a new client, sends it the events
+        it missed and then its live events, until it disconnects. The client
+        is registered under the publish lock: the events up to that point
+        are replayed from the log, the later ones are queued for it, so no
+        event is lost or sent twice.
+        """
+        events = queue.Queue(self.max_queued_events)
+        try:
+            connection.settimeout(2)
+            request = json.loads(connection.makefile('r').readline() or '{}')
+            with self.lock:
+                subscribed_seq = self.seq
+                self.clients[connection] = events
+            after_seq = int(request.get("after_seq", subscribed_seq))
+            lines = [{"seq": subscribed_seq, "type": SUBSCRIBED, "time": time.time()}]
+            lines += [event for event in read_events(self.log_path, after_seq) if event["seq"] <= subscribed_seq]
+            connection.sendall(''.join(json.dumps(line) + '\n' for line in lines).encode())
+            connection.settimeout(0.5)
+            while True:
+                line = events.get()
+                if line is None:
+                    break
+                connection.sendall(line.encode())
+        except (OSError, ValueError) as e:
+            if self.running:
+                self.log_error(f"Event subscriber disconnected: {e}")
+        finally:
+            with self.lock:
+                self.clients.pop(connection, None)
+            connection.close()
+
+    def publish(self, event_type, **fields) -> dict:
+        """
+        Appends an event to the log and sends it to all subscribers.
+
+        Parameters:
+            event_type (str): Type of the event, e.g. MEASUREMENT_COMPLETED.
+            **fields: JSON serializable event fields.
+
+        Returns:
+            dict: The published event, with its sequence number.
+        """
+        with self.lock:
+            self.seq += 1
+            event = {"seq": self.seq, "type": event_type, "time": time.time(), **fields}
+            line = (json.dumps(event) + '\n')
+            try:
+                self.log.write(line)
+                self.log.flush()
+                self.written_seq = self.seq
+                self.logged_events += 1
+            except (OSError, ValueError) as e:
+                self.log_error(f"Error writing event {self.seq} to {self.log_path}: {e}")
+            for connection, events in list(self.clients.items()):
+                try:
+                    events.put_nowait(line)
+                except queue.Full:
+                    # Not keeping up, it catches up from the log on reconnect
+                    del self.clients[connection]
+                    connection.close()
+            if self.logged_events > 2 * self.max_log_events:
+                self._compact()
+        if event_type not in PROGRESS_EVENTS:
+            self._sync(event["seq"])
+        return event
+
+    def _sync(self, seq):
+        """
+        Syncs the log to disk, unless a sync after event `seq` was written
+        already did.
+        """
+        with self.sync_lock:
+            if self.synced_seq >= seq:
+                return
+            written_seq = self.written_seq
+            try:
+                os.fsync(self.log.fileno())
+                self.synced_seq = written_seq
+            except (OSError, ValueError) as e:
+                self.log_error(f"Error syncing {self.log_path}: {e}")
+
+    def _compact(self):
+        """
+        Keeps the last `max_log_events` events of the log, the lock must be
+        held. The log is rewritten under a temporary name and renamed.
+        """
+        with self.sync_lock:
+            try:
+                events = read_events(self.log_path)[-self.max_log_events:]
+                tmp_path = f"{self.log_path}.part"
+                with open(tmp_path, 'w') as f:
+                    f.writelines(json.dumps(event) + '\n' for event in events)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.log.close()
+                os.replace(tmp_path, self.log_path)
+                self.log = open(self.log_path, 'a')
+                self.logged_events = len(events)
+                self.synced_seq = self.written_seq
+            except OSError as e:
+                self.log_error(f"Error compacting {self.log_path}: {e}")
+
+    def close(self) -> None:
+        """
+        Stops accepting subscribers and disconnects the current ones.
+        """
+        self.running = False
+        self.server.close()
+        with self.lock:
+            for connection, events in self.clients.items():
+                try:
+                    events.put_nowait(None)
+                except queue.Full:
+                    connection.close()
+            self.clients = {}
+            with self.sync_lock:
+                try:
+                    os.fsync(self.log.fileno())
+                except (OSError, ValueError):
+                    pass
+                self.log.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class EventSubscriber:
+    """
+    EventSubscriber receives the events of an EventPublisher. It reconnects
+    when the publisher restarts and resumes after the last sequence number
+    it received, so no event is missed while the publisher is down.
+
+    Without `after_seq` the subscriber starts at the end of the event log,
+    i.e. it only receives new events.
+    """
+
+    def __init__(self, socket_path=DEFAULT_EVENT_SOCKET, log_path=DEFAULT_EVENT_LOG, after_seq=None):
+        self.socket_path = socket_path
+        self.last_seq = read_last_seq(log_path) if after_seq is None else after_seq
+        self.connection = None
+        self.buffer = b''
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.socket_path)
+        connection.sendall((json.dumps({"after_seq": self.last_seq}) + '\n').encode())
+        self.connection = connection
+        self.buffer = b''
+
+    def receive(self, timeout=None) -> dict:
+        """
+        Waits up to `timeout` seconds (forever for None) for the next event.
+
+        Returns:
+            dict: The event, or None if no event arrived within the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if b'\n' in self.buffer:
+                line, self.buffer = self.buffer.split(b'\n', 1)
+                event = json.loads(line)
+                if event["type"] == SUBSCRIBED:
+                    # The publisher lost its log, continue from its numbers
+                    self.last_seq = min(self.last_seq, event["seq"])
+                    continue
+                if event["seq"] <= self.last_seq:
+                    continue
+                self.last_seq = event["seq"]
+                return event
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                if self.connection is None:
+                    self._connect()
+                self.connection.settimeout(remaining)
+                data = self.connection.recv(65536)
+                if not data:
+                    raise ConnectionError("publisher closed the connection")
+                self.buffer += data
+            except socket.timeout:
+                return None
+            except OSError:
+                # Publisher not running (yet), retry
+                self.close()
+                time.sleep(min(0.5, remaining) if remaining is not None else 0.5)
+
+    def events(self):
+        """
+        Yields events forever.
+        """
+        while True:
+            event = self.receive()
+            if event is not None:
+                yield event
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print measurement events")
+    parser.add_argument('--after-seq', type=int, help="replay the events after this sequence number")
+    parser.add_argument('--socket', default=DEFAULT_EVENT_SOCKET)
+    args = parser.parse_args()
+
+    subscriber = EventSubscriber(args.socket, after_seq=args.after_seq)
+    try:
+        for event in subscriber.events():
+            print(json.dumps(event))
+    except KeyboardInterrupt:
+        subscriber.close()
@@ -0,0 +1,256 @@
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_HANDOFF_SOCKET = '/home/plense/plensor_data/events/measurement_handoff.sock'
+DEFAULT_SLOTS = 8
+# Room for 50 repetitions of 25000 int16 samples, a full-rate BLOCK sweep
+DEFAULT_SLOT_BYTES = 4 * 1024 ** 2
+
+RING_MAGIC = b'PLNSRNG1'
+# magic, slots, slot bytes, read seq
+RING_HEADER = struct.Struct('<8sIIQ')
+RING_HEADER_SIZE = 64
+READ_SEQ_OFFSET = 16
+MAX_DESCRIPTOR_BYTES = 4096
+
+
+class HandoffReceiver:
+    """
+    HandoffReceiver is the process-data end of the shared-memory hand-off of
+    fresh measurements. It owns a ring of fixed-size slots in a
+    `multiprocessing.shared_memory` block and a Unix SEQPACKET socket over
+    which the measure service sends a small JSON descriptor per measurement
+    (slot, sequence number, path, sample rate, number of samples, storage
+    metadata). The samples are read straight from the slot, so the
+    measurement is processed without a FLAC encode, a write and a decode.
+
+    Slots are released in order with `release`: the read sequence number in
+    the ring header tells the sender which slots it may reuse, so a slow
+    consumer never has its samples overwritten. A new ring is created for
+    every receiver, its name is sent to a sender when it connects.
+    """
+
+    def __init__(self, socket_path=DEFAULT_HANDOFF_SOCKET, slots=DEFAULT_SLOTS, slot_bytes=DEFAULT_SLOT_BYTES, logger=None):
+        from multiprocessing import shared_memory
+        self.socket_path = socket_path
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.logger = logger
+        self.ring = shared_memory.SharedMemory(
+            name=f"plensor_handoff_{os.getpid()}", create=True, size=RING_HEADER_SIZE + slots * slot_bytes)
+        RING_HEADER.pack_into(self.ring.buf, 0, RING_MAGIC, slots, slot_bytes, 0)
+        self.connection = None
+
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.server.bind(socket_path)
+        self.server.listen(1)
+
+    def log_error(self, message):
+        if self.logger is not None:
+            self.logger.log_error(message)
+        else:
+            print(message)
+
+    def _accept(self):
+        """
+        Accepts a (new) sender. It starts writing at slot 0, so the ring is
+        reset and the ring name is sent to it.
+        """
+        connection, _ = self.server.accept()
+        if self.connection is not None:
+            self.connection.close()
+        struct.pack_into('<Q', self.ring.buf, READ_SEQ_OFFSET, 0)
+        connection.sendall(json.dumps({"ring": self.ring.name}).encode())
+        self.connection = connection
+
+    def receive(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (forever for None) for the next
+        measurement.
+
+        Returns:
+            tuple: (descriptor dict, int16 samples), or None if no measurement
+                arrived within the timeout. The samples are a view on the
+                ring, valid until the descriptor is released.
+        """
+        import numpy as np
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            sockets = [self.server] + ([self.connection] if self.connection is not None else [])
+            readable, _, _ = select.select(sockets, [], [], remaining)
+            if not readable:
+                return None
+            if self.server in readable:
+                self._accept()
+                continue
+            data = self.connection.recv(MAX_DESCRIPTOR_BYTES)
+            if not data:
+                # Sender stopped, it reconnects when it restarts
+                self.connection.close()
+                self.connection = None
+                continue
+            descriptor = json.loads(data)
+            offset = RING_HEADER_SIZE + descriptor["slot"] * self.slot_bytes
+            samples = np.ndarray(
+                (descriptor["num_samples"],), dtype=np.int16, buffer=self.ring.buf, offset=offset)
+            return descriptor, samples
+
+    def persist(self, descriptor, samples) -> str:
+        """
+        Writes the samples of a measurement to its raw file, in the format of
+        the extension of its path (FLAC, WAV, or .npy with a .json sidecar,
+        as the StorageCodec of the measure service). Used for measurements
+        the sender did not persist (`persisted=False`) whose processing
+        failed, before their slot is released.
+
+        Returns:
+            str: The path of the written file.
+        """
+        import numpy as np
+        path = descriptor["path"]
+        metadata = descriptor.get("metadata") or {}
+        tmp_path = f"{path}.part"
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if path.endswith('.npy'):
+            with open(tmp_path, 'wb') as f:
+                np.save(f, samples)
+            with open(f"{path}.json.part", 'w') as f:
+                json.dump({"sample_rate": descriptor["sample_rate"], **metadata}, f)
+            os.replace(f"{path}.json.part", f"{path}.json")
+        else:
+            import soundfile as sf
+            with sf.SoundFile(tmp_path, 'w', samplerate=descriptor["sample_rate"], channels=1,
+                              format=os.path.splitext(path)[1][1:].upper(), subtype='PCM_16') as f:
+                if metadata:
+                    f.comment = json.dumps(metadata)
+                f.write(samples)
+        os.replace(tmp_path, path)
+        return path
+
+    def release(self, descriptor) -> None:
+        """
+        Hands the slot of a processed measurement back to the sender.
+        """
+        struct.pack_into('<Q', self.ring.buf, READ_SEQ_OFFSET, descriptor["seq"] + 1)
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+        self.server.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        try:
+            self.ring.close()
+        except BufferError:
+            # A view on the ring is still in use, the mapping goes with the process
+            pass
+        self.ring.unlink()
+
+
+class HandoffSender:
+    """
+    HandoffSender is the measure service end of the hand-off: it copies the
+    samples of a measurement into a free slot of the ring of a
+    HandoffReceiver and sends the descriptor. `send` returns False when no
+    receiver is running, the ring is full or the measurement does not fit a
+    slot; the caller then stores the measurement as a file, so nothing is
+    lost when process-data is down or behind.
+    """
+
+    def __init__(self, socket_path=DEFAULT_HANDOFF_SOCKET, logger=None, retry_s=10.0):
+        self.socket_path = socket_path
+        self.logger = logger
+        self.retry_s = retry_s
+        self.lock = threading.Lock()
+        self.connection = None
+        self.ring = None
+        self.write_seq = 0
+        self.next_attempt = 0.0
+
+    def _connect(self) -> bool:
+        """
+        Connects to the receiver and attaches its ring, at most once per
+        `retry_s` while no receiver is running.
+        """
+        if self.connection is not None:
+            return True
+        if time.monotonic() < self.next_attempt:
+            return False
+        self.next_attempt = time.monotonic() + self.retry_s
+        from multiprocessing import resource_tracker, shared_memory
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            connection.settimeout(2)
+            connection.connect(self.socket_path)
+            ring_name = json.loads(connection.recv(MAX_DESCRIPTOR_BYTES))["ring"]
+            ring = shared_memory.SharedMemory(name=ring_name)
+        except (OSError, ValueError, KeyError):
+            connection.close()
+            return False
+        try:
+            # The receiver owns the ring, do not unlink it when this process exits
+            resource_tracker.unregister(ring._name, 'shared_memory')
+        except Exception:
+            pass
+        self.connection, self.ring, self.write_seq = connection, ring, 0
+        return True
+
+    def _disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+        if self.ring is not None:
+            self.ring.close()
+        self.connection, self.ring = None, None
+
+    def send(self, path, signal, sample_rate, metadata=None, **fields) -> bool:
+        """
+        Hands a measurement over to the receiver.
+
+        Parameters:
+            path (str): Path the raw file has (or would have) on disk, the
+                key of the measurement in the processing manifest.
+            signal (np.ndarray): The int16 samples.
+            sample_rate (int): Sample rate in Hz.
+            metadata (dict): Storage metadata, e.g. the decimation spec.
+            **fields: Extra descriptor fields, e.g. persisted=True.
+
+        Returns:
+            bool: True if the receiver got the measurement.
+        """
+        import numpy as np
+        signal = np.ascontiguousarray(signal, dtype=np.int16)
+        with self.lock:
+            if not self._connect():
+                return False
+            magic, slots, slot_bytes, read_seq = RING_HEADER.unpack_from(self.ring.buf, 0)
+            if magic != RING_MAGIC or signal.nbytes > slot_bytes or self.write_seq - read_seq >= slots:
+                return False
+            slot = self.write_seq % slots
+            offset = RING_HEADER_SIZE + slot * slot_bytes
+            np.ndarray(signal.shape, dtype=np.int16, buffer=self.ring.buf, offset=offset)[:] = signal
+            descriptor = {
+                "seq": self.write_seq, "slot": slot, "path": path, "name": os.path.basename(path),
+                "sample_rate": int(sample_rate), "num_samples": int(signal.size),
+                "metadata": metadata or {}, "sent_at": time.time(), **fields}
+            try:
+                self.connection.sendall(json.dumps(descriptor).encode())
+            except OSError as e:
+                if self.logger is not None:
+                    self.logger.log_error(f"Measurement hand-off disconnected: {e}")
+                self._disconnect()
+                return False
+            self.write_seq += 1
+            return True
+
+    def close(self) -> None:
+        with self.lock:
+            self._disconnect()
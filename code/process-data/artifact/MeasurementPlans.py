@@ -0,0 +1,58 @@
+import json
+import os
+
+DEFAULT_PLANS_FILE = '/home/plense/metadata/measurement_plans.json'
+DEFAULT_INTERVAL = 300
+
+
+def plan_messages(plan) -> list:
+    """
+    Returns the measure messages of a measurement plan: its measurement
+    sequence for every sensor of the plan.
+
+    Parameters:
+        plan (dict): A measurement plan, with `plan_name`, `sensors` (e.g.
+            "#122"), `measurement_sequence`, `measurement_settings` per
+            command and `interval` in seconds.
+    """
+    sensor_ids = plan.get("sensors", [])
+    sequence = plan.get("measurement_sequence", [])
+    measurement_settings = plan.get("measurement_settings", {})
+    messages = []
+    for sensor in sensor_ids:
+        for cmd in sequence:
+            settings = measurement_settings.get(cmd, {}).copy()
+            # For BLOCK and SINE commands, remove any "damping_byte" key.
+            if cmd in ["BLOCK", "SINE"]:
+                settings.pop("damping_byte", None)
+            # Build the message (do not include plan name here)
+            msg = {"sensor_id": int(str(sensor).lstrip('#')), "measurement_settings": {"type": "measure"}}
+            if "damping" in settings:
+                settings["command"] = settings.pop("damping")
+            msg["measurement_settings"].update(settings)
+            messages.append(msg)
+    return messages
+
+
+def read_plans(path=DEFAULT_PLANS_FILE) -> list:
+    """
+    Reads the measurement plans registered with the measure service, an
+    empty list if there are none.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f).get("measurement_plans", [])
+    except (OSError, ValueError):
+        return []
+
+
+def register_plans(plans, path=DEFAULT_PLANS_FILE) -> None:
+    """
+    Registers measurement plans with the measure service, which measures
+    them at their interval until they are registered without them. The file
+    is replaced at once, so the service never reads a partial file.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump({"measurement_plans": plans}, f, indent=4)
+    os.replace(f"{path}.tmp", path)
@@ -1,70 +1,248 @@
 import os
 import soundfile as sf
 import numpy as np
-from xedge_plense_tools import SignalOperator_edge as SignalOperator
+from DataLayout import PROCESSED_DIR, measurement_path, prune_empty_shards
+from MeasurementContainer import CONTAINER_SUFFIX, SOURCE_SEPARATOR, is_source_id, source_name
+from PreviewBuilder import PreviewBuilder
+from xedge_plense_tools import LocalDataLoader_edge, SignalOperator_edge as SignalOperator
+
+# Bump this whenever the processing output changes, so the manifest can
+# re-queue files that were processed by an older version.
+PIPELINE_VERSION = 'pp001-v2'
+
+# Sample rate of the Plensor, band-limited files are stored at this rate
+# divided by an integer decimation factor
+FULL_SAMPLE_RATE = 500000
+
+# Storage formats of the raw files written by the measure service
+RAW_SUFFIXES = ('.flac', '.wav', '.npy')
+# Manifest patterns of all raw sources: the raw files and container records
+CONTAINER_SOURCE_PATTERN = CONTAINER_SUFFIX + SOURCE_SEPARATOR + '%'
+RAW_SOURCE_PATTERNS = RAW_SUFFIXES + (CONTAINER_SOURCE_PATTERN,)
 
 
 class Preprocessor:
-    def __init__(self):
+    def __init__(self, manifest=None, remove_raw=True, feature_table=None, preview_dir=None, processed_subtype='PCM_24', catalog=None, staging=None):
         """
         Initializes the Preprocessor class with hardcoded directories.
+
+        Args:
+            manifest (ProcessingManifest, optional): Manifest used to decide
+                whether a file is done and to record the processing status.
+                Without a manifest, the processed output is looked up on disk.
+            remove_raw (bool): Whether to remove the raw file after processing.
+                Keep the raw files if they should be re-processed after a
+                pipeline version bump.
+            feature_table (FeatureTable, optional): Table to store the acoustic
+                feature vector of every processed raw file in.
+            preview_dir (str, optional): Directory to write the GUI preview
+                sidecar of every processed raw file to.
+            processed_subtype (str): 'PCM_24' or 'PCM_16' for the processed FLAC files.
+            catalog (MeasurementCatalog, optional): Catalog to add the processed
+                files to and to remove the deleted raw files from.
+            staging (StagingTier, optional): RAM staging tier to write the
+                processed files and previews to. A file is marked done, and
+                its raw file removed, once the processed file is flushed.
         """
-        self.preprocessed_data_dir = '/home/plense/plensor_data/audio_data/time_domain_processed'
+        self.preprocessed_data_dir = PROCESSED_DIR
+        self.manifest = manifest
+        self.remove_raw = remove_raw
+        self.feature_table = feature_table
+        self.preview_dir = preview_dir
+        self.processed_subtype = processed_subtype
+        self.catalog = catalog
+        self.staging = staging
 
-    def process_measurement_file(self, measurementfile):
+    def is_processed(self, measurementfile, processed_file_path):
+        """
+        Checks whether a measurement file has already been processed by the
+        current pipeline version.
+        """
+        if self.manifest is not None:
+            return self.manifest.is_done(measurementfile, PIPELINE_VERSION)
+        return os.path.exists(processed_file_path)
+
+    def process_measurement_file(self, measurementfile, segments=10):
         """
         Processes a single measurement file: performs segmentation, FFT, and IFFT,
         saves the processed file, and returns the maximum amplitude.
 
         Args:
             measurementfile (str): Path to the measurement file.
+            segments (int): Number of segments to average over.
 
         Returns:
-            float: Maximum amplitude of the processed signal, or None if the processing failed.
+            tuple: (maximum amplitude of the processed signal, processed file path),
+                or None if the processing failed.
         """
-        # Create the new filename for processed data
-        new_filename = self.add_24_before_hash(os.path.basename(measurementfile))
-        processed_file_path = os.path.join(self.preprocessed_data_dir, new_filename)
+        # Create the new filename for processed data, always a FLAC file.
+        # Container records are named after the FLAC file they replace.
+        try:
+            measurement_name = source_name(measurementfile)
+        except Exception as e:
+            print(f"Error loading {measurementfile}: {e}")
+            self._mark_failed(measurementfile, e, status='missing')
+            return None
+        new_filename = self.add_24_before_hash(os.path.splitext(measurement_name)[0] + '.flac')
+        processed_file_path = measurement_path(self.preprocessed_data_dir, new_filename)
 
         # Check if the file has already been processed
-        if not os.path.exists(processed_file_path):
-            os.makedirs(self.preprocessed_data_dir, exist_ok=True)
+        if not self.is_processed(measurementfile, processed_file_path):
+            if self.manifest is not None:
+                self.manifest.mark_started(measurementfile)
 
             try:
                 # Load the raw audio data
-                audio_data_int16, sample_rate = sf.read(measurementfile, dtype="int16")
-                if sample_rate != 500000:
+                # Band-limited files are stored at a decimated sample rate,
+                # everything below uses the sample rate of the file itself
+                audio_data_int16, sample_rate = LocalDataLoader_edge.read_measurement(measurementfile, dtype="int16")
+                if FULL_SAMPLE_RATE % sample_rate != 0:
                     print(f"Inconsistent sample rate in file {measurementfile}")
+                    self._mark_failed(measurementfile, f"Inconsistent sample rate {sample_rate}")
                     return None
             except Exception as e:
                 print(f"Error loading {measurementfile}: {e}")
+                status = 'missing' if not os.path.exists(measurementfile.split(SOURCE_SEPARATOR)[0]) else 'failed'
+                self._mark_failed(measurementfile, e, status=status)
                 return None
 
-            # Perform FFT and IFFT transformation
-            try:
-                audio_data_processed = self.segment_and_transform(audio_data_int16, sample_rate)
-            except Exception as e:
-                print(f"Error in signal transformation for {measurementfile}: {e}")
-                return None
-
-            # Save the processed file
-            try:
-                self.save_processed_file(processed_file_path, audio_data_processed)
-            except Exception as e:
-                print(f"Error saving processed file {measurementfile}: {e}")
-                return None
-
-            # Remove the raw file
-            os.remove(measurementfile)
-
-            # Calculate and return the maximum amplitude
-            max_amp = np.max(audio_data_processed)
-            return max_amp, processed_file_path # TODO ADD OUTLIER SEGMENTS USED AND STD OVER USED SEGMENTS
+            return self.process_samples(measurementfile, audio_data_int16, sample_rate, segments=segments)
         else:
             # File has already been processed
             print(f"File {new_filename} already processed, skipping.")
             return None
 
+    def process_samples(self, measurementfile, audio_data_int16, sample_rate, segments=10, remove_raw=None, processed=None):
+        """
+        Processes the loaded samples of a measurement: extracts the feature
+        vector, writes the preview, saves the processed file and marks the
+        measurement done. Used for measurement files and for measurements
+        handed over in shared memory by the measure service, and by the
+        measure service itself for measurements averaged on acquisition.
+
+        Args:
+            measurementfile (str): Path (or source id) of the measurement.
+            audio_data_int16 (np.array): The raw int16 samples.
+            sample_rate (int): Sample rate of the samples.
+            segments (int): Number of segments to average over.
+            remove_raw (bool): Whether to remove the raw file, defaults to
+                the `remove_raw` of the Preprocessor.
+            processed (np.array): Processed output that was already computed
+                (see SpectralAverager), the transformation is then skipped.
+
+        Returns:
+            tuple: (maximum amplitude of the processed signal, processed file path),
+                or None if the processing failed.
+        """
+        if remove_raw is None:
+            remove_raw = self.remove_raw
+        measurement_name = source_name(measurementfile)
+        new_filename = self.add_24_before_hash(os.path.splitext(measurement_name)[0] + '.flac')
+        processed_file_path = measurement_path(self.preprocessed_data_dir, new_filename)
+
+        # Perform FFT and IFFT transformation
+        try:
+            if processed is not None:
+                audio_data_processed = processed
+            else:
+                audio_data_processed = self.segment_and_transform(audio_data_int16, sample_rate, segments=segments)
+        except Exception as e:
+            print(f"Error in signal transformation for {measurementfile}: {e}")
+            self._mark_failed(measurementfile, e)
+            return None
+
+        # Extract the feature vector from the raw signal while it is loaded
+        if self.feature_table is not None:
+            self.feature_table.extract_and_add(measurement_name, audio_data_int16, sample_rate=sample_rate, segments=segments)
+
+        # Write the preview sidecar for the GUIs
+        if self.preview_dir is not None:
+            self.save_preview(measurement_name, audio_data_int16, sample_rate)
+
+        # Save the processed file
+        try:
+            os.makedirs(os.path.dirname(processed_file_path), exist_ok=True)
+            staged_path = self.staging.stage_path(processed_file_path) if self.staging else processed_file_path
+            self.save_processed_file(staged_path, audio_data_processed, sample_rate=sample_rate)
+        except Exception as e:
+            print(f"Error saving processed file {measurementfile}: {e}")
+            self._mark_failed(measurementfile, e)
+            return None
+
+        if self.staging is not None:
+            if self.manifest is not None:
+                # Lets finish_recovered_file find the source if the process
+                # stops before the staged file is flushed
+                self.manifest.set_output_path(measurementfile, processed_file_path)
+            self.staging.commit(staged_path, callback=lambda path: self.finish_measurement_file(measurementfile, path, remove_raw))
+        else:
+            self.finish_measurement_file(measurementfile, processed_file_path, remove_raw)
+
+        # Calculate and return the maximum amplitude
+        max_amp = np.max(audio_data_processed)
+        return max_amp, processed_file_path # TODO ADD OUTLIER SEGMENTS USED AND STD OVER USED SEGMENTS
+
+    def finish_measurement_file(self, measurementfile, processed_file_path, remove_raw=True):
+        """
+        Marks a measurement file done once its processed file is written and,
+        with `remove_raw`, removes the raw file.
+        """
+        if self.manifest is not None:
+            self.manifest.mark_done(measurementfile, processed_file_path, PIPELINE_VERSION)
+        if self.catalog is not None:
+            self.catalog.add(processed_file_path)
+
+        # Remove the raw file, container records are only removed with
+        # their whole container
+        if remove_raw and not is_source_id(measurementfile):
+            os.remove(measurementfile)
+            if measurementfile.endswith('.npy') and os.path.exists(f"{measurementfile}.json"):
+                os.remove(f"{measurementfile}.json")
+            if self.catalog is not None:
+                self.catalog.remove(measurementfile)
+            prune_empty_shards(os.path.dirname(measurementfile))
+
+    def finish_recovered_file(self, processed_file_path):
+        """
+        Finishes a processed file that a previous process staged and did not
+        flush (see StagingTier.recover), once it is flushed: its source is
+        marked done and cataloged and its raw file removed, as the lost
+        commit callback would have done. Other recovered files (previews,
+        metadata) are left as they are.
+        """
+        if self.manifest is None:
+            return
+        measurementfile = self.manifest.get_processing_source(processed_file_path)
+        if measurementfile is None:
+            return
+        # Sources handed over in shared memory have no raw file to remove
+        remove_raw = self.remove_raw and (is_source_id(measurementfile) or os.path.exists(measurementfile))
+        self.finish_measurement_file(measurementfile, processed_file_path, remove_raw)
+
+    def save_preview(self, measurementfile, audio_data, sample_rate):
+        """
+        Builds and saves the preview sidecar (waveform envelope and PSD) of a
+        measurement file.
+        """
+        try:
+            preview = PreviewBuilder.build_preview(audio_data, sample_rate)
+            preview_path = PreviewBuilder.preview_path(measurementfile, self.preview_dir)
+            if self.staging is not None:
+                staged_path = self.staging.stage_path(preview_path)
+                PreviewBuilder.save_preview(staged_path, preview)
+                self.staging.commit(staged_path)
+            else:
+                PreviewBuilder.save_preview(preview_path, preview)
+        except Exception as e:
+            print(f"Error saving preview for {measurementfile}: {e}")
+
+    def _mark_failed(self, measurementfile, error, status='failed'):
+        """
+        Records a failed processing attempt in the manifest, if there is one.
+        """
+        if self.manifest is not None:
+            self.manifest.mark_failed(measurementfile, error, status=status)
+
     def add_24_before_hash(self, filename):
         """
         Adds '24' before the first occurrence of '#' in the filename.
@@ -85,18 +263,19 @@ class Preprocessor:
             return filename
 
 
-    def segment_and_transform(self, audio_data, sample_rate):
+    def segment_and_transform(self, audio_data, sample_rate, segments=10):
         """
         Segments the audio data, performs FFT, and applies inverse FFT.
 
         Args:
             audio_data (np.array): The raw audio data to process.
+            segments (int): Number of segments to average over.
 
         Returns:
             np.array: The processed audio data.
         """
         # Perform FFT on segmented audio data
-        audio_data_fft_f64n, std_fft, num_used_segments, _ = SignalOperator._transform_segments_fft(audio_data)
+        audio_data_fft_f64n, _ = SignalOperator._transform_segments_fft(audio_data, segments=segments)
 
         # Convert to float32 for processing
         audio_data_fft_f32n = np.complex64(audio_data_fft_f64n)
@@ -104,15 +283,16 @@ class Preprocessor:
         # Apply inverse FFT and scale to [-1, 1] in float32
         audio_data_processed = (SignalOperator._transform_segments_ifft(audio_data_fft_f32n)).astype(np.float32) / 32767.0
 
-        return audio_data_processed, std_fft, num_used_segments
+        return audio_data_processed
 
-    def save_processed_file(self, filepath, processed_data):
+    def save_processed_file(self, filepath, processed_data, sample_rate=500000):
         """
-        Saves the processed audio data as a 24-bit signal.
+        Saves the processed audio data as a 24-bit (or 16-bit) signal.
 
         Args:
             filepath (str): The path to save the processed file.
             processed_data (np.array): The processed audio data.
+            sample_rate (int): Sample rate of the processed data.
         """
-        sf.write(filepath, processed_data, samplerate=500000, subtype='PCM_24')
+        sf.write(filepath, processed_data, samplerate=sample_rate, subtype=self.processed_subtype)
         print(f"Processed file saved: {filepath}")
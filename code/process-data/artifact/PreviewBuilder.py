@@ -0,0 +1,167 @@
+import os
+import numpy as np
+from DataLayout import PREVIEW_DIR, measurement_path
+
+DEFAULT_PREVIEW_DIR = PREVIEW_DIR
+
+
+class PreviewBuilder:
+    """
+    PreviewBuilder creates the small preview products that the GUIs show for
+    a measurement: a min/max-decimated waveform envelope and a log-binned
+    power spectral density. The previews are stored as a `.preview.npz`
+    sidecar, so opening a measurement does not require decoding the raw
+    FLAC file or running an FFT over every sample.
+
+    Only NumPy is used, so the GUIs can import this module without SciPy.
+    """
+
+    @staticmethod
+    def minmax_envelope(signal: np.ndarray, num_bins=1000) -> tuple:
+        """
+        Decimates a signal to the minimum and maximum of `num_bins` bins of
+        (nearly) equal size, which keeps the peaks that plain decimation
+        would drop. Every bin is a non-empty part of the signal, the bin
+        sizes differ by at most one sample.
+
+        Parameters:
+            signal (np.ndarray): The signal to decimate.
+            num_bins (int): Number of bins, giving 2 * num_bins points.
+
+        Returns:
+            tuple: (bin_start_indices, minima, maxima)
+        """
+        signal = np.asarray(signal)
+        num_bins = max(1, min(num_bins, len(signal)))
+        # Bin edges as floor(i * n / num_bins), in integers so no edge is
+        # rounded onto the next one
+        starts = np.arange(num_bins, dtype=np.int64) * len(signal) // num_bins
+        return starts, np.minimum.reduceat(signal, starts), np.maximum.reduceat(signal, starts)
+
+    @staticmethod
+    def log_binned_psd(signal: np.ndarray, sample_rate, num_bins=256, nperseg=8192, fmin=1000.0) -> tuple:
+        """
+        Estimates the PSD with Welch's method (Hann window, 50% overlap) and
+        averages it into logarithmically spaced frequency bins.
+
+        Parameters:
+            signal (np.ndarray): The signal, scaled to [-1, 1].
+            sample_rate (int): Sample rate of the signal in Hz.
+            num_bins (int): Number of logarithmic frequency bins.
+            nperseg (int): Welch segment length.
+            fmin (float): Lower edge of the first bin in Hz.
+
+        Returns:
+            tuple: (bin_center_frequencies, psd_db), empty bins are dropped.
+        """
+        signal = np.asarray(signal, dtype=np.float64)
+        nperseg = min(nperseg, len(signal))
+        step = max(1, nperseg // 2)
+        starts = np.arange(0, len(signal) - nperseg + 1, step)
+        window = np.hanning(nperseg)
+        segments = signal[starts[:, None] + np.arange(nperseg)[None, :]]
+        segments = (segments - segments.mean(axis=1, keepdims=True)) * window
+        power = np.mean(np.abs(np.fft.rfft(segments, axis=1)) ** 2, axis=0)
+        psd = power / (sample_rate * np.sum(window ** 2))
+        psd[1:-1] *= 2
+        freqs = np.fft.rfftfreq(nperseg, d=1 / sample_rate)
+
+        edges = np.geomspace(fmin, sample_rate / 2, num_bins + 1)
+        bin_index = np.digitize(freqs, edges) - 1
+        valid = (bin_index >= 0) & (bin_index < num_bins)
+        sums = np.bincount(bin_index[valid], weights=psd[valid], minlength=num_bins)
+        counts = np.bincount(bin_index[valid], minlength=num_bins)
+        filled = counts > 0
+        centers = np.sqrt(edges[:-1] * edges[1:])
+        psd_binned = sums[filled] / counts[filled]
+        return centers[filled], 10 * np.log10(np.maximum(psd_binned, 1e-20))
+
+    @staticmethod
+    def build_preview(signal: np.ndarray, sample_rate, num_bins=1000, psd_bins=256) -> dict:
+        """
+        Builds the preview products of a measurement signal.
+
+        Parameters:
+            signal (np.ndarray): The signal, int16 samples are scaled to [-1, 1].
+            sample_rate (int): Sample rate of the signal in Hz.
+            num_bins (int): Number of envelope bins (2 * num_bins points).
+            psd_bins (int): Number of logarithmic PSD bins.
+
+        Returns:
+            dict: The preview arrays and scalars, ready for `save_preview`.
+        """
+        signal = np.asarray(signal)
+        if signal.ndim > 1:
+            signal = signal[:, 0]
+        if signal.dtype == np.int16:
+            signal = signal.astype(np.float32) / 32768.0
+        starts, minima, maxima = PreviewBuilder.minmax_envelope(signal, num_bins)
+        freqs, psd_db = PreviewBuilder.log_binned_psd(signal, sample_rate, num_bins=psd_bins)
+        return {
+            "envelope_time": (starts / sample_rate).astype(np.float32),
+            "envelope_min": minima.astype(np.float32),
+            "envelope_max": maxima.astype(np.float32),
+            "psd_frequency": freqs.astype(np.float32),
+            "psd_db": psd_db.astype(np.float32),
+            "sample_rate": np.int64(sample_rate),
+            "num_samples": np.int64(len(signal)),
+            "max_abs": np.float32(max(np.max(np.abs(minima)), np.max(np.abs(maxima)))),
+        }
+
+    @staticmethod
+    def preview_path(measurementfile, preview_dir=DEFAULT_PREVIEW_DIR) -> str:
+        """
+        Returns the sidecar path of a measurement file, in the shard of the
+        measurement below `preview_dir`. Previews are keyed by the raw file
+        basename, so they are found after a file is moved.
+        """
+        basename = os.path.splitext(os.path.basename(measurementfile))[0]
+        return measurement_path(preview_dir, f"{basename}.preview.npz")
+
+    @staticmethod
+    def save_preview(filepath, preview: dict) -> None:
+        """
+        Saves a preview as an (uncompressed) `.npz` sidecar. The file is
+        written under a temporary name first, so readers never see a partial
+        sidecar.
+        """
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **preview)
+        os.replace(tmp_path, filepath)
+
+    @staticmethod
+    def load_preview(filepath) -> dict:
+        """
+        Loads a preview sidecar, or returns None if it does not exist.
+        """
+        if not os.path.exists(filepath):
+            return None
+        with np.load(filepath) as data:
+            return {key: data[key] for key in data.files}
+
+    @staticmethod
+    def load_or_build(measurementfile, preview_dir=DEFAULT_PREVIEW_DIR) -> dict:
+        """
+        Loads the preview of a measurement file, building it from the raw
+        file (and saving the sidecar) if the pipeline has not made it yet.
+        """
+        sidecar_path = PreviewBuilder.preview_path(measurementfile, preview_dir)
+        preview = PreviewBuilder.load_preview(sidecar_path)
+        if preview is None:
+            if measurementfile.endswith('.npy'):
+                # Raw int16 hot tier file, the sample rate is in the sidecar
+                import json
+                with open(f"{measurementfile}.json") as f:
+                    sample_rate = json.load(f)["sample_rate"]
+                signal = np.load(measurementfile)
+            else:
+                import soundfile as sf
+                signal, sample_rate = sf.read(measurementfile, dtype='int16')
+            preview = PreviewBuilder.build_preview(signal, sample_rate)
+            try:
+                PreviewBuilder.save_preview(sidecar_path, preview)
+            except OSError as e:
+                print(f"Could not save preview {sidecar_path}: {e}")
+        return preview
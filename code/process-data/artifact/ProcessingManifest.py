@@ -0,0 +1,446 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from ErrorLogger import ErrorLogger
+
+# Age in seconds after which a file that is still 'processing' is assumed to
+# be left behind by an interrupted run
+STALE_PROCESSING_S = 15 * 60
+
+
+class ProcessingManifest:
+    """
+    ProcessingManifest keeps track of every measurement file that enters the
+    processing pipeline in a small SQLite database, so that the processing
+    loop does not have to decide whether a file is done by looking for its
+    renamed output on disk.
+
+    Every source file gets one row holding its size, mtime, content hash,
+    the pipeline version that processed it, the output path, the status and
+    the processing timings. Lookups are done on the primary key, so checking
+    whether a file is done or pending does not depend on the number of files
+    that have been processed before.
+
+    Statuses:
+        - pending: registered, waiting to be processed.
+        - processing: picked up by the processing loop.
+        - done: processed by `pipeline_version`, output at `output_path`.
+        - failed: processing raised an error, see `error`.
+        - missing: the source file was gone when it was picked up.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, db_path='/home/plense/plensor_data/index/processing_manifest.db'):
+        if cls._instance is None:
+            cls._instance = cls(db_path)
+        return cls._instance
+
+    def __init__(self, db_path='/home/plense/plensor_data/index/processing_manifest.db'):
+        """
+        Opens (and if needed creates) the manifest database.
+
+        Parameters:
+            db_path (str): Path to the SQLite manifest database.
+        """
+        if self._instance is not None:
+            raise Exception("ProcessingManifest is a singleton!")
+        self.logger = ErrorLogger.get_instance()
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+    def create_tables(self):
+        """
+        Creates the manifest table and its indices if they do not exist.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS manifest (
+                    source_path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime REAL,
+                    content_hash TEXT,
+                    pipeline_version TEXT,
+                    output_path TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    registered_at REAL,
+                    started_at REAL,
+                    finished_at REAL,
+                    processing_time REAL,
+                    error TEXT
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_manifest_status "
+                "ON manifest(status, registered_at)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_manifest_version "
+                "ON manifest(pipeline_version)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_manifest_output "
+                "ON manifest(output_path)")
+
+    @staticmethod
+    def _suffix_condition(suffix):
+        """
+        Returns the SQL condition and parameters that select the source paths
+        ending with `suffix` (a string or a tuple of strings, None for all).
+        The suffixes are LIKE patterns, '%' in a suffix matches anything.
+        """
+        if suffix is None:
+            return "1", []
+        suffixes = (suffix,) if isinstance(suffix, str) else tuple(suffix)
+        condition = " OR ".join("source_path LIKE '%' || ?" for _ in suffixes)
+        return f"({condition})", list(suffixes)
+
+    @staticmethod
+    def compute_content_hash(filepath, chunk_size=1 << 20):
+        """
+        Computes the BLAKE2b hash of a file, reading it in chunks.
+
+        Parameters:
+            filepath (str): Path of the file to hash.
+            chunk_size (int): Number of bytes read per chunk.
+
+        Returns:
+            str: The hex digest of the file content.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def register_file(self, filepath, compute_hash=True):
+        """
+        Registers a source file as pending. A file that is already known is
+        only re-queued if its size or mtime changed.
+
+        Parameters:
+            filepath (str): Path of the source file.
+            compute_hash (bool): Whether to store the content hash.
+
+        Returns:
+            bool: True if the file was (re-)queued, else False.
+        """
+        try:
+            stat = os.stat(filepath)
+            content_hash = self.compute_content_hash(filepath) if compute_hash else None
+            return self.register_source(filepath, stat.st_size, stat.st_mtime, content_hash)
+        except Exception as e:
+            self.logger.log_error(f"Error registering {filepath} in manifest: {e}")
+            return False
+
+    def register_source(self, source_path, size, mtime, content_hash=None):
+        """
+        Registers a source as pending, see `register_file`. Sources that are
+        not files (container records) are registered with their own size,
+        timestamp and checksum.
+
+        Returns:
+            bool: True if the source was (re-)queued, else False.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute("""
+                INSERT INTO manifest (source_path, size, mtime, content_hash, status, registered_at)
+                VALUES (?, ?, ?, ?, 'pending', ?)
+                ON CONFLICT(source_path) DO UPDATE SET
+                    size = excluded.size,
+                    mtime = excluded.mtime,
+                    content_hash = excluded.content_hash,
+                    status = 'pending',
+                    registered_at = excluded.registered_at,
+                    error = NULL
+                WHERE manifest.size != excluded.size OR manifest.mtime != excluded.mtime
+                """, (source_path, size, mtime, content_hash, time.time()))
+        return cursor.rowcount > 0
+
+    def register_container(self, container):
+        """
+        Registers the records of a measurement container that are not yet in
+        the manifest. Records are only appended, so only the records after
+        the number already registered are read from the index.
+
+        Parameters:
+            container (MeasurementContainer): The container to register.
+
+        Returns:
+            int: The number of newly registered records.
+        """
+        from MeasurementContainer import source_id
+        prefix = source_id(container.path, 0)[:-6]
+        try:
+            with self.lock:
+                known = self.connection.execute(
+                    "SELECT COUNT(*) FROM manifest WHERE source_path >= ? AND source_path < ?",
+                    (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))).fetchone()[0]
+            registered = 0
+            for record in range(known, len(container)):
+                entry = container.entry(record)
+                if self.register_source(source_id(container.path, record), entry["length"],
+                                        entry["timestamp"], f"{entry['crc32']:08x}"):
+                    registered += 1
+            return registered
+        except Exception as e:
+            self.logger.log_error(f"Error registering container {container.path}: {e}")
+            return 0
+
+    def register_directory(self, directory, suffix='.flac', compute_hash=True, recursive=False):
+        """
+        Registers all files in a directory that are not yet in the manifest.
+        Known files are skipped with a primary key lookup, without a stat
+        or a hash.
+
+        Parameters:
+            directory (str): The directory to scan.
+            suffix (str or tuple): Only files ending with this suffix are registered.
+            compute_hash (bool): Whether to store the content hash.
+            recursive (bool): Whether to scan the subdirectories (the shards
+                of the sharded layout, see DataLayout) too.
+
+        Returns:
+            int: The number of newly registered files.
+        """
+        registered = 0
+        try:
+            if not os.path.isdir(directory):
+                raise FileNotFoundError(directory)
+            for dirpath, dirnames, filenames in os.walk(directory):
+                if not recursive:
+                    dirnames.clear()
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if not filename.endswith(suffix) or self.get_status(path) is not None:
+                        continue
+                    if self.register_file(path, compute_hash=compute_hash):
+                        registered += 1
+        except FileNotFoundError:
+            self.logger.log_error(f"Directory {directory} does not exist.")
+        except Exception as e:
+            self.logger.log_error(f"Error registering directory {directory}: {e}")
+        return registered
+
+    def get_status(self, filepath):
+        """
+        Returns the status of a source file, or None if it is unknown.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM manifest WHERE source_path = ?",
+                (filepath,)).fetchone()
+        return row["status"] if row else None
+
+    def is_done(self, filepath, pipeline_version=None):
+        """
+        Checks whether a source file has been processed, optionally by a
+        specific pipeline version.
+
+        Parameters:
+            filepath (str): Path of the source file.
+            pipeline_version (str): If given, only a run by this version counts.
+
+        Returns:
+            bool: True if the file is done, else False.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status, pipeline_version FROM manifest WHERE source_path = ?",
+                (filepath,)).fetchone()
+        if row is None or row["status"] != 'done':
+            return False
+        return pipeline_version is None or row["pipeline_version"] == pipeline_version
+
+    def get_record(self, filepath):
+        """
+        Returns the full manifest row of a source file as a dict, or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM manifest WHERE source_path = ?",
+                (filepath,)).fetchone()
+        return dict(row) if row else None
+
+    def get_pending(self, limit=100, suffix=None):
+        """
+        Returns the oldest pending source files.
+
+        Parameters:
+            limit (int): The maximum number of files to return.
+            suffix (str or tuple): If given, only files ending with this suffix are returned.
+
+        Returns:
+            list: Source paths in order of registration.
+        """
+        condition, parameters = self._suffix_condition(suffix)
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT source_path FROM manifest WHERE status = 'pending' AND {condition} "
+                "ORDER BY registered_at LIMIT ?", (*parameters, limit)).fetchall()
+        return [row["source_path"] for row in rows]
+
+    def count_by_status(self):
+        """
+        Returns a dict with the number of files per status.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT status, COUNT(*) AS n FROM manifest GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def mark_started(self, filepath):
+        """
+        Marks a source file as being processed.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE manifest SET status = 'processing', started_at = ? WHERE source_path = ?",
+                (time.time(), filepath))
+
+    def set_output_path(self, filepath, output_path):
+        """
+        Records the output path of a source file that is being processed,
+        before its output is durable, so `get_processing_source` can find
+        the source of an output that was left behind by a crash.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE manifest SET output_path = ? WHERE source_path = ?", (output_path, filepath))
+
+    def get_processing_source(self, output_path):
+        """
+        Returns the source path of the file that is being processed into
+        `output_path`, or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT source_path FROM manifest WHERE output_path = ? AND status = 'processing'",
+                (output_path,)).fetchone()
+        return row["source_path"] if row else None
+
+    def mark_done(self, filepath, output_path, pipeline_version):
+        """
+        Marks a source file as processed and stores its output and timings.
+
+        Parameters:
+            filepath (str): Path of the source file.
+            output_path (str): Path of the processed output.
+            pipeline_version (str): Version of the pipeline that processed it.
+        """
+        finished_at = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("""
+                UPDATE manifest SET
+                    status = 'done',
+                    output_path = ?,
+                    pipeline_version = ?,
+                    finished_at = ?,
+                    processing_time = ? - COALESCE(started_at, ?),
+                    error = NULL
+                WHERE source_path = ?""",
+                (output_path, pipeline_version, finished_at, finished_at, finished_at, filepath))
+
+    def move(self, old_path, new_path):
+        """
+        Updates the source and output paths of a file that was moved.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE OR IGNORE manifest SET source_path = ? WHERE source_path = ?", (new_path, old_path))
+            self.connection.execute(
+                "UPDATE manifest SET output_path = ? WHERE output_path = ?", (new_path, old_path))
+
+    def mark_failed(self, filepath, error, status='failed'):
+        """
+        Marks a source file as failed (or missing) and stores the error.
+        """
+        finished_at = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("""
+                UPDATE manifest SET
+                    status = ?,
+                    finished_at = ?,
+                    processing_time = ? - COALESCE(started_at, ?),
+                    error = ?
+                WHERE source_path = ?""",
+                (status, finished_at, finished_at, finished_at, str(error), filepath))
+
+    def forget(self, filepath):
+        """
+        Removes a source file from the manifest, so it is registered again
+        when it shows up in the raw directory or the catalog.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM manifest WHERE source_path = ?", (filepath,))
+
+    def requeue_outdated(self, pipeline_version, suffix=None):
+        """
+        Puts every file that was processed by another pipeline version back
+        to pending, so it is processed again after a version bump. Files whose
+        source was removed will end up as 'missing' when they are picked up,
+        so only pass the suffixes of sources that are kept after processing.
+
+        Parameters:
+            pipeline_version (str): The current pipeline version.
+            suffix (str or tuple): If given, only files ending with this suffix are re-queued.
+
+        Returns:
+            int: The number of re-queued files.
+        """
+        condition, parameters = self._suffix_condition(suffix)
+        with self.lock, self.connection:
+            cursor = self.connection.execute(f"""
+                UPDATE manifest SET status = 'pending', registered_at = ?
+                WHERE status = 'done' AND pipeline_version != ? AND {condition}""",
+                (time.time(), pipeline_version, *parameters))
+        self.logger.log_info(f"Re-queued {cursor.rowcount} files for pipeline version {pipeline_version}")
+        return cursor.rowcount
+
+    def requeue_stale(self, older_than_s=STALE_PROCESSING_S):
+        """
+        Puts every file that was picked up more than `older_than_s` seconds
+        ago and never finished back to pending. A file stays 'processing'
+        when the processing of it was interrupted, e.g. by a crash or a power
+        cut, and `get_pending` would never return it again.
+
+        Parameters:
+            older_than_s (float): Minimum age of the 'processing' status, so
+                files that are being processed right now are left alone.
+
+        Returns:
+            int: The number of re-queued files.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "UPDATE manifest SET status = 'pending', registered_at = ? "
+                "WHERE status = 'processing' AND COALESCE(started_at, 0) < ?",
+                (time.time(), time.time() - older_than_s))
+        if cursor.rowcount:
+            self.logger.log_info(f"Re-queued {cursor.rowcount} files that were left processing")
+        return cursor.rowcount
+
+    def requeue_failed(self):
+        """
+        Puts every failed file back to pending.
+
+        Returns:
+            int: The number of re-queued files.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "UPDATE manifest SET status = 'pending', registered_at = ? WHERE status = 'failed'",
+                (time.time(),))
+        return cursor.rowcount
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,311 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_RUN_MANIFEST_DB = '/home/plense/plensor_data/index/runs.db'
+
+QUEUED = 'queued'
+MEASURING = 'measuring'
+# Measured, the file is not written yet
+MEASURED = 'measured'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+FINAL_STATUSES = (DONE, FAILED, SKIPPED)
+
+# Message types that get a run record
+RUN_TYPES = ('measure', 'sweep')
+
+
+def new_run_id() -> str:
+    return uuid.uuid4().hex
+
+
+class RunManifest:
+    """
+    RunManifest records the outcome of every measure message by its run id:
+    status, file path, timings and retries. A GUI puts a `run_id` in the
+    messages it submits (one is assigned to messages without) and waits on
+    those run ids with primary key lookups, instead of listing directories
+    for filenames it expects.
+
+    A run is `queued` when the measure service reads it from the interrupt
+    file or a plan, `measuring` when it is taken from the queue, `measured`
+    when its samples are in and `done` once its file is written (at once for
+    ENV and TOF readings, which have no file). Runs that did not measure are
+    `failed`, runs of a plan past its deadline are `skipped`. The runs of a
+    sweep descriptor get the run id of the descriptor with `.<n>` appended
+    and the descriptor as `parent_run_id`; the descriptor is done when its
+    last run was taken.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, db_path=DEFAULT_RUN_MANIFEST_DB, logger=None):
+        if cls._instance is None:
+            cls._instance = cls(db_path, logger=logger)
+        return cls._instance
+
+    def __init__(self, db_path=DEFAULT_RUN_MANIFEST_DB, logger=None):
+        if self._instance is not None:
+            raise Exception("RunManifest is a singleton!")
+        self.logger = logger
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id TEXT PRIMARY KEY,
+                    parent_run_id TEXT,
+                    sensor_id INTEGER,
+                    command TEXT,
+                    status TEXT,
+                    path TEXT,
+                    retries INTEGER,
+                    error TEXT,
+                    plan_run_id TEXT,
+                    sweep_id TEXT,
+                    submitted_at REAL,
+                    started_at REAL,
+                    measurement_started REAL,
+                    measurement_finished REAL,
+                    finished_at REAL
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_runs_parent ON runs(parent_run_id)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_runs_submitted ON runs(submitted_at)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_runs_path ON runs(path)")
+
+    def log_error(self, message):
+        if self.logger is not None:
+            self.logger.log_error(message)
+        else:
+            print(message)
+
+    def _execute(self, query, parameters=()) -> bool:
+        try:
+            with self.lock, self.connection:
+                self.connection.execute(query, parameters)
+            return True
+        except sqlite3.Error as e:
+            self.log_error(f"Error updating the run manifest: {e}")
+            return False
+
+    @staticmethod
+    def _describe(message) -> dict:
+        settings = message.get("measurement_settings", {})
+        return {
+            "run_id": message["run_id"],
+            "parent_run_id": message.get("parent_run_id"),
+            "sensor_id": message.get("sensor_id"),
+            "command": settings.get("command") or settings.get("sweep_type"),
+            "plan_run_id": message.get("plan_run_id"),
+            "sweep_id": message.get("sweep_id") or settings.get("sweep_id"),
+        }
+
+    def submit(self, messages) -> list:
+        """
+        Records the measure and sweep messages of a batch as queued, with a
+        new run id for messages without one.
+
+        Returns:
+            list: The run ids of the recorded messages.
+        """
+        now = time.time()
+        rows = []
+        for message in messages:
+            if message.get("measurement_settings", {}).get("type") not in RUN_TYPES:
+                continue
+            message.setdefault("run_id", new_run_id())
+            run = self._describe(message)
+            rows.append((run["run_id"], run["parent_run_id"], run["sensor_id"], run["command"], QUEUED,
+                         run["plan_run_id"], run["sweep_id"], now))
+        try:
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO runs (run_id, parent_run_id, sensor_id, command, status, "
+                    "plan_run_id, sweep_id, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            self.log_error(f"Error recording {len(rows)} submitted runs: {e}")
+        return [row[0] for row in rows]
+
+    def start(self, message):
+        """
+        Records that a message was taken from the queue, with a new run id
+        if it has none (e.g. the measurements of the measurement cycle).
+
+        Returns:
+            str: The run id, None if the message is not a run.
+        """
+        if message.get("measurement_settings", {}).get("type") not in RUN_TYPES:
+            return None
+        message.setdefault("run_id", new_run_id())
+        run = self._describe(message)
+        now = time.time()
+        self._execute(
+            "INSERT INTO runs (run_id, parent_run_id, sensor_id, command, status, plan_run_id, sweep_id, "
+            "submitted_at, started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(run_id) DO UPDATE SET status = excluded.status, started_at = excluded.started_at",
+            (run["run_id"], run["parent_run_id"], run["sensor_id"], run["command"], MEASURING,
+             run["plan_run_id"], run["sweep_id"], now, now))
+        return run["run_id"]
+
+    def measured(self, run_id, path=None, measurement_started=None, measurement_finished=None, retries=0) -> None:
+        """
+        Records that the samples of a run are in and its file is queued for
+        writing at `path`. Does nothing if the file was already written.
+        """
+        if run_id is None:
+            return
+        self._execute(
+            "UPDATE runs SET status = ?, path = ?, measurement_started = ?, measurement_finished = ?, retries = ? "
+            "WHERE run_id = ? AND status = ?",
+            (MEASURED, path, measurement_started, measurement_finished, retries, run_id, MEASURING))
+
+    def done(self, run_id, path=None) -> None:
+        """
+        Records that a run is done, with the path of its file if it has one.
+        """
+        if run_id is None:
+            return
+        self._execute(
+            "UPDATE runs SET status = ?, path = COALESCE(?, path), finished_at = ? WHERE run_id = ?",
+            (DONE, path, time.time(), run_id))
+
+    def written(self, path) -> bool:
+        """
+        Records the measured run whose file is `path` as done, for a file
+        that was written after the process that measured it stopped (see
+        StagingTier.recover).
+
+        Returns:
+            bool: True if a measured run with that file was found.
+        """
+        try:
+            with self.lock, self.connection:
+                cursor = self.connection.execute(
+                    "UPDATE runs SET status = ?, finished_at = ? WHERE path = ? AND status = ?",
+                    (DONE, time.time(), path, MEASURED))
+            return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            self.log_error(f"Error updating the run manifest: {e}")
+            return False
+
+    def fail(self, run_id, error) -> None:
+        """
+        Records that a run failed, unless it already finished.
+        """
+        self._finish(run_id, FAILED, error)
+
+    def skip(self, run_id, reason) -> None:
+        """
+        Records that a run was not measured, unless it already finished.
+        """
+        self._finish(run_id, SKIPPED, reason)
+
+    def _finish(self, run_id, status, error) -> None:
+        if run_id is None:
+            return
+        self._execute(
+            f"UPDATE runs SET status = ?, error = ?, finished_at = ? "
+            f"WHERE run_id = ? AND status NOT IN ({', '.join('?' * len(FINAL_STATUSES))})",
+            (status, str(error), time.time(), run_id, *FINAL_STATUSES))
+
+    def settle(self, run_id) -> None:
+        """
+        Records a run that was handled without a measurement as failed; the
+        handlers only record the runs that measured.
+        """
+        if run_id is None:
+            return
+        self._execute(
+            "UPDATE runs SET status = ?, error = ?, finished_at = ? WHERE run_id = ? AND status = ?",
+            (FAILED, "No measurement", time.time(), run_id, MEASURING))
+
+    def get(self, run_id):
+        """
+        Returns the record of a run as dict, or None if it is unknown.
+        """
+        return self.get_many([run_id]).get(run_id)
+
+    def get_many(self, run_ids) -> dict:
+        """
+        Returns the records of runs by run id; unknown run ids are left out.
+        """
+        run_ids = list(run_ids)
+        records = {}
+        try:
+            with self.lock:
+                # In chunks, below the SQLite limit of bound parameters
+                for i in range(0, len(run_ids), 500):
+                    chunk = run_ids[i:i + 500]
+                    rows = self.connection.execute(
+                        f"SELECT * FROM runs WHERE run_id IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+                    records.update((row["run_id"], dict(row)) for row in rows)
+        except sqlite3.Error as e:
+            self.log_error(f"Error reading the run manifest: {e}")
+        return records
+
+    def children(self, run_id) -> list:
+        """
+        Returns the records of the runs of a sweep descriptor, in order.
+        """
+        try:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT * FROM runs WHERE parent_run_id = ? ORDER BY started_at", (run_id,)).fetchall()
+            return [dict(row) for row in rows]
+        except sqlite3.Error as e:
+            self.log_error(f"Error reading the runs of {run_id}: {e}")
+            return []
+
+    def wait(self, run_ids, timeout=None, poll_s=0.2) -> dict:
+        """
+        Waits until every run is done, failed or skipped, or until the
+        timeout in seconds.
+
+        Returns:
+            dict: The records of the runs by run id, as `get_many`. Runs
+                that are not finished keep their current status.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            records = self.get_many(run_ids)
+            finished = all(records.get(run_id, {}).get("status") in FINAL_STATUSES for run_id in run_ids)
+            if finished or (deadline is not None and time.time() >= deadline):
+                return records
+            time.sleep(poll_s)
+
+    def prune(self, max_age_days=30) -> int:
+        """
+        Removes the runs submitted more than `max_age_days` ago.
+
+        Returns:
+            int: The number of removed runs.
+        """
+        try:
+            with self.lock, self.connection:
+                cursor = self.connection.execute(
+                    "DELETE FROM runs WHERE submitted_at < ?", (time.time() - max_age_days * 86400,))
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            self.log_error(f"Error pruning the run manifest: {e}")
+            return 0
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            self.connection.close()
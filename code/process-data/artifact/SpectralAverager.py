@@ -0,0 +1,87 @@
+import numpy as np
+from xedge_plense_tools import SignalOperator_edge as SignalOperator
+
+
+class SpectralAverager:
+    """
+    SpectralAverager computes the processed output of a BLOCK/SINE
+    measurement while its repetitions arrive, instead of after the whole
+    measurement is stored and loaded again.
+
+    The measurement is split in `segments` equal segments, as in
+    `Preprocessor.segment_and_transform`, which need not line up with the
+    repetitions. Every segment is transformed as soon as its samples have
+    arrived and folded into two running accumulators: the sum of the FFT
+    magnitudes and the phase of the first segment. `result` gives the same
+    output as `segment_and_transform` (mean-subtracted segments,
+    'first-phase' averaging), or None if the repetitions did not fill the
+    segments exactly (e.g. a repetition failed), and the measurement must be
+    transformed whole.
+
+    With an executor, the repetitions are folded on its worker while the
+    caller waits on the bus for the next repetition. The executor must run
+    one task at a time, so the first repetition is folded first.
+    """
+
+    def __init__(self, repetitions, segments=10, executor=None):
+        self.expected_repetitions = repetitions
+        self.segments = segments
+        self.executor = executor
+        self.futures = []
+        self.magnitude_sum = None
+        self.first_phase = None
+        self.repetitions = 0
+        self.folded = 0
+        # Samples of the segment that has not fully arrived yet
+        self.pending = np.zeros(0, dtype=np.int16)
+        self.segment_length = None
+
+    def add(self, samples) -> None:
+        """
+        Folds one repetition (int16 samples) into the accumulators, on the
+        executor if there is one. Errors are raised by `result`.
+        """
+        if self.executor is not None:
+            self.futures.append(self.executor.submit(self._fold, samples))
+        else:
+            self._fold(samples)
+
+    def _fold(self, samples) -> None:
+        samples = np.asarray(samples, dtype=np.int16)
+        if self.repetitions == 0:
+            length = len(samples) * self.expected_repetitions
+            if length % self.segments == 0:
+                self.segment_length = length // self.segments
+        self.repetitions += 1
+        if self.segment_length is None:
+            return
+        self.pending = np.concatenate((self.pending, samples))
+        while len(self.pending) >= self.segment_length and self.folded < self.segments:
+            self._fold_segment(self.pending[:self.segment_length])
+            self.pending = self.pending[self.segment_length:]
+
+    def _fold_segment(self, segment) -> None:
+        from scipy.fft import fft
+        spectrum = fft(segment - np.mean(segment))
+        if self.magnitude_sum is None:
+            self.magnitude_sum = np.abs(spectrum)
+            self.first_phase = np.angle(spectrum)
+        else:
+            self.magnitude_sum += np.abs(spectrum)
+        self.folded += 1
+
+    def result(self):
+        """
+        Waits for the folded repetitions and returns the processed output.
+
+        Returns:
+            np.array: The averaged segment as float32 in [-1, 1], or None if
+                the repetitions did not fill exactly `segments` segments.
+        """
+        for future in self.futures:
+            future.result()
+        if (self.repetitions != self.expected_repetitions or self.folded != self.segments
+                or len(self.pending) != 0):
+            return None
+        spectrum = (self.magnitude_sum / self.segments) * np.exp(1j * self.first_phase)
+        return SignalOperator._transform_segments_ifft(np.complex64(spectrum)).astype(np.float32) / 32767.0
@@ -0,0 +1,366 @@
+import atexit
+import logging
+import os
+import shutil
+import threading
+import time
+from logging.handlers import MemoryHandler
+
+DEFAULT_STAGING_ROOT = '/dev/shm/plensor_staging'
+COPY_BUFFER_SIZE = 1 << 20
+# Free space kept on the tmpfs, below it files are written straight to SD
+MIN_STAGING_FREE = 16 * 1024 ** 2
+# Unfinished files of a writer, never flushed
+PARTIAL_SUFFIXES = ('.part', '.tmp')
+
+
+def disk_write_counters(path) -> tuple:
+    """
+    Returns the completed write requests and written bytes of the block
+    device holding `path`, from /proc/diskstats. These include the journal
+    and metadata writes of the file system, i.e. what reaches the SD card.
+
+    Returns:
+        tuple: (write requests, written bytes), (0, 0) if the device is unknown.
+    """
+    try:
+        st_dev = os.stat(path).st_dev
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if int(fields[0]) == os.major(st_dev) and int(fields[1]) == os.minor(st_dev):
+                    return int(fields[7]), int(fields[9]) * 512
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0, 0
+
+
+class StagedFile:
+    __slots__ = ('staged_path', 'final_path', 'size', 'callback')
+
+    def __init__(self, staged_path, final_path, size, callback):
+        self.staged_path = staged_path
+        self.final_path = final_path
+        self.size = size
+        self.callback = callback
+
+
+class StagingTier:
+    """
+    StagingTier lets a service write its output files to RAM (a tmpfs,
+    /dev/shm by default) and moves them to persistent storage in batches,
+    instead of many small synchronous writes to the SD card.
+
+    A writer asks for the staging path of a file with `stage_path`, writes
+    the file there and hands it over with `commit`. A flush thread copies
+    the committed files to their final path, grouped per directory: all
+    files are written, then fsynced, then renamed into place, then the
+    directory is fsynced once. A callback passed to `commit` runs after the
+    file is durable, so catalog entries, events and manifest updates never
+    point at data that can still be lost.
+
+    The data that can be lost with a power cut is bounded: a flush starts at
+    the latest `max_loss_s` seconds after the oldest unflushed file and as
+    soon as `flush_bytes` are pending, and `commit` flushes synchronously
+    when `max_loss_bytes` are pending. `close()` flushes everything and
+    is also run at exit; services call it on SIGTERM. Files left on the
+    tmpfs by a crashed process are flushed by `recover`, which a service
+    calls once it is set up, with a callback that redoes what the callbacks
+    of the lost process would have done.
+
+    When the tmpfs is (nearly) full, `stage_path` returns the final path and
+    the file is written straight to persistent storage.
+    """
+
+    def __init__(self, service, staging_root=DEFAULT_STAGING_ROOT, max_loss_s=30.0,
+                 max_loss_bytes=64 * 1024 ** 2, flush_bytes=None, logger=None,
+                 persistent_path='/home/plense'):
+        self.service = service
+        self.stage_dir = os.path.join(staging_root, service)
+        self.max_loss_s = max_loss_s
+        self.max_loss_bytes = max_loss_bytes
+        self.flush_bytes = flush_bytes or max_loss_bytes // 2
+        self.logger = logger
+        self.persistent_path = persistent_path
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.log_buffers = []
+        self.stats = {"flushes": 0, "flushed_files": 0, "flushed_bytes": 0, "write_through_files": 0}
+        self.disk_counters_start = disk_write_counters(persistent_path)
+        self.last_report = time.monotonic()
+        os.makedirs(self.stage_dir, exist_ok=True)
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_loop, name='staging-flush', daemon=True)
+        self.flush_thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_settings(cls, settings, service, logger=None):
+        """
+        Creates the staging tier of a service from the `staging` entry of the
+        app settings, e.g. {"enabled": true, "max_loss_s": 30}. With
+        `buffer_logs` (default true) the log lines of `logger` are staged too.
+
+        Returns:
+            StagingTier: The staging tier, or None if staging is disabled.
+        """
+        settings = settings or {}
+        if not settings.get("enabled", False):
+            return None
+        tier = cls(
+            service,
+            staging_root=settings.get("directory", DEFAULT_STAGING_ROOT),
+            max_loss_s=settings.get("max_loss_s", 30.0),
+            max_loss_bytes=settings.get("max_loss_mb", 64) * 1024 ** 2,
+            flush_bytes=settings.get("flush_mb", 0) * 1024 ** 2 or None,
+            logger=logger)
+        if logger is not None and settings.get("buffer_logs", True):
+            tier.buffer_log(logger)
+        return tier
+
+    def log_error(self, message):
+        if self.logger is not None:
+            self.logger.log_error(message)
+        else:
+            print(message)
+
+    def recover(self, on_recover=None) -> int:
+        """
+        Queues the files a previous process of the service left on the tmpfs
+        for flushing. Their commit callbacks were lost with that process.
+
+        Parameters:
+            on_recover (callable): Called with the final path of every
+                recovered file once it is durable, instead of the lost
+                commit callback.
+
+        Returns:
+            int: The number of recovered files.
+        """
+        recovered = []
+        for directory, _, filenames in os.walk(self.stage_dir):
+            for filename in filenames:
+                staged_path = os.path.join(directory, filename)
+                if filename.endswith(PARTIAL_SUFFIXES):
+                    os.remove(staged_path)
+                    continue
+                recovered.append(StagedFile(
+                    staged_path, self.final_path(staged_path), os.path.getsize(staged_path), on_recover))
+        if recovered:
+            with self.lock:
+                self.pending = recovered + self.pending
+                self.pending_bytes += sum(item.size for item in recovered)
+                self.pending_since = self.pending_since or time.monotonic()
+            self.log_error(f"Recovered {len(recovered)} staged files of {self.service}, flushing them")
+            self.wake_event.set()
+        return len(recovered)
+
+    def stage_path(self, final_path) -> str:
+        """
+        Returns the path to write a file to, on the tmpfs if there is room.
+        """
+        try:
+            if shutil.disk_usage(self.stage_dir).free < MIN_STAGING_FREE:
+                return final_path
+        except OSError:
+            return final_path
+        staged_path = os.path.join(self.stage_dir, os.path.abspath(final_path).lstrip(os.sep))
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        return staged_path
+
+    def final_path(self, staged_path) -> str:
+        """
+        Returns the persistent path of a staged file.
+        """
+        return os.sep + os.path.relpath(staged_path, self.stage_dir)
+
+    def is_staged(self, path) -> bool:
+        return os.path.abspath(path).startswith(self.stage_dir + os.sep)
+
+    def commit(self, path, callback=None) -> str:
+        """
+        Hands a completely written file over for flushing.
+
+        Parameters:
+            path (str): The path returned by `stage_path`, after writing.
+            callback (callable): Called with the final path once the file is
+                durable on persistent storage (from the flush thread).
+
+        Returns:
+            str: The final path of the file.
+        """
+        if not self.is_staged(path):
+            # Written straight to persistent storage
+            with self.lock:
+                self.stats["write_through_files"] += 1
+            if callback is not None:
+                callback(path)
+            return path
+        item = StagedFile(path, self.final_path(path), os.path.getsize(path), callback)
+        with self.lock:
+            self.pending.append(item)
+            self.pending_bytes += item.size
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            pending_bytes = self.pending_bytes
+        if pending_bytes >= self.max_loss_bytes:
+            self.flush()
+        elif pending_bytes >= self.flush_bytes:
+            self.wake_event.set()
+        return item.final_path
+
+    def write(self, final_path, data, callback=None) -> str:
+        """
+        Stages a file with the given bytes (or str) content.
+
+        Returns:
+            str: The final path of the file.
+        """
+        staged_path = self.stage_path(final_path)
+        tmp_path = f"{staged_path}.part"
+        with open(tmp_path, 'w' if isinstance(data, str) else 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, staged_path)
+        return self.commit(staged_path, callback)
+
+    def buffer_log(self, logger, capacity=1000):
+        """
+        Buffers the records of a logger (an ErrorLogger or a logging.Logger)
+        in memory, they are written at every flush. Critical records are
+        written immediately.
+        """
+        target_logger = getattr(logger, 'logger', logger)
+        for handler in list(target_logger.handlers):
+            if isinstance(handler, MemoryHandler):
+                continue
+            buffer = MemoryHandler(capacity, flushLevel=logging.CRITICAL, target=handler)
+            target_logger.removeHandler(handler)
+            target_logger.addHandler(buffer)
+            self.log_buffers.append(buffer)
+
+    def _flush_loop(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                pending_since = self.pending_since
+            timeout = self.max_loss_s if pending_since is None else pending_since + self.max_loss_s - time.monotonic()
+            self.wake_event.wait(max(0.0, timeout))
+            self.wake_event.clear()
+            if self.stop_event.is_set():
+                break
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Moves all committed files to persistent storage and writes the
+        buffered log records.
+
+        Returns:
+            int: The number of flushed files.
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                self.pending_bytes, self.pending_since = 0, None
+            for buffer in self.log_buffers:
+                buffer.flush()
+            if not batch:
+                return 0
+
+            directories = {}
+            for item in batch:
+                directories.setdefault(os.path.dirname(item.final_path), []).append(item)
+            flushed, failed = [], []
+            for directory in sorted(directories):
+                items = directories[directory]
+                try:
+                    self._flush_directory(directory, items)
+                    flushed += items
+                except OSError as e:
+                    self.log_error(f"Error flushing {len(items)} staged files to {directory}: {e}")
+                    failed += items
+
+            if failed:
+                # Retried at the next flush, the staged files are kept
+                with self.lock:
+                    self.pending = failed + self.pending
+                    self.pending_bytes += sum(item.size for item in failed)
+                    self.pending_since = self.pending_since or time.monotonic()
+            for item in flushed:
+                try:
+                    os.remove(item.staged_path)
+                except FileNotFoundError:
+                    pass
+                if item.callback is not None:
+                    try:
+                        item.callback(item.final_path)
+                    except Exception as e:
+                        self.log_error(f"Error in the flush callback of {item.final_path}: {e}")
+            with self.lock:
+                self.stats["flushes"] += 1
+                self.stats["flushed_files"] += len(flushed)
+                self.stats["flushed_bytes"] += sum(item.size for item in flushed)
+            if time.monotonic() - self.last_report > 3600:
+                self.report()
+            return len(flushed)
+
+    @staticmethod
+    def _flush_directory(directory, items):
+        """
+        Writes the staged files of one directory sequentially, then syncs
+        them, renames them into place and syncs the directory once.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for item in items:
+            with open(item.staged_path, 'rb') as source, open(f"{item.final_path}.part", 'wb') as target:
+                shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        for item in items:
+            fd = os.open(f"{item.final_path}.part", os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for item in items:
+            os.replace(f"{item.final_path}.part", item.final_path)
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def write_stats(self) -> dict:
+        """
+        Returns the flush statistics and the write amplification: bytes
+        written to the persistent block device per flushed byte. The device
+        counters include the writes of all processes on the device.
+        """
+        requests, written = disk_write_counters(self.persistent_path)
+        with self.lock:
+            stats = dict(self.stats)
+        stats["device_write_requests"] = requests - self.disk_counters_start[0]
+        stats["device_write_bytes"] = written - self.disk_counters_start[1]
+        stats["write_amplification"] = (
+            stats["device_write_bytes"] / stats["flushed_bytes"] if stats["flushed_bytes"] else None)
+        return stats
+
+    def report(self) -> None:
+        self.last_report = time.monotonic()
+        if self.logger is not None:
+            self.logger.log_info(f"Staging tier of {self.service}: {self.write_stats()}")
+
+    def close(self) -> None:
+        """
+        Stops the flush thread and flushes everything that is staged.
+        """
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.wake_event.set()
+        self.flush_thread.join()
+        self.flush()
+        self.report()
+        for buffer in self.log_buffers:
+            buffer.flush()
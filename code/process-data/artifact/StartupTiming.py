@@ -0,0 +1,59 @@
+import json
+import os
+import time
+
+STARTUP_TIMING_DIR = '/home/plense/error_logs/startup_timing'
+
+_module_loaded_at = time.monotonic()
+_recorded = set()
+
+
+def process_uptime() -> float:
+    """
+    Returns the number of seconds since the current process was started,
+    including interpreter start and imports. Falls back to the time since
+    this module was imported if /proc is not available.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the command name, field 22 (starttime) is index 19
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _module_loaded_at
+
+
+def record_milestone(service, milestone, directory=STARTUP_TIMING_DIR) -> None:
+    """
+    Records the seconds since process start at which a startup milestone was
+    reached, in `<directory>/<service>.json`. Only the first occurrence of a
+    milestone per process is recorded. The file is rewritten by every new
+    process, the startup benchmark reads it.
+
+    Parameters:
+        service (str): Name of the service, e.g. 'process-data'.
+        milestone (str): Name of the milestone, e.g. 'first_file_processed'.
+        directory (str): Directory of the startup timing files.
+    """
+    if milestone in _recorded:
+        return
+    _recorded.add(milestone)
+    try:
+        elapsed = process_uptime()
+        filepath = os.path.join(directory, f"{service}.json")
+        timing = {}
+        if os.path.exists(filepath):
+            with open(filepath) as f:
+                timing = json.load(f)
+        if timing.get("pid") != os.getpid():
+            timing = {"service": service, "pid": os.getpid(), "started_at": time.time() - elapsed, "milestones": {}}
+        timing["milestones"][milestone] = round(elapsed, 4)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(timing, f, indent=4)
+        os.replace(tmp_path, filepath)
+    except Exception as e:
+        print(f"Could not record startup milestone {milestone} of {service}: {e}")
@@ -0,0 +1,317 @@
+import atexit
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_TIMESERIES_DB = '/home/plense/plensor_data/index/timeseries.db'
+ENV_FIELDS = ('inside_temperature', 'outside_temperature', 'inside_humidity', 'outside_humidity')
+# Keys of the reading returned by Sensor.measure_env()
+ENV_MEASUREMENT_KEYS = {
+    'inside_temperature': 'inside_temp',
+    'outside_temperature': 'outside_temp',
+    'inside_humidity': 'inside_humidity',
+    'outside_humidity': 'outside_humidity',
+}
+
+
+def to_epoch_seconds(timestamp) -> float:
+    """
+    Converts a record timestamp to epoch seconds. Accepts epoch seconds, a
+    datetime, a Plense timestamp (`2025-01-01T120000`) or an ISO timestamp.
+    """
+    if timestamp is None:
+        return time.time()
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+    try:
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H%M%S").timestamp()
+    except ValueError:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+
+def env_values(reading) -> tuple:
+    """
+    Returns the inside/outside temperature and humidity of an ENV reading,
+    either with the keys of Sensor.measure_env() or with the full names.
+    """
+    return tuple(
+        reading.get(field, reading.get(ENV_MEASUREMENT_KEYS[field])) for field in ENV_FIELDS)
+
+
+class TimeSeriesStore:
+    """
+    TimeSeriesStore keeps the ENV and TOF readings of all sensors in one
+    SQLite database (WAL mode) instead of a JSON file per reading, indexed
+    by (sensor_id, timestamp) for range queries.
+
+    Rows are buffered and committed in batches, when `batch_size` rows are
+    pending or at the latest `max_delay` seconds after the first pending
+    row, so a reading costs one small append to the WAL instead of a file
+    create. A crash loses at most the rows of the last `max_delay` seconds;
+    `flush()` and `close()` commit immediately and are also run at exit.
+
+    The measure service writes the readings and the processing service
+    reads them, both open the same database.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, db_path=DEFAULT_TIMESERIES_DB, logger=None):
+        if cls._instance is None:
+            cls._instance = cls(db_path, logger=logger)
+        return cls._instance
+
+    def __init__(self, db_path=DEFAULT_TIMESERIES_DB, logger=None, batch_size=100, max_delay=5.0):
+        if self._instance is not None:
+            raise Exception("TimeSeriesStore is a singleton!")
+        self.logger = logger
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.pending = {'env_readings': [], 'tof_readings': []}
+        self.pending_since = None
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode a commit with synchronous=NORMAL is durable after the
+        # next checkpoint, which saves an fsync per batch on the SD card
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_loop, name='timeseries-flush', daemon=True)
+        self.flush_thread.start()
+        atexit.register(self.close)
+
+    def create_tables(self):
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS env_readings (
+                    sensor_id INTEGER,
+                    timestamp REAL,
+                    inside_temperature REAL,
+                    outside_temperature REAL,
+                    inside_humidity REAL,
+                    outside_humidity REAL
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_env_sensor_time ON env_readings(sensor_id, timestamp)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS tof_readings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sensor_id INTEGER,
+                    timestamp REAL,
+                    command TEXT,
+                    tof_half_periods INTEGER,
+                    repetitions INTEGER,
+                    damping_level INTEGER,
+                    deltas BLOB
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_tof_sensor_time ON tof_readings(sensor_id, timestamp)")
+
+    def log_error(self, message):
+        if self.logger is not None:
+            self.logger.log_error(message)
+        else:
+            print(message)
+
+    def add_env(self, sensor_id, timestamp, inside_temperature, outside_temperature, inside_humidity, outside_humidity):
+        """
+        Buffers an ENV reading.
+
+        Parameters:
+            sensor_id (int): Sensor id.
+            timestamp: Time of the reading, see `to_epoch_seconds`.
+            inside_temperature, outside_temperature (float): In degrees C.
+            inside_humidity, outside_humidity (float): Relative humidity in %.
+        """
+        self._append('env_readings', (
+            int(sensor_id), to_epoch_seconds(timestamp),
+            inside_temperature, outside_temperature, inside_humidity, outside_humidity))
+
+    def add_tof(self, sensor_id, timestamp, deltas, command='TOF_BLOCK', tof_half_periods=0, repetitions=None, damping_level=None):
+        """
+        Buffers a TOF reading. The deltas (in ns) are stored as an int32 blob.
+
+        Parameters:
+            sensor_id (int): Sensor id.
+            timestamp: Time of the reading, see `to_epoch_seconds`.
+            deltas (list): The TOF deltas of all repetitions.
+            command (str): TOF or TOF_BLOCK.
+            tof_half_periods (int): Half periods of the TOF_BLOCK, 0 for TOF.
+            repetitions (int): Requested number of repetitions.
+            damping_level (int): Damping level of the measurement.
+        """
+        self._append('tof_readings', (
+            int(sensor_id), to_epoch_seconds(timestamp), command, int(tof_half_periods or 0),
+            repetitions, damping_level, struct.pack(f'<{len(deltas)}i', *deltas)))
+
+    def _append(self, table, row):
+        with self.lock:
+            self.pending[table].append(row)
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            if sum(len(rows) for rows in self.pending.values()) >= self.batch_size:
+                self._commit_pending()
+
+    def _commit_pending(self):
+        """
+        Commits the buffered rows in one transaction, the lock must be held.
+        """
+        if self.pending_since is None:
+            return
+        try:
+            with self.connection:
+                if self.pending['env_readings']:
+                    self.connection.executemany(
+                        "INSERT INTO env_readings (sensor_id, timestamp, inside_temperature, outside_temperature, "
+                        "inside_humidity, outside_humidity) VALUES (?, ?, ?, ?, ?, ?)",
+                        self.pending['env_readings'])
+                if self.pending['tof_readings']:
+                    self.connection.executemany(
+                        "INSERT INTO tof_readings (sensor_id, timestamp, command, tof_half_periods, repetitions, "
+                        "damping_level, deltas) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        self.pending['tof_readings'])
+            self.pending = {table: [] for table in self.pending}
+            self.pending_since = None
+        except sqlite3.Error as e:
+            # Keep the rows buffered, they are retried with the next flush
+            self.log_error(f"Error committing time series readings to {self.db_path}: {e}")
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(min(1.0, self.max_delay)):
+            with self.lock:
+                if self.pending_since is not None and time.monotonic() - self.pending_since >= self.max_delay:
+                    self._commit_pending()
+
+    def flush(self) -> None:
+        """
+        Commits all buffered readings.
+        """
+        with self.lock:
+            self._commit_pending()
+
+    def get_env(self, sensor_id, start=None, end=None) -> dict:
+        """
+        Returns the ENV readings of a sensor between `start` and `end` (epoch
+        seconds), ordered by time, as a dict of numpy arrays with the keys
+        `timestamp` and the ENV_FIELDS.
+        """
+        # Imported on first use, the measure service writes readings
+        # without loading numpy
+        import numpy as np
+        conditions, parameters = self._range_conditions(sensor_id, start, end)
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT timestamp, {', '.join(ENV_FIELDS)} FROM env_readings "
+                f"WHERE {' AND '.join(conditions)} ORDER BY timestamp", parameters).fetchall()
+        columns = np.array(rows, dtype=np.float64).reshape(-1, len(ENV_FIELDS) + 1)
+        return {name: columns[:, i] for i, name in enumerate(('timestamp',) + ENV_FIELDS)}
+
+    def get_tof(self, sensor_id=None, start=None, end=None, after_id=None, limit=None) -> list:
+        """
+        Returns TOF readings ordered by id (the insertion order), optionally
+        for one sensor, between `start` and `end` (epoch seconds) and after
+        the reading with id `after_id`. The deltas are returned as numpy
+        int32 arrays.
+        """
+        import numpy as np
+        conditions, parameters = self._range_conditions(sensor_id, start, end)
+        if after_id is not None:
+            conditions.append("id > ?")
+            parameters.append(after_id)
+        query = f"SELECT * FROM tof_readings WHERE {' AND '.join(conditions) or '1'} ORDER BY id"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        readings = []
+        for row in rows:
+            reading = dict(row)
+            reading["deltas"] = np.frombuffer(row["deltas"], dtype='<i4')
+            readings.append(reading)
+        return readings
+
+    @staticmethod
+    def _range_conditions(sensor_id, start, end) -> tuple:
+        conditions, parameters = [], []
+        if sensor_id is not None:
+            conditions.append("sensor_id = ?")
+            parameters.append(int(sensor_id))
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(end)
+        return conditions, parameters
+
+    def import_env_files(self, paths) -> int:
+        """
+        Imports legacy `ENV#xxxxx_<ts>.json` files written by the measure
+        service before this store existed. The files are kept.
+
+        Returns:
+            int: Number of imported readings.
+        """
+        count = 0
+        for path in paths:
+            try:
+                name = os.path.splitext(os.path.basename(path))[0]
+                sensor_id, timestamp = name[len('ENV#'):].split('_', 1)
+                with open(path) as f:
+                    reading = json.load(f)
+                self.add_env(int(sensor_id), timestamp, *env_values(reading))
+                count += 1
+            except (OSError, ValueError, KeyError) as e:
+                self.log_error(f"Skipping {path}: {e}")
+        self.flush()
+        return count
+
+    def close(self) -> None:
+        """
+        Commits the buffered readings and closes the database.
+        """
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.flush_thread.join(timeout=5)
+        with self.lock:
+            self._commit_pending()
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+
+    parser = argparse.ArgumentParser(description="Time series store of ENV and TOF readings")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import-env', help="import legacy ENV JSON files")
+    import_parser.add_argument('directory', nargs='?', default='/home/plense/plensor_data/environment_data')
+    query_parser = subparsers.add_parser('env', help="print the ENV readings of a sensor")
+    query_parser.add_argument('sensor_id', type=int)
+    query_parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--db', default=DEFAULT_TIMESERIES_DB)
+    args = parser.parse_args()
+
+    store = TimeSeriesStore.get_instance(args.db)
+    if args.command == 'import-env':
+        files = sorted(glob.glob(os.path.join(args.directory, 'ENV#*.json')))
+        print(f"Imported {store.import_env_files(files)} of {len(files)} ENV files into {args.db}")
+    else:
+        readings = store.get_env(args.sensor_id, start=time.time() - args.hours * 3600)
+        for i, timestamp in enumerate(readings['timestamp']):
+            values = " ".join(f"{readings[field][i]:8.2f}" for field in ENV_FIELDS)
+            print(f"{datetime.fromtimestamp(timestamp)} {values}")
+    store.close()
@@ -0,0 +1,387 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+from ErrorLogger import ErrorLogger
+from xedge_plense_tools import LocalDataLoader_edge
+
+TOF_PIPELINE_VERSION = 'tof001-v1'
+
+# Key used for the running statistics over all tof_half_periods of a sensor
+ALL_HALF_PERIODS = -1
+
+
+class TofOperator:
+    """
+    Vectorized robust statistics of the nanosecond deltas of one TOF
+    measurement.
+    """
+
+    @staticmethod
+    def robust_statistics(deltas, trim_fraction=0.1, outlier_threshold=3.5) -> dict:
+        """
+        Computes the median, MAD, trimmed mean and an outlier mask of the TOF
+        deltas of one measurement. A delta is an outlier if its modified
+        z-score |x - median| / (1.4826 * MAD) exceeds `outlier_threshold`.
+        When more than half of the deltas are equal the MAD is 0, the score
+        then uses 1.2533 times the mean absolute deviation instead
+        (Iglewicz & Hoaglin).
+
+        Parameters:
+            deltas (list): The TOF deltas in nanoseconds.
+            trim_fraction (float): Fraction cut from both ends for the trimmed mean.
+            outlier_threshold (float): Modified z-score above which a delta is an outlier.
+
+        Returns:
+            dict: median, mad, trimmed_mean, inlier_mean, inlier_std, count,
+                outlier_count and outlier_mask (np.ndarray of bool).
+        """
+        x = np.asarray(deltas, dtype=np.float64)
+        if x.size == 0:
+            raise ValueError("No TOF deltas to compute statistics of")
+        median = np.median(x)
+        absolute_deviation = np.abs(x - median)
+        mad = np.median(absolute_deviation)
+        mean_absolute_deviation = np.mean(absolute_deviation)
+        if mad > 0:
+            outlier_mask = absolute_deviation / (1.4826 * mad) > outlier_threshold
+        elif mean_absolute_deviation > 0:
+            outlier_mask = absolute_deviation / (1.2533 * mean_absolute_deviation) > outlier_threshold
+        else:
+            # All deltas are equal
+            outlier_mask = np.zeros(x.shape, dtype=bool)
+
+        cut = int(trim_fraction * x.size)
+        trimmed = np.sort(x)[cut:x.size - cut] if x.size > 2 * cut else x
+        inliers = x[~outlier_mask]
+        return {
+            "median": float(median),
+            "mad": float(mad),
+            "trimmed_mean": float(np.mean(trimmed)),
+            "inlier_mean": float(np.mean(inliers)),
+            "inlier_std": float(np.std(inliers)),
+            "count": int(x.size),
+            "outlier_count": int(np.count_nonzero(outlier_mask)),
+            "outlier_mask": outlier_mask,
+        }
+
+
+class P2Quantile:
+    """
+    P-square estimator of a single quantile (Jain & Chlamtac, 1985). Keeps
+    five markers, so the memory use does not grow with the number of values.
+    """
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        """
+        Adds one value to the estimator.
+        """
+        if len(self.heights) < 5:
+            self.heights.append(value)
+            self.heights.sort()
+            return
+
+        heights, positions = self.heights, self.positions
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = next(i for i in range(4) if heights[i] <= value < heights[i + 1])
+
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                candidate = self._parabolic(i, d)
+                if not heights[i - 1] < candidate < heights[i + 1]:
+                    candidate = heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+                heights[i] = candidate
+                positions[i] += d
+
+    def _parabolic(self, i, d):
+        heights, positions = self.heights, self.positions
+        return heights[i] + d / (positions[i + 1] - positions[i - 1]) * (
+            (positions[i] - positions[i - 1] + d) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i])
+            + (positions[i + 1] - positions[i] - d) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1]))
+
+    def value(self):
+        """
+        Returns the current quantile estimate, or None without values.
+        """
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return float(np.quantile(self.heights, self.quantile))
+        return float(self.heights[2])
+
+    def to_dict(self):
+        return {"quantile": self.quantile, "heights": self.heights, "positions": self.positions, "desired": self.desired}
+
+    @classmethod
+    def from_dict(cls, state):
+        estimator = cls(state["quantile"])
+        estimator.heights = state["heights"]
+        estimator.positions = state["positions"]
+        estimator.desired = state["desired"]
+        return estimator
+
+
+class RunningStatistics:
+    """
+    Incremental count, mean, variance (Welford), min, max and P-square
+    quantiles of a stream of values. The state is a small dict, so it can be
+    persisted and resumed without re-reading the history.
+    """
+
+    def __init__(self, quantiles=(0.05, 0.5, 0.95)):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.quantiles = [P2Quantile(q) for q in quantiles]
+
+    def add(self, value):
+        """
+        Adds one value to the running statistics.
+        """
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        for estimator in self.quantiles:
+            estimator.add(value)
+
+    def add_many(self, values):
+        for value in values:
+            self.add(value)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def summary(self):
+        """
+        Returns the current statistics as a flat dict.
+        """
+        summary = {
+            "count": self.count,
+            "mean": self.mean,
+            "std": float(np.sqrt(self.variance)),
+            "min": self.minimum,
+            "max": self.maximum,
+        }
+        for estimator in self.quantiles:
+            summary[f"p{int(round(estimator.quantile * 100)):02d}"] = estimator.value()
+        return summary
+
+    def to_dict(self):
+        return {
+            "count": self.count, "mean": self.mean, "m2": self.m2,
+            "minimum": self.minimum, "maximum": self.maximum,
+            "quantiles": [estimator.to_dict() for estimator in self.quantiles],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        statistics = cls(quantiles=())
+        statistics.count = state["count"]
+        statistics.mean = state["mean"]
+        statistics.m2 = state["m2"]
+        statistics.minimum = state["minimum"]
+        statistics.maximum = state["maximum"]
+        statistics.quantiles = [P2Quantile.from_dict(q) for q in state["quantiles"]]
+        return statistics
+
+
+class TofStatisticsStore:
+    """
+    TofStatisticsStore stores the robust statistics of every TOF measurement
+    and keeps running statistics of the inlier deltas per sensor and per
+    `tof_half_periods` (and over all half periods of a sensor). Dashboards can
+    read the running statistics directly instead of re-reading the history
+    of TOF JSON files.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, db_path='/home/plense/plensor_data/index/tof_statistics.db'):
+        if cls._instance is None:
+            cls._instance = cls(db_path)
+        return cls._instance
+
+    def __init__(self, db_path='/home/plense/plensor_data/index/tof_statistics.db'):
+        if self._instance is not None:
+            raise Exception("TofStatisticsStore is a singleton!")
+        self.logger = ErrorLogger.get_instance()
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS tof_measurements (
+                    source TEXT PRIMARY KEY,
+                    sensor_id INTEGER,
+                    command TEXT,
+                    tof_half_periods INTEGER,
+                    timestamp REAL,
+                    median REAL,
+                    mad REAL,
+                    trimmed_mean REAL,
+                    inlier_mean REAL,
+                    inlier_std REAL,
+                    count INTEGER,
+                    outlier_count INTEGER,
+                    outlier_mask TEXT
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_tof_sensor_time "
+                "ON tof_measurements(sensor_id, tof_half_periods, timestamp)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS tof_running (
+                    sensor_id INTEGER,
+                    tof_half_periods INTEGER,
+                    state TEXT,
+                    updated_at REAL,
+                    PRIMARY KEY (sensor_id, tof_half_periods)
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS tof_watermarks (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER
+                )""")
+
+    @staticmethod
+    def interpret_tof_basename(filename) -> dict:
+        """
+        Interprets a TOF filename, either `TOF#xxxxx_<ts>.json` or
+        `TOF_BLOCKh<hhh>r<rrr>l<lll>#xxxxx_<ts>.json`. TOF impulse
+        measurements get 0 half periods.
+        """
+        match = re.match(
+            r'^(TOF(?:_BLOCK)?)(?:h(\d+)r(\d+)l(\d+))?#(\d+)_([^.]+)\.json$',
+            os.path.basename(filename))
+        if not match:
+            raise ValueError(f"nonvalid TOF file name: {filename}")
+        command, half_periods, _, _, sensor_id, timestamp = match.groups()
+        return {
+            "command": command,
+            "tof_half_periods": int(half_periods) if half_periods else 0,
+            "sensor_id": int(sensor_id),
+            "timestamp": LocalDataLoader_edge.plense_stringtime_to_datetime(timestamp).timestamp(),
+        }
+
+    def add_measurement(self, source, sensor_id, tof_half_periods, timestamp, deltas, command='TOF_BLOCK'):
+        """
+        Computes and stores the robust statistics of one TOF measurement and
+        folds its inlier deltas into the running statistics. A measurement
+        that is already stored is not counted twice.
+
+        Returns:
+            dict: The robust statistics of the measurement.
+        """
+        statistics = TofOperator.robust_statistics(deltas)
+        inliers = np.asarray(deltas, dtype=np.float64)[~statistics["outlier_mask"]]
+        with self.lock, self.connection:
+            cursor = self.connection.execute("""
+                INSERT OR IGNORE INTO tof_measurements
+                (source, sensor_id, command, tof_half_periods, timestamp, median, mad, trimmed_mean,
+                 inlier_mean, inlier_std, count, outlier_count, outlier_mask)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (source, sensor_id, command, tof_half_periods, timestamp,
+                 statistics["median"], statistics["mad"], statistics["trimmed_mean"],
+                 statistics["inlier_mean"], statistics["inlier_std"], statistics["count"],
+                 statistics["outlier_count"],
+                 json.dumps(statistics["outlier_mask"].astype(int).tolist())))
+            if cursor.rowcount:
+                for key in (tof_half_periods, ALL_HALF_PERIODS):
+                    running = self._load_running(sensor_id, key)
+                    running.add_many(inliers)
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO tof_running (sensor_id, tof_half_periods, state, updated_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        (sensor_id, key, json.dumps(running.to_dict()), time.time()))
+        return statistics
+
+    def _load_running(self, sensor_id, tof_half_periods):
+        row = self.connection.execute(
+            "SELECT state FROM tof_running WHERE sensor_id = ? AND tof_half_periods = ?",
+            (sensor_id, tof_half_periods)).fetchone()
+        return RunningStatistics.from_dict(json.loads(row["state"])) if row else RunningStatistics()
+
+    def get_running_statistics(self, sensor_id, tof_half_periods=ALL_HALF_PERIODS) -> dict:
+        """
+        Returns the running statistics summary of a sensor, for one
+        `tof_half_periods` setting or over all of them.
+        """
+        with self.lock:
+            return self._load_running(sensor_id, tof_half_periods).summary()
+
+    def get_measurements(self, sensor_id, tof_half_periods=None, start=None, end=None) -> list:
+        """
+        Returns the per-measurement statistics of a sensor, ordered by time.
+        """
+        conditions, parameters = ["sensor_id = ?"], [sensor_id]
+        if tof_half_periods is not None:
+            conditions.append("tof_half_periods = ?")
+            parameters.append(tof_half_periods)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(end)
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT * FROM tof_measurements WHERE {' AND '.join(conditions)} ORDER BY timestamp",
+                parameters).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_watermark(self, name) -> int:
+        """
+        Returns the last processed id of an input, e.g. the TOF readings of
+        the time series store, 0 if nothing was processed yet.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM tof_watermarks WHERE name = ?", (name,)).fetchone()
+        return row["value"] if row else 0
+
+    def set_watermark(self, name, value):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tof_watermarks (name, value) VALUES (?, ?)", (name, int(value)))
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,379 @@
+import atexit
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_TREND_DB = '/home/plense/plensor_data/index/trends.db'
+LEGACY_CONTINUOUS_DB = '/home/plense/metadata/continuous_measurements.db'
+
+# Rollup resolutions, from fine to coarse, with their bucket size in seconds
+RESOLUTIONS = (('1m', 60), ('1h', 3600), ('1d', 86400))
+RAW = 'raw'
+# Days the raw points and the 1 minute rollups are kept by `prune`, the
+# coarser rollups are kept forever
+RETENTION_DAYS = {RAW: 90, '1m': 365}
+# Sensor id of the points of a plan that were not recorded per sensor
+ANY_SENSOR = 0
+
+# Per-day tables of the continuous measurement window, before this store
+LEGACY_TABLE = re.compile(r'^continuous_(?P<plan>.+)_(?P<date>\d{8})$')
+
+
+def max_amplitude(samples) -> int:
+    """
+    Returns the largest absolute sample of a measurement.
+    """
+    return max(max(samples), -min(samples)) if len(samples) else 0
+
+
+class TrendStore:
+    """
+    TrendStore keeps the trend metrics of the measurement plans (e.g. the
+    max amplitude of every run) in one SQLite database, keyed by (sensor,
+    plan, metric, time), instead of a table per plan per day.
+
+    Points are stored in `trend_points`, clustered by their key, so the
+    points of one series in a time range are one range scan. For every
+    point, the rollups of its 1 minute, 1 hour and 1 day bucket (min, max,
+    sum and count) are updated in the same transaction, so a query over
+    months reads a few hundred rollup rows instead of every point. `series`
+    picks the finest resolution that fits the number of points asked for.
+
+    As in TimeSeriesStore, points are buffered and committed in batches,
+    when `batch_size` points are pending or `max_delay` seconds after the
+    first pending point. The measure service writes the points, the GUIs
+    read them.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, db_path=DEFAULT_TREND_DB, logger=None):
+        if cls._instance is None:
+            cls._instance = cls(db_path, logger=logger)
+        return cls._instance
+
+    def __init__(self, db_path=DEFAULT_TREND_DB, logger=None, batch_size=100, max_delay=5.0):
+        if self._instance is not None:
+            raise Exception("TrendStore is a singleton!")
+        self.logger = logger
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_since = None
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_loop, name='trend-flush', daemon=True)
+        self.flush_thread.start()
+        atexit.register(self.close)
+
+    def create_tables(self):
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS trend_points (
+                    sensor_id INTEGER NOT NULL,
+                    plan TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    timestamp REAL NOT NULL,
+                    value REAL,
+                    PRIMARY KEY (sensor_id, plan, metric, timestamp)
+                ) WITHOUT ROWID""")
+            for resolution, _ in RESOLUTIONS:
+                self.connection.execute(f"""
+                    CREATE TABLE IF NOT EXISTS trend_rollup_{resolution} (
+                        sensor_id INTEGER NOT NULL,
+                        plan TEXT NOT NULL,
+                        metric TEXT NOT NULL,
+                        bucket REAL NOT NULL,
+                        min_value REAL,
+                        max_value REAL,
+                        sum_value REAL,
+                        count INTEGER,
+                        PRIMARY KEY (sensor_id, plan, metric, bucket)
+                    ) WITHOUT ROWID""")
+
+    def log_error(self, message):
+        if self.logger is not None:
+            self.logger.log_error(message)
+        else:
+            print(message)
+
+    def add(self, sensor_id, plan, metric, timestamp, value) -> None:
+        """
+        Buffers a trend point.
+
+        Parameters:
+            sensor_id (int): Sensor id, ANY_SENSOR for a point of the plan.
+            plan (str): Plan name, "" outside a measurement plan.
+            metric (str): Metric name, e.g. "max_amplitude".
+            timestamp (float): Epoch seconds.
+            value (float): The value of the metric.
+        """
+        with self.lock:
+            self.pending.append((int(sensor_id), plan or "", metric, float(timestamp), float(value)))
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            if len(self.pending) >= self.batch_size:
+                self._commit_pending()
+
+    def _commit_pending(self):
+        """
+        Commits the buffered points and their rollups in one transaction,
+        the lock must be held. A point that is already stored (same key) is
+        not rolled up again.
+        """
+        if self.pending_since is None:
+            return
+        try:
+            with self.connection:
+                rollups = {resolution: {} for resolution, _ in RESOLUTIONS}
+                for point in self.pending:
+                    inserted = self.connection.execute(
+                        "INSERT OR IGNORE INTO trend_points (sensor_id, plan, metric, timestamp, value) "
+                        "VALUES (?, ?, ?, ?, ?)", point).rowcount
+                    if not inserted:
+                        continue
+                    sensor_id, plan, metric, timestamp, value = point
+                    for resolution, seconds in RESOLUTIONS:
+                        key = (sensor_id, plan, metric, timestamp // seconds * seconds)
+                        bucket = rollups[resolution].get(key)
+                        if bucket is None:
+                            rollups[resolution][key] = [value, value, value, 1]
+                        else:
+                            bucket[0] = min(bucket[0], value)
+                            bucket[1] = max(bucket[1], value)
+                            bucket[2] += value
+                            bucket[3] += 1
+                for resolution, buckets in rollups.items():
+                    self.connection.executemany(
+                        f"INSERT INTO trend_rollup_{resolution} "
+                        f"(sensor_id, plan, metric, bucket, min_value, max_value, sum_value, count) "
+                        f"VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                        f"ON CONFLICT(sensor_id, plan, metric, bucket) DO UPDATE SET "
+                        f"min_value = MIN(min_value, excluded.min_value), "
+                        f"max_value = MAX(max_value, excluded.max_value), "
+                        f"sum_value = sum_value + excluded.sum_value, "
+                        f"count = count + excluded.count",
+                        [key + tuple(bucket) for key, bucket in buckets.items()])
+            self.pending = []
+            self.pending_since = None
+        except sqlite3.Error as e:
+            # Keep the points buffered, they are retried with the next flush
+            self.log_error(f"Error committing trend points to {self.db_path}: {e}")
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(min(1.0, self.max_delay)):
+            with self.lock:
+                if self.pending_since is not None and time.monotonic() - self.pending_since >= self.max_delay:
+                    self._commit_pending()
+
+    def flush(self) -> None:
+        """
+        Commits all buffered points.
+        """
+        with self.lock:
+            self._commit_pending()
+
+    def series_keys(self, plan=None, metric=None) -> list:
+        """
+        Returns the (sensor_id, plan, metric) of every stored series,
+        optionally of one plan or metric.
+        """
+        conditions, parameters = [], []
+        if plan is not None:
+            conditions.append("plan = ?")
+            parameters.append(plan)
+        if metric is not None:
+            conditions.append("metric = ?")
+            parameters.append(metric)
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT DISTINCT sensor_id, plan, metric FROM trend_rollup_1d "
+                f"WHERE {' AND '.join(conditions) or '1'} ORDER BY plan, metric, sensor_id", parameters).fetchall()
+        return [tuple(row) for row in rows]
+
+    def _bounds(self, key, start, end) -> tuple:
+        """
+        Returns the time range of a series within `start` and `end`, and an
+        upper bound of its number of points, from the daily rollups.
+        """
+        conditions = ["sensor_id = ? AND plan = ? AND metric = ?"]
+        parameters = list(key)
+        if start is not None:
+            conditions.append("bucket >= ?")
+            parameters.append(start // 86400 * 86400)
+        if end is not None:
+            conditions.append("bucket < ?")
+            parameters.append(end)
+        row = self.connection.execute(
+            f"SELECT MIN(bucket), MAX(bucket), SUM(count) FROM trend_rollup_1d WHERE {' AND '.join(conditions)}",
+            parameters).fetchone()
+        if row[0] is None:
+            return None, None, 0
+        first = row[0] if start is None else max(row[0], start)
+        last = row[1] + 86400 if end is None else min(row[1] + 86400, end)
+        return first, last, row[2]
+
+    def series(self, sensor_id, plan, metric, start=None, end=None, max_points=2000, resolution=None) -> dict:
+        """
+        Returns a series between `start` and `end` (epoch seconds), ordered
+        by time, as a dict of numpy arrays `timestamp`, `min`, `max`, `mean`
+        and `count`, and the `resolution` it was read at.
+
+        Parameters:
+            max_points (int): The number of points the series should have at
+                most, e.g. the width of the plot in pixels. The raw points are
+                returned if there are no more, else the finest rollup with at
+                most `max_points` buckets (the daily rollup if none has). The
+                raw points and the 1 minute rollup are only picked if the
+                range lies within their RETENTION_DAYS.
+            resolution (str): RAW or a resolution of RESOLUTIONS, to read at
+                that resolution instead.
+        """
+        # Imported on first use, the measure service writes points without
+        # loading numpy
+        import numpy as np
+        key = (int(sensor_id), plan or "", metric)
+        self.flush()
+        with self.lock:
+            if resolution is None:
+                first, last, points = self._bounds(key, start, end)
+
+                def retained(name):
+                    days = RETENTION_DAYS.get(name)
+                    return first is None or days is None or first >= time.time() - days * 86400
+
+                resolution = RESOLUTIONS[-1][0]
+                if points <= max_points and retained(RAW):
+                    resolution = RAW
+                else:
+                    for name, seconds in RESOLUTIONS:
+                        if (last - first) / seconds <= max_points and retained(name):
+                            resolution = name
+                            break
+            if resolution == RAW:
+                query = ("SELECT timestamp, value, value, value, 1 FROM trend_points "
+                         "WHERE sensor_id = ? AND plan = ? AND metric = ?")
+                column = "timestamp"
+            else:
+                query = (f"SELECT bucket, min_value, max_value, sum_value / count, count FROM trend_rollup_{resolution} "
+                         f"WHERE sensor_id = ? AND plan = ? AND metric = ?")
+                column = "bucket"
+            parameters = list(key)
+            if start is not None:
+                # The bucket that `start` falls in
+                seconds = dict(RESOLUTIONS).get(resolution)
+                query += f" AND {column} >= ?"
+                parameters.append(start // seconds * seconds if seconds else start)
+            if end is not None:
+                query += f" AND {column} < ?"
+                parameters.append(end)
+            rows = self.connection.execute(f"{query} ORDER BY {column}", parameters).fetchall()
+        columns = np.array(rows, dtype=np.float64).reshape(-1, 5)
+        series = {name: columns[:, i] for i, name in enumerate(('timestamp', 'min', 'max', 'mean', 'count'))}
+        series['resolution'] = resolution
+        return series
+
+    def prune(self, raw_days=RETENTION_DAYS[RAW], minute_days=RETENTION_DAYS['1m']) -> None:
+        """
+        Removes the raw points older than `raw_days` and the 1 minute
+        rollups older than `minute_days`. The hourly and daily rollups are
+        kept, so long trends stay available.
+        """
+        now = time.time()
+        self.flush()
+        try:
+            with self.lock, self.connection:
+                self.connection.execute("DELETE FROM trend_points WHERE timestamp < ?", (now - raw_days * 86400,))
+                self.connection.execute("DELETE FROM trend_rollup_1m WHERE bucket < ?", (now - minute_days * 86400,))
+        except sqlite3.Error as e:
+            self.log_error(f"Error pruning the trend store: {e}")
+
+    def import_legacy(self, path=LEGACY_CONTINUOUS_DB, drop=False) -> int:
+        """
+        Imports the per-day `continuous_<plan>_<YYYYMMDD>` tables (timestamp,
+        max_amplitude) of the continuous measurement window as the
+        max_amplitude series of their plan, with sensor ANY_SENSOR. Points
+        that were already imported are skipped.
+
+        Parameters:
+            drop (bool): Drop the imported tables.
+
+        Returns:
+            int: Number of read points.
+        """
+        count = 0
+        legacy = sqlite3.connect(path)
+        try:
+            tables = [row[0] for row in legacy.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            for table in tables:
+                match = LEGACY_TABLE.match(table)
+                if match is None:
+                    continue
+                for timestamp, value in legacy.execute(f'SELECT timestamp, max_amplitude FROM "{table}"'):
+                    if timestamp is not None and value is not None:
+                        self.add(ANY_SENSOR, match["plan"].replace('_', ' '), 'max_amplitude', timestamp, value)
+                        count += 1
+                self.flush()
+                if drop:
+                    with legacy:
+                        legacy.execute(f'DROP TABLE "{table}"')
+        finally:
+            legacy.close()
+        return count
+
+    def close(self) -> None:
+        """
+        Commits the buffered points and closes the database.
+        """
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.flush_thread.join(timeout=5)
+        with self.lock:
+            self._commit_pending()
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Trend store of the measurement plans")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import-legacy', help="import the per-day tables of continuous_measurements.db")
+    import_parser.add_argument('path', nargs='?', default=LEGACY_CONTINUOUS_DB)
+    import_parser.add_argument('--drop', action='store_true', help="drop the imported tables")
+    subparsers.add_parser('keys', help="list the stored series")
+    series_parser = subparsers.add_parser('series', help="print a series")
+    series_parser.add_argument('sensor_id', type=int)
+    series_parser.add_argument('plan')
+    series_parser.add_argument('--metric', default='max_amplitude')
+    series_parser.add_argument('--days', type=float, default=30)
+    series_parser.add_argument('--max-points', type=int, default=50)
+    parser.add_argument('--db', default=DEFAULT_TREND_DB)
+    args = parser.parse_args()
+
+    store = TrendStore.get_instance(args.db)
+    if args.command == 'import-legacy':
+        print(f"Imported {store.import_legacy(args.path, drop=args.drop)} points from {args.path} into {args.db}")
+    elif args.command == 'keys':
+        for sensor_id, plan, metric in store.series_keys():
+            print(f"{sensor_id:6d} {plan!r:40} {metric}")
+    else:
+        series = store.series(args.sensor_id, args.plan, args.metric, start=time.time() - args.days * 86400,
+                              max_points=args.max_points)
+        print(f"Resolution: {series['resolution']}")
+        for i, timestamp in enumerate(series['timestamp']):
+            print(f"{datetime.fromtimestamp(timestamp)} min {series['min'][i]:10.2f} max {series['max'][i]:10.2f} "
+                  f"mean {series['mean'][i]:10.2f} ({int(series['count'][i])})")
+    store.close()
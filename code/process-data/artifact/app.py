@@ -1,10 +1,25 @@
 import json
 import os
+import signal
+import sys
+import threading
 import time
 from datetime import datetime
 from ComponentHandler import ComponentHandler
+from DataLayout import PROCESSED_DIR, RAW_DIR
 from ErrorLogger import ErrorLogger
+from FeatureTable import FeatureTable
 from JSONHandler import JSONHandler
+from MeasurementCatalog import MeasurementCatalog
+from MeasurementContainer import DEFAULT_CONTAINER_ROOT, MeasurementContainer, list_containers
+from MeasurementHandoff import DEFAULT_SLOT_BYTES, DEFAULT_SLOTS, HandoffReceiver
+from PreProcessor import CONTAINER_SOURCE_PATTERN, FULL_SAMPLE_RATE, PIPELINE_VERSION, RAW_SOURCE_PATTERNS, RAW_SUFFIXES, Preprocessor
+from PreviewBuilder import DEFAULT_PREVIEW_DIR
+from ProcessingManifest import ProcessingManifest
+from StagingTier import StagingTier
+from StartupTiming import record_milestone
+from TimeSeriesStore import TimeSeriesStore, env_values
+from TofStatistics import TOF_PIPELINE_VERSION, TofStatisticsStore
 from xedge_plense_tools import PreprocessingOperator_edge
 
 
@@ -23,16 +38,62 @@ class SignalProcessor:
             log_level=40,
             log_file_name='ProcessDataLocal.log'
         )
-        self.edge_preprocessor = PreprocessingOperator_edge(
-            '/home/plense/plensor_data/audio_data/time_domain_not_processed',
-            '/home/plense/plensor_data/audio_data/time_domain_processed'
-        )
+        self.edge_preprocessor = PreprocessingOperator_edge(RAW_DIR, PROCESSED_DIR)
         self.logger.log_info("New instance started -------")
         self.logger.set_log_level('ERROR')
         self.component_handler = ComponentHandler()
         self.json_handler = JSONHandler.get_instance()
         self.metadata_dir = '/home/plense/metadata'
+        # Optional RAM staging tier, output files and log lines are flushed
+        # to the SD card in batches
+        app_settings = self.json_handler.safe_json_load(os.path.join(self.metadata_dir, 'app_settings.json')) or {}
+        self.staging = StagingTier.from_settings(app_settings.get("staging"), 'process-data', logger=self.logger)
+        self.raw_td_dir = RAW_DIR
+        self.tof_dir = '/home/plense/plensor_data/audio_data/tof'
+        self.manifest = ProcessingManifest.get_instance()
+        self.container_root = DEFAULT_CONTAINER_ROOT
+        # Files left 'processing' by a crash are processed again
+        self.manifest.requeue_stale()
+        self.tof_statistics = TofStatisticsStore.get_instance()
+        self.timeseries = TimeSeriesStore.get_instance(logger=self.logger)
+        self.feature_table = FeatureTable.get_instance()
+        self.catalog = MeasurementCatalog.get_instance(logger=self.logger)
+        # Id of the last catalog entry registered in the manifest, None until
+        # the raw directory has been scanned once
+        self.catalog_watermark = None
+        self.preprocessor = Preprocessor(
+            manifest=self.manifest,
+            feature_table=self.feature_table,
+            preview_dir=DEFAULT_PREVIEW_DIR,
+            catalog=self.catalog,
+            staging=self.staging)
+        if self.staging is not None:
+            # Processed files a crashed process staged are flushed and their
+            # sources finished, before anything new is staged
+            self.staging.recover(on_recover=self.preprocessor.finish_recovered_file)
+        if self.preprocessor.remove_raw:
+            # Processed raw files are removed, only the records in the
+            # containers can be processed again by a new pipeline version
+            self.logger.log_info("Raw files are removed after processing, only container records are re-queued "
+                                 "after a pipeline version bump")
+            self.manifest.requeue_outdated(PIPELINE_VERSION, suffix=CONTAINER_SOURCE_PATTERN)
+        else:
+            self.manifest.requeue_outdated(PIPELINE_VERSION, suffix=RAW_SOURCE_PATTERNS)
         self.running = True
+        # Optional shared-memory hand-off of fresh measurements from the
+        # measure service, processed as they arrive by a separate thread
+        self.handoff = None
+        handoff_settings = app_settings.get("handoff") or {}
+        if handoff_settings.get("enabled", False):
+            try:
+                self.handoff = HandoffReceiver(
+                    slots=handoff_settings.get("slots", DEFAULT_SLOTS),
+                    slot_bytes=int(handoff_settings.get("slot_mb", DEFAULT_SLOT_BYTES / 1024 ** 2) * 1024 ** 2),
+                    logger=self.logger)
+                threading.Thread(target=self.handoff_loop, name='handoff', daemon=True).start()
+            except Exception as e:
+                self.logger.log_error(f"Measurement hand-off not available: {e}")
+        record_milestone('process-data', 'ready')
 
     def list_files(self, directory):
         """
@@ -96,6 +157,16 @@ class SignalProcessor:
             self.logger.log_error(f"Error extracting input signal from key: {e}")
             return None
 
+    def write_json(self, filepath, data):
+        """
+        Writes a JSON file, through the staging tier if it is enabled.
+        """
+        if self.staging is not None:
+            self.staging.write(filepath, json.dumps(data, indent=2))
+        else:
+            with open(filepath, 'w') as f:
+                json.dump(data, f, indent=2)
+
     def create_local_metadata_file(self, sensor_id, record_timestamp, file_metadata, measurement_metadata):
         """
         Create a local metadata file instead of DynamoDB entry.
@@ -120,9 +191,7 @@ class SignalProcessor:
             os.makedirs(output_dir, exist_ok=True)
             filename = f"{sensor_id}_{record_timestamp}.json"
             filepath = os.path.join(output_dir, filename)
-            
-            with open(filepath, 'w') as f:
-                json.dump(metadata, f, indent=2)
+            self.write_json(filepath, metadata)
             
             self.logger.log_info(f"Local metadata saved: {filepath}")
             return True
@@ -132,7 +201,7 @@ class SignalProcessor:
 
     def create_local_env_file(self, sensor_id, record_timestamp, env_data):
         """
-        Create a local environment data file.
+        Store environmental data in the time series store.
 
         Parameters:
             sensor_id: Sensor identifier
@@ -140,23 +209,8 @@ class SignalProcessor:
             env_data: Environmental data
         """
         try:
-            metadata = {
-                'sensor_id': sensor_id,
-                'record_timestamp': record_timestamp,
-                'environmental_data': env_data,
-                'created_at': datetime.now().isoformat()
-            }
-            
-            # Save to local JSON file
-            output_dir = '/home/plense/plensor_data/environmental'
-            os.makedirs(output_dir, exist_ok=True)
-            filename = f"{sensor_id}_env_{record_timestamp}.json"
-            filepath = os.path.join(output_dir, filename)
-            
-            with open(filepath, 'w') as f:
-                json.dump(metadata, f, indent=2)
-            
-            self.logger.log_info(f"Local environmental data saved: {filepath}")
+            self.timeseries.add_env(sensor_id, record_timestamp, *env_values(env_data))
+            self.logger.log_info(f"Local environmental data stored for sensor {sensor_id}")
             return True
         except Exception as e:
             self.logger.log_error(f"Error creating local environmental data: {e}")
@@ -164,33 +218,22 @@ class SignalProcessor:
 
     def create_local_tof_file(self, metadata, record_timestamp, tof_data, prefix):
         """
-        Create a local TOF data file.
+        Store TOF data in the time series store.
 
         Parameters:
-            metadata: Metadata about the measurement
+            metadata: Metadata about the measurement, with sensor_id and
+                optionally tof_half_periods, repetitions and damping_level
             record_timestamp: Timestamp of the record
             tof_data: TOF data
-            prefix: File prefix
+            prefix: Measurement command, TOF or TOF_BLOCK
         """
         try:
-            data = {
-                'metadata': metadata,
-                'record_timestamp': record_timestamp,
-                'tof_data': tof_data,
-                'prefix': prefix,
-                'created_at': datetime.now().isoformat()
-            }
-            
-            # Save to local JSON file
-            output_dir = '/home/plense/plensor_data/tof'
-            os.makedirs(output_dir, exist_ok=True)
-            filename = f"{prefix}_{record_timestamp}.json"
-            filepath = os.path.join(output_dir, filename)
-            
-            with open(filepath, 'w') as f:
-                json.dump(data, f, indent=2)
-            
-            self.logger.log_info(f"Local TOF data saved: {filepath}")
+            self.timeseries.add_tof(
+                metadata['sensor_id'], record_timestamp, tof_data, command=prefix,
+                tof_half_periods=metadata.get('tof_half_periods', 0),
+                repetitions=metadata.get('repetitions'),
+                damping_level=metadata.get('damping_level'))
+            self.logger.log_info(f"Local TOF data stored for sensor {metadata['sensor_id']}")
             return True
         except Exception as e:
             self.logger.log_error(f"Error creating local TOF data: {e}")
@@ -241,9 +284,7 @@ class SignalProcessor:
             os.makedirs(output_dir, exist_ok=True)
             filename = f"health_{sensor_id}_{record_timestamp}.json"
             filepath = os.path.join(output_dir, filename)
-            
-            with open(filepath, 'w') as f:
-                json.dump(health_data, f, indent=2)
+            self.write_json(filepath, health_data)
             
             self.logger.log_info(f"Health log saved: {filepath}")
             return True
@@ -253,7 +294,7 @@ class SignalProcessor:
 
     def add_local_environment_log(self, sensor_id, inside_temperature, outside_temperature, inside_humidity, outside_humidity, record_timestamp):
         """
-        Add environment data to local log file.
+        Add environment data to the time series store.
 
         Parameters:
             sensor_id: Sensor identifier
@@ -264,57 +305,198 @@ class SignalProcessor:
             record_timestamp: Timestamp of the record
         """
         try:
-            env_data = {
-                'sensor_id': sensor_id,
-                'inside_temperature': inside_temperature,
-                'outside_temperature': outside_temperature,
-                'inside_humidity': inside_humidity,
-                'outside_humidity': outside_humidity,
-                'record_timestamp': record_timestamp,
-                'created_at': datetime.now().isoformat()
-            }
-            
-            # Save to local environment log
-            output_dir = '/home/plense/plensor_data/environment_logs'
-            os.makedirs(output_dir, exist_ok=True)
-            filename = f"environment_{sensor_id}_{record_timestamp}.json"
-            filepath = os.path.join(output_dir, filename)
-            
-            with open(filepath, 'w') as f:
-                json.dump(env_data, f, indent=2)
-            
-            self.logger.log_info(f"Environment log saved: {filepath}")
+            self.timeseries.add_env(
+                sensor_id, record_timestamp,
+                inside_temperature, outside_temperature, inside_humidity, outside_humidity)
+            self.logger.log_info(f"Environment log stored for sensor {sensor_id}")
             return True
         except Exception as e:
             self.logger.log_error(f"Error creating environment log: {e}")
             return False
 
-    def process_time_domain(self, execute_preprocessing = True, segment_length=25000, process_num_segments=10):
+    def process_time_domain(self, execute_preprocessing = True, segment_length=25000, process_num_segments=10, batch_size=50):
         """
         Process time domain data locally.
+
+        New raw files are registered in the processing manifest, after which
+        the pending files are processed in order of arrival. Whether a file
+        is done is looked up in the manifest instead of on disk.
         """
         try:
             self.logger.log_info("Starting time domain processing...")
-            
-            # Your existing time domain processing logic here
-            # This would be the core signal processing without AWS dependencies
-            
-            self.logger.log_info("Time domain processing completed")
+
+            registered = self.register_new_files()
+            registered += self.register_containers()
+            if registered:
+                self.logger.log_info(f"Registered {registered} new raw files in the manifest")
+            # Also files left by a crash of the measure service, or by a
+            # restart within the stale age
+            self.manifest.requeue_stale()
+
+            if execute_preprocessing:
+                for measurementfile in self.manifest.get_pending(limit=batch_size, suffix=RAW_SOURCE_PATTERNS):
+                    result = self.preprocessor.process_measurement_file(
+                        measurementfile, segments=process_num_segments)
+                    if result is None:
+                        self.logger.log_error(f"Processing failed for {measurementfile}")
+                    else:
+                        record_milestone('process-data', 'first_file_processed')
+
+            self.logger.log_info(f"Time domain processing completed: {self.manifest.count_by_status()}")
             return True
         except Exception as e:
             self.logger.log_error(f"Error in time domain processing: {e}")
             return False
 
-    def process_tof(self):
+    def register_new_files(self):
+        """
+        Registers new raw files in the manifest. The first call scans the raw
+        directory tree and backfills the catalog, which picks up files written
+        while the catalog was not available. After that, only the raw files
+        added to the measurement catalog since the previous call are
+        registered, without listing the directory.
+
+        Returns:
+            int: The number of newly registered files.
+        """
+        if self.catalog_watermark is None:
+            self.catalog_watermark = self.catalog.last_id()
+            self.catalog.backfill([self.raw_td_dir], container_root=None)
+            return self.manifest.register_directory(self.raw_td_dir, suffix=RAW_SUFFIXES, recursive=True)
+
+        registered = 0
+        for measurement in self.catalog.find(root=self.raw_td_dir, after_id=self.catalog_watermark):
+            if self.manifest.get_status(measurement["path"]) is None and self.manifest.register_file(measurement["path"]):
+                registered += 1
+            self.catalog_watermark = measurement["id"]
+        return registered
+
+    def register_containers(self, days=2):
+        """
+        Registers the new records of the measurement containers of the last
+        `days` days in the manifest. Older containers are no longer appended to.
+
+        Returns:
+            int: The number of newly registered records.
+        """
+        registered = 0
+        for container_path in list_containers(self.container_root, days=days):
+            try:
+                container = MeasurementContainer(container_path)
+                registered += self.manifest.register_container(container)
+                container.close()
+            except Exception as e:
+                self.logger.log_error(f"Error registering container {container_path}: {e}")
+        return registered
+
+    def handoff_loop(self, segments=10):
+        """
+        Processes the measurements handed over in shared memory. A measurement
+        is registered in the manifest under the path of its raw file, so the
+        raw file is skipped by `process_time_domain` when it is persisted.
+        The raw file is kept, the retention manager removes it once processed.
+        A failed measurement that the measure service did not persist is
+        written to its raw file before its slot is released, so it can be
+        re-queued instead of being lost.
+        """
+        while self.running:
+            try:
+                received = self.handoff.receive(timeout=1.0)
+            except Exception as e:
+                self.logger.log_error(f"Error receiving a handed off measurement: {e}")
+                time.sleep(1)
+                continue
+            if received is None:
+                continue
+            descriptor, samples = received
+            path = descriptor["path"]
+            failed = False
+            try:
+                status = self.manifest.get_status(path)
+                if status in ('processing', 'done'):
+                    continue
+                if status is None:
+                    self.manifest.register_source(path, int(samples.nbytes), descriptor["sent_at"])
+                self.manifest.mark_started(path)
+                if FULL_SAMPLE_RATE % descriptor["sample_rate"] != 0:
+                    self.manifest.mark_failed(path, f"Inconsistent sample rate {descriptor['sample_rate']}")
+                    failed = True
+                    continue
+                if self.preprocessor.process_samples(
+                        path, samples, descriptor["sample_rate"], segments=segments, remove_raw=False) is not None:
+                    record_milestone('process-data', 'first_file_processed')
+                else:
+                    failed = True
+            except Exception as e:
+                self.logger.log_error(f"Error processing handed off measurement {path}: {e}")
+                self.manifest.mark_failed(path, e)
+                failed = True
+            finally:
+                if failed and not descriptor.get("persisted", True):
+                    try:
+                        self.handoff.persist(descriptor, samples)
+                        self.logger.log_error(f"Stored the failed handed off measurement {path}")
+                    except Exception as e:
+                        self.logger.log_error(f"Storing the failed handed off measurement {path} failed: {e}")
+                del samples
+                self.handoff.release(descriptor)
+
+    def process_tof(self, batch_size=200):
         """
         Process TOF measurements locally.
+
+        New TOF JSON files are registered in the processing manifest. For
+        every pending file the robust statistics are stored and the inlier
+        deltas are added to the running statistics of the sensor, see
+        TofStatisticsStore. The TOF JSON files are kept.
+
+        TOF readings in the time series store are read in id order from
+        the last processed id, which is kept as watermark in the TOF
+        statistics database.
         """
         try:
             self.logger.log_info("Starting TOF processing...")
-            
-            # Your existing TOF processing logic here
-            # This would be the core TOF processing without AWS dependencies
-            
+
+            self.manifest.register_directory(self.tof_dir, suffix='.json', compute_hash=False)
+            for tof_file in self.manifest.get_pending(limit=batch_size, suffix='.json'):
+                self.manifest.mark_started(tof_file)
+                if not os.path.exists(tof_file):
+                    self.manifest.mark_failed(tof_file, "source file not found", status='missing')
+                    continue
+                try:
+                    file_metadata = TofStatisticsStore.interpret_tof_basename(tof_file)
+                    deltas = self.json_handler.safe_json_load(tof_file)
+                    if not deltas:
+                        raise ValueError("no TOF deltas in file")
+                    self.tof_statistics.add_measurement(
+                        os.path.basename(tof_file),
+                        file_metadata["sensor_id"],
+                        file_metadata["tof_half_periods"],
+                        file_metadata["timestamp"],
+                        deltas,
+                        command=file_metadata["command"])
+                    self.manifest.mark_done(tof_file, self.tof_statistics.db_path, TOF_PIPELINE_VERSION)
+                except Exception as e:
+                    self.logger.log_error(f"Error processing TOF file {tof_file}: {e}")
+                    self.manifest.mark_failed(tof_file, e)
+
+            watermark = self.tof_statistics.get_watermark('timeseries')
+            for reading in self.timeseries.get_tof(after_id=watermark, limit=batch_size):
+                try:
+                    if not len(reading["deltas"]):
+                        raise ValueError("no TOF deltas in reading")
+                    self.tof_statistics.add_measurement(
+                        f"timeseries:{reading['id']}",
+                        reading["sensor_id"],
+                        reading["tof_half_periods"],
+                        reading["timestamp"],
+                        reading["deltas"],
+                        command=reading["command"])
+                except Exception as e:
+                    self.logger.log_error(f"Error processing TOF reading {reading['id']}: {e}")
+                watermark = reading["id"]
+            self.tof_statistics.set_watermark('timeseries', watermark)
+
             self.logger.log_info("TOF processing completed")
             return True
         except Exception as e:
@@ -378,4 +560,13 @@ class SignalProcessor:
 
 if __name__ == "__main__":
     processor = SignalProcessor()
-    processor.run()
+    # Stop the run loop on SIGTERM, so staged files are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        processor.run()
+    finally:
+        processor.running = False
+        if processor.handoff is not None:
+            processor.handoff.close()
+        if processor.staging is not None:
+            processor.staging.close()
@@ -6,13 +6,11 @@ import datetime
 from typing import Union, List, Tuple
 
 from datetime import datetime
-from scipy.signal import savgol_filter, welch, lfilter
-from scipy.fft import fft, fftfreq, ifft
-from scipy.ndimage import gaussian_filter1d
-
-import soundfile as sf
 import warnings
 
+# SciPy and soundfile are imported inside the functions that use them, so
+# importing this module (e.g. for the filename helpers) stays cheap.
+
 class LocalDataLoader_edge:
 
     @staticmethod
@@ -21,6 +19,7 @@ class LocalDataLoader_edge:
         Load an audio file and return its data.
         """
         try:
+            import soundfile as sf
             audio_data, sample_rate = sf.read(file, dtype=flc_type)
             if sample_rate != expected_sample_rate:
                 raise Exception(f"Inconsistent sample rate in file {file}: {sample_rate}")
@@ -31,6 +30,49 @@ class LocalDataLoader_edge:
             print(f"Error loading {file}: {e}")
             return None
 
+    @staticmethod
+    def read_measurement(file, dtype="int16") -> tuple:
+        """
+        Read a time domain measurement in any of the storage formats of the
+        measure service (FLAC, WAV, raw int16 .npy with a .json sidecar, or
+        a record in a measurement container, see MeasurementContainer).
+
+        Returns:
+            tuple: (samples, sample rate)
+        """
+        if '::' in file:
+            from MeasurementContainer import read_source
+            return read_source(file, dtype=dtype)
+        if file.endswith('.npy'):
+            import json
+            with open(f"{file}.json") as f:
+                sample_rate = json.load(f)["sample_rate"]
+            return np.load(file).astype(dtype, copy=False), sample_rate
+        import soundfile as sf
+        return sf.read(file, dtype=dtype)
+
+    @staticmethod
+    def load_storage_metadata(file) -> dict:
+        """
+        Load the storage metadata that the measure service writes as JSON in
+        the FLAC comment of band-limited files (decimation factor, filter
+        spec, original sample rate). Full-rate files give an empty dict.
+        """
+        try:
+            import json
+            if file.endswith('.npy'):
+                with open(f"{file}.json") as f:
+                    metadata = json.load(f)
+                metadata.pop("sample_rate", None)
+                return metadata
+            import soundfile as sf
+            with sf.SoundFile(file) as f:
+                comment = f.comment
+            return json.loads(comment) if comment else {}
+        except Exception as e:
+            print(f"Error loading storage metadata of {file}: {e}")
+            return None
+
     @staticmethod
     def interpret_measurementfile_basename(file: str, basename_version = None) -> dict:
         """
@@ -149,12 +191,92 @@ class SignalOperator_edge:
 
         return MS
 
+    # Default bands (Hz) for the band powers in the feature vector, covering
+    # the 20-100 kHz excitation range of the Plensor.
+    FEATURE_BANDS = ((20000, 40000), (40000, 60000), (60000, 80000), (80000, 100000))
+
+    @staticmethod
+    def _feature_columns(bands=FEATURE_BANDS) -> list:
+        """
+        Names of the features returned by `_extract_features`, in order.
+        """
+        band_columns = [f"band_power_{int(lo/1000)}_{int(hi/1000)}khz" for lo, hi in bands]
+        return ["rms", "peak", "crest_factor", "spectral_centroid",
+                *band_columns, "dominant_frequency", "dominant_amplitude",
+                "segment_variance_mean", "segment_variance_std",
+                "segment_variance_min", "segment_variance_max"]
+
+    @staticmethod
+    def _extract_features(signal: np.ndarray, sample_rate=500000, bands=FEATURE_BANDS, segments=10, nperseg=4096) -> dict:
+        """
+        Computes the standard acoustic feature vector of a signal in one
+        vectorized pass: RMS, peak, crest factor, spectral centroid, band
+        powers, dominant peak frequency and amplitude and the variance per
+        segment.
+
+        The spectral features are computed on the Welch PSD estimate. The
+        dominant amplitude is the amplitude of a sine at the dominant frequency
+        that would give the same peak, i.e. sqrt(2 * PSD * ENBW).
+
+        Parameters:
+            signal (np.ndarray): Input signal, int16 samples are scaled to [-1, 1].
+            sample_rate (int): Sample rate of the signal in Hz.
+            bands (tuple): (low, high) frequency pairs in Hz for the band powers.
+            segments (int): Number of segments for the per-segment variance.
+            nperseg (int): Welch segment length.
+
+        Returns:
+            dict: The features, keyed by the names of `_feature_columns`.
+        """
+        from scipy.signal import get_window, welch
+
+        x = np.asarray(signal)
+        if x.dtype == np.int16:
+            x = x.astype(np.float32) / 32767.0
+        x = x.astype(np.float64, copy=False)
+
+        square = np.square(x)
+        rms = np.sqrt(np.mean(square))
+        peak = np.max(np.abs(x))
+
+        nperseg = min(nperseg, len(x))
+        freqs, psd = welch(x, fs=sample_rate, window='hann', nperseg=nperseg)
+        df = freqs[1] - freqs[0]
+        total_power = np.sum(psd)
+        window = get_window('hann', nperseg)
+        enbw = sample_rate * np.sum(window**2) / np.sum(window)**2
+        peak_index = np.argmax(psd)
+
+        lows, highs = np.array(bands, dtype=np.float64).T
+        in_band = (freqs[None, :] >= lows[:, None]) & (freqs[None, :] < highs[:, None])
+        band_powers = (in_band * psd[None, :]).sum(axis=1) * df
+
+        segment_length = len(x) // segments
+        segment_variance = np.var(x[:segment_length * segments].reshape(segments, segment_length), axis=1)
+
+        values = [
+            rms,
+            peak,
+            peak / rms if rms > 0 else 0.0,
+            np.sum(freqs * psd) / total_power if total_power > 0 else 0.0,
+            *band_powers,
+            freqs[peak_index],
+            np.sqrt(2 * psd[peak_index] * enbw),
+            np.mean(segment_variance),
+            np.std(segment_variance),
+            np.min(segment_variance),
+            np.max(segment_variance),
+        ]
+        columns = SignalOperator_edge._feature_columns(bands)
+        return {column: float(value) for column, value in zip(columns, values)}
+
     @staticmethod
     def _transform_segments_ifft(signal, check_imag=False):
         """
         Give the inverse fft of a signal. 
         TODO include faultsafe checks and data checks
         """
+        from scipy.fft import ifft
         inverse_fft_signal = ifft(signal)
         if check_imag:
             max_j = np.max(np.abs(np.imag(inverse_fft_signal)))
@@ -182,6 +304,7 @@ class SignalOperator_edge:
         
         TODO: include try/except statements
         """
+        from scipy.fft import fft
         # Split in given segments
         audio_data_segments = np.split(signal, segments)
         # Apply FFT with optional mean subtraction
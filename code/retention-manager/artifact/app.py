@@ -0,0 +1,305 @@
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'process-data', 'artifact'))
+from ErrorLogger import ErrorLogger
+from RetentionIndex import RetentionIndex
+from DataLayout import DATA_ROOT, LONG_DIR, PROCESSED_DIR, RAW_DIR, prune_empty_shards
+from MeasurementCatalog import MeasurementCatalog
+from MeasurementContainer import CONTAINER_SUFFIX, INDEX_SUFFIX, MeasurementContainer, source_id
+from ProcessingManifest import ProcessingManifest
+
+# Data classes that are not in the measurement catalog: the directory trees
+# and file suffixes indexed by the RetentionIndex
+INDEXED_CLASSES = {
+    'raw_audio': ([os.path.join(DATA_ROOT, 'audio_data', 'containers')],
+                  (CONTAINER_SUFFIX, CONTAINER_SUFFIX + INDEX_SUFFIX)),
+    'previews': ([os.path.join(DATA_ROOT, 'audio_data', 'previews')], ('.npz',)),
+    'long_acquisitions': ([LONG_DIR], ('.flac',)),
+    'legacy_json': ([os.path.join(DATA_ROOT, name) for name in (
+        'environment_data', 'environmental', 'environment_logs', 'health_logs', 'tof',
+        os.path.join('audio_data', 'tof'))], ('.json',)),
+    'logs': ([os.path.join(DATA_ROOT, 'logs')], None),
+}
+
+# Order in which data classes give up space when the disk runs full
+FREE_SPACE_ORDER = ('previews', 'logs', 'legacy_json', 'long_acquisitions', 'processed_audio', 'raw_audio')
+# (timestamp, path) before every candidate, the start of the paging
+FIRST_CANDIDATE = (float('-inf'), '')
+
+DEFAULT_SETTINGS = {
+    "interval_s": 900,
+    "min_free_bytes": 2 * 1024 ** 3,
+    "deletes_per_second": 20,
+    "max_deletes_per_run": 5000,
+    "classes": {
+        "raw_audio": {"max_bytes": 8 * 1024 ** 3, "max_age_days": 7},
+        "processed_audio": {"max_bytes": 16 * 1024 ** 3, "max_age_days": 180},
+        "previews": {"max_bytes": 1024 ** 3, "max_age_days": 180},
+        "long_acquisitions": {"max_bytes": 4 * 1024 ** 3, "max_age_days": 30},
+        "legacy_json": {"max_bytes": 512 * 1024 ** 2, "max_age_days": 90},
+        "logs": {"max_bytes": 512 * 1024 ** 2, "max_age_days": 60},
+    },
+}
+
+
+class RetentionManager:
+    """
+    RetentionManager bounds the disk usage of /home/plense/plensor_data with
+    a byte budget and a maximum age per data class, and evicts the oldest
+    files first. Data moves down three tiers:
+
+        1. raw_audio: full-rate raw files and containers, kept for
+           `max_age_days` once they are processed (unprocessed raw data is
+           only evicted when the budget or the free space forces it),
+        2. processed_audio: the processed FLAC files (and band-limited
+           storage), kept for `max_age_days`,
+        3. features only: the feature table, TOF statistics and time series
+           databases in index/, which are never evicted.
+
+    Previews, legacy per-reading JSON files and copied logs have their own
+    budgets. The oldest files are found with queries on the measurement
+    catalog and the RetentionIndex instead of walking the tree, and deletes
+    are throttled to `deletes_per_second` so acquisition is not disturbed.
+    """
+
+    def __init__(self, settings_path=None):
+        self.logger = ErrorLogger.get_instance(
+            directory='/home/plense/error_logs',
+            log_level=20,
+            log_file_name='RetentionManagerPlense.log'
+        )
+        self.logger.log_critical('-----New instance started-----')
+        self.settings_path = settings_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retention_settings.json')
+        self.settings = self.load_settings()
+        self.catalog = MeasurementCatalog.get_instance(logger=self.logger)
+        self.manifest = ProcessingManifest.get_instance()
+        self.index = RetentionIndex.get_instance()
+        self.deleted = 0
+        self.catalog_backfilled = False
+
+    def load_settings(self) -> dict:
+        """
+        Loads the retention settings, missing entries fall back to the
+        defaults.
+        """
+        settings = json.loads(json.dumps(DEFAULT_SETTINGS))
+        try:
+            with open(self.settings_path) as f:
+                loaded = json.load(f)
+            for data_class, class_settings in loaded.pop("classes", {}).items():
+                settings["classes"].setdefault(data_class, {}).update(class_settings)
+            settings.update(loaded)
+        except FileNotFoundError:
+            self.logger.log_info(f"No retention settings at {self.settings_path}, using the defaults")
+        except Exception as e:
+            self.logger.log_error(f"Error loading retention settings {self.settings_path}: {e}")
+        return settings
+
+    def refresh_indexes(self) -> None:
+        """
+        Brings the indexes up to date. The catalog is backfilled once at
+        startup (the services keep it current afterwards), the RetentionIndex
+        is refreshed incrementally.
+        """
+        if not self.catalog_backfilled:
+            result = self.catalog.backfill([RAW_DIR, PROCESSED_DIR], container_root=None)
+            self.logger.log_info(f"Catalog backfill: {result}")
+            self.catalog_backfilled = True
+        for data_class, (roots, suffixes) in INDEXED_CLASSES.items():
+            for root in roots:
+                try:
+                    self.index.refresh(data_class, root, suffixes)
+                except Exception as e:
+                    self.logger.log_error(f"Error refreshing the retention index of {root}: {e}")
+
+    def usage(self) -> dict:
+        """
+        Returns the bytes used per data class.
+        """
+        usage = {data_class: self.index.total_size(data_class) for data_class in INDEXED_CLASSES}
+        usage['raw_audio'] += self.catalog.total_size(root=RAW_DIR)
+        usage['processed_audio'] = self.catalog.total_size(root=PROCESSED_DIR)
+        return usage
+
+    def candidates(self, data_class, limit=100, before=None, after=FIRST_CANDIDATE) -> list:
+        """
+        Returns the oldest files of a data class, as dicts with path, size and
+        timestamp, ordered by timestamp and path, optionally only those older
+        than `before` (epoch seconds). Pass the (timestamp, path) of the last
+        candidate as `after` for the next page.
+        """
+        candidates = []
+        if data_class in ('raw_audio', 'processed_audio'):
+            directory = RAW_DIR if data_class == 'raw_audio' else PROCESSED_DIR
+            candidates += [
+                {"path": m["path"], "size": m["size"] or 0, "timestamp": m["timestamp"]}
+                for m in self.catalog.find(root=directory, end=before, after=after, limit=limit)]
+        if data_class in INDEXED_CLASSES:
+            candidates += [
+                {"path": f["path"], "size": f["size"], "timestamp": f["mtime"]}
+                for f in self.index.oldest(data_class, limit=limit, before=before, after=after)
+                if not f["path"].endswith(INDEX_SUFFIX)]
+        return sorted(candidates, key=lambda c: (c["timestamp"], c["path"]))[:limit]
+
+    def is_processed(self, path) -> bool:
+        """
+        Checks whether a raw file, or every record of a container, is processed.
+        """
+        if path.endswith(CONTAINER_SUFFIX):
+            container = MeasurementContainer(path)
+            try:
+                return all(self.manifest.is_done(source_id(path, record)) for record in range(len(container)))
+            finally:
+                container.close()
+        return self.manifest.is_done(path)
+
+    def evict(self, data_class, candidate) -> int:
+        """
+        Deletes a file (with its sidecar or container index) and removes it
+        from the indexes. Throttled to `deletes_per_second`.
+
+        Returns:
+            int: The number of freed bytes.
+        """
+        path = candidate["path"]
+        if path.endswith(CONTAINER_SUFFIX) and os.path.basename(os.path.dirname(path)) == datetime.now().strftime('%Y-%m-%d'):
+            # Today's container is still being appended to
+            return 0
+        companions = [f"{path}.json"] if path.endswith('.npy') or data_class == 'long_acquisitions' else []
+        if path.endswith(CONTAINER_SUFFIX):
+            companions.append(path + INDEX_SUFFIX)
+        freed = 0
+        for file_path in [path] + companions:
+            try:
+                freed += os.path.getsize(file_path)
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.log_error(f"Error deleting {file_path}: {e}")
+                return 0
+            self.index.remove(file_path)
+        prune_empty_shards(os.path.dirname(path))
+        if path.endswith(CONTAINER_SUFFIX):
+            self.catalog.remove_container(path)
+        elif data_class in ('raw_audio', 'processed_audio', 'long_acquisitions'):
+            self.catalog.remove(path)
+        self.deleted += 1
+        time.sleep(1 / self.settings["deletes_per_second"])
+        return freed
+
+    def enforce_age(self, data_class) -> int:
+        """
+        Evicts the files of a data class that are older than its maximum
+        age. Raw data is only evicted by age once it is processed.
+
+        Returns:
+            int: The number of freed bytes.
+        """
+        max_age_days = self.settings["classes"].get(data_class, {}).get("max_age_days")
+        if max_age_days is None:
+            return 0
+        before = time.time() - max_age_days * 86400
+        freed, after = 0, FIRST_CANDIDATE
+        while self.deleted < self.settings["max_deletes_per_run"]:
+            # Paged after the last candidate, unprocessed raw files are not
+            # read again
+            batch = self.candidates(data_class, limit=100, before=before, after=after)
+            if not batch:
+                break
+            for candidate in batch:
+                after = (candidate["timestamp"], candidate["path"])
+                if data_class == 'raw_audio' and not self.is_processed(candidate["path"]):
+                    continue
+                freed += self.evict(data_class, candidate)
+        return freed
+
+    def enforce_budget(self, data_class, max_bytes, usage) -> int:
+        """
+        Evicts the oldest files of a data class until it uses at most
+        `max_bytes`.
+
+        Returns:
+            int: The number of freed bytes.
+        """
+        freed, after = 0, FIRST_CANDIDATE
+        while usage - freed > max_bytes and self.deleted < self.settings["max_deletes_per_run"]:
+            batch = self.candidates(data_class, limit=100, after=after)
+            if not batch:
+                break
+            for candidate in batch:
+                if usage - freed <= max_bytes:
+                    break
+                after = (candidate["timestamp"], candidate["path"])
+                freed += self.evict(data_class, candidate)
+        return freed
+
+    def run_once(self) -> dict:
+        """
+        Refreshes the indexes and applies the age rules, the budgets and the
+        minimum free space, in that order.
+
+        Returns:
+            dict: Usage per data class before the run, freed bytes and deletes.
+        """
+        self.deleted = 0
+        self.refresh_indexes()
+        usage = self.usage()
+        freed = 0
+        for data_class in FREE_SPACE_ORDER:
+            freed += self.enforce_age(data_class)
+        usage_after_age = self.usage()
+        for data_class, class_settings in self.settings["classes"].items():
+            if class_settings.get("max_bytes") is not None and data_class in usage_after_age:
+                freed += self.enforce_budget(data_class, class_settings["max_bytes"], usage_after_age[data_class])
+
+        free_bytes = shutil.disk_usage(DATA_ROOT).free
+        missing = self.settings["min_free_bytes"] - free_bytes
+        if missing > 0:
+            self.logger.log_error(f"Only {free_bytes} bytes free on {DATA_ROOT}, evicting {missing} bytes")
+            current = self.usage()
+            for data_class in FREE_SPACE_ORDER:
+                if missing <= 0:
+                    break
+                class_freed = self.enforce_budget(data_class, max(0, current[data_class] - missing), current[data_class])
+                missing -= class_freed
+                freed += class_freed
+
+        summary = {"usage": usage, "freed_bytes": freed, "deleted_files": self.deleted}
+        self.logger.log_info(f"Retention run: {summary}")
+        return summary
+
+    def run(self) -> None:
+        """
+        Main run loop for retention management.
+        """
+        try:
+            self.logger.log_info("Starting retention manager...")
+            while True:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    self.logger.log_error(f"Error in retention run: {e}")
+                time.sleep(self.settings["interval_s"])
+        except KeyboardInterrupt:
+            self.logger.log_info("Retention manager stopped by user")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Retention manager of plensor_data")
+    parser.add_argument('--once', action='store_true', help="run once and print the summary")
+    parser.add_argument('--settings', help="retention settings file")
+    args = parser.parse_args()
+
+    retention_manager = RetentionManager(args.settings)
+    if args.once:
+        print(json.dumps(retention_manager.run_once(), indent=4))
+    else:
+        retention_manager.run()
@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# Set environment variables for local operation
+export AS_LOCAL='true'
+
+cd /home/plense/edge-code/retention-manager/artifact
+source /home/plense/edge-code/.venv/bin/activate
+# Idle I/O class and low CPU priority, acquisition always goes first
+ionice -c3 nice -n 10 python app.py